@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+Bản ASGI (asyncio) của Google OAuth Server - cùng JSON contract với bản Flask
+Callback và verify chạy bất đồng bộ, một worker phục vụ được nhiều lượt đăng nhập cùng lúc
+trong khi chờ Google/server admin. Các route còn lại do app Flask xử lý.
+
+Cần cài đặt thêm: pip install httpx uvicorn
+Chạy: uvicorn async_server:app --host 0.0.0.0 --port $PORT
+"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import httpx
+from werkzeug.http import parse_cookie
+
+import server_google_oauth_example as sync_server
+from html_pages import compress_body
+from metrics import UPSTREAM_SECONDS, upstream_outcome
+from upstream_client import Bulkhead, UpstreamCall, UpstreamResult, reject_open_circuit
+
+
+class AsyncUpstreamClient:
+    """httpx.AsyncClient dùng chung trong process, giữ kết nối keep-alive theo host"""
+
+    def __init__(self, max_connections=100, max_keepalive_connections=20, verify=True):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections
+        )
+        self.verify = verify
+        self._client = None
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits, verify=self.verify)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def call(self, call):
+        """Thực hiện UpstreamCall, lỗi kết nối được gói vào UpstreamResult.error"""
+        if call.breaker is not None and not call.breaker.allow():
+            return reject_open_circuit(call)
+        # call.bulkhead (giới hạn theo thread của bản sync) không áp dụng ở đây:
+        # số lời gọi đồng thời mỗi host đã bị httpx.Limits giới hạn, phần dư chờ trong pool
+        await self.start()
+        start = time.perf_counter()
+        result = None
+        try:
+            response = await self._client.request(call.method, call.url, **call.kwargs)
+            result = UpstreamResult(response.status_code, response.text)
+        except Exception as error:
+            result = UpstreamResult(error=error)
+        finally:
+            if call.breaker is not None:
+                if result is None:
+                    # CancelledError (client ngắt kết nối, wait_for hết giờ): không kết luận được
+                    # upstream lỗi hay không, nhưng lượt thử half_open phải được trả lại
+                    call.breaker.release_trial()
+                else:
+                    call.breaker.record(result)
+        if call.stage:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, call.stage, upstream_outcome(result))
+        return result
+
+
+# Phần đồng bộ giữa các lời gọi upstream (store sqlite/redis, rate limiter redis, fsync journal đăng ký...)
+# chạy trong thread pool riêng: một lần đọc đĩa/Redis chậm không làm treo mọi kết nối của event loop
+step_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('ASGI_STEP_THREADS', 32)),
+    thread_name_prefix='asgi-steps'
+)
+
+
+async def run_blocking(fn, *args):
+    """Chạy hàm đồng bộ có thể chặn (I/O store, rate limiter) trong step_executor"""
+    return await asyncio.get_running_loop().run_in_executor(step_executor, fn, *args)
+
+
+def _advance(steps, result):
+    # StopIteration không đi qua Future được: đổi thành (None, giá trị return)
+    try:
+        return steps.send(result), None
+    except StopIteration as stop:
+        return None, stop.value
+
+
+async def run_upstream_steps_async(steps, client):
+    """Chạy generator các bước xử lý với client bất đồng bộ, mỗi bước đồng bộ chạy trong step_executor"""
+    result = None
+    while True:
+        call, value = await run_blocking(_advance, steps, result)
+        if call is None:
+            return value
+        wake = call.wake
+        if wake is not None and not wake.is_warm and not (call.breaker is not None and call.breaker.is_open):
+            # Server admin đang cold: ping đánh thức chạy song song với lời gọi chính
+            ping_timeout = min(wake.ping_timeout, call.kwargs.get('timeout') or wake.ping_timeout)
+            ping_result, result = await asyncio.gather(
+                client.call(UpstreamCall('GET', wake.ping_url, stage='admin_ping', timeout=ping_timeout)),
+                client.call(call)
+            )
+            if ping_result.error is None and ping_result.status_code < 500:
+                wake.mark_warm()
+        else:
+            result = await client.call(call)
+
+
+async_upstream = AsyncUpstreamClient(
+    max_connections=int(os.getenv('UPSTREAM_POOL_MAXSIZE', 100)),
+    max_keepalive_connections=int(os.getenv('UPSTREAM_POOL_KEEPALIVE', 20))
+)
+
+# Giới hạn lượt callback/verify đang chạy trong event loop (coroutine rẻ hơn thread nhiều
+# nên giới hạn cao hơn bản Flask); quá giới hạn thì trả 503 + Retry-After ngay, không chờ
+async_endpoint_bulkheads = {
+    endpoint: Bulkhead(endpoint, max_concurrent=int(os.getenv('ASGI_MAX_CONCURRENT', 256)))
+    for endpoint in ('google_callback', 'verify_google_auth', 'google_auth_refresh')
+}
+# Request long-poll của device flow chỉ là coroutine đang ngủ: giới hạn riêng, cao hơn nhiều
+async_endpoint_bulkheads['google_auth_poll'] = Bulkhead(
+    'google_auth_poll', max_concurrent=int(os.getenv('ASGI_MAX_POLLERS', 10000))
+)
+
+# ============================================
+# ASGI HELPERS
+# ============================================
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _send_response(send, status, body, content_type, extra_headers=None):
+    headers = [
+        (b'content-type', content_type.encode('latin-1')),
+        (b'content-length', str(len(body)).encode('latin-1')),
+    ]
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _jsonify(payload):
+    # Giống jsonify của Flask: sort key, gọn, kết thúc bằng xuống dòng
+    return (json.dumps(payload, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def _call_flask(scope, body):
+    """Chuyển request sang app Flask (WSGI) cho các route không gọi upstream"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value.decode('latin-1')
+        elif key != 'CONTENT_LENGTH':
+            environ[f'HTTP_{key}'] = value.decode('latin-1')
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    chunks = sync_server.app(environ, start_response)
+    try:
+        data = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response['status'], response['headers'], data
+
+# ============================================
+# ROUTES
+# ============================================
+
+async def google_callback(scope, body):
+    """Callback từ Google OAuth - các bước giống google_callback_steps của bản Flask"""
+    query = {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+    cookies = parse_cookie('; '.join(value.decode('latin-1') for name, value in scope.get('headers', [])
+                                     if name.lower() == b'cookie'))
+    state_cookie = cookies.get(sync_server.OAUTH_STATE_COOKIE)
+    start = time.perf_counter()
+    html, status = await run_upstream_steps_async(sync_server.google_callback_steps(query, state_cookie),
+                                                  async_upstream)
+    sync_server.REQUEST_SECONDS.observe(time.perf_counter() - start, 'google_callback', str(status))
+    # Như send_html của bản Flask: không cache, nén nếu trình duyệt chấp nhận
+    accept_encoding = next((value.decode('latin-1') for name, value in scope.get('headers', [])
+                            if name.lower() == b'accept-encoding'), None)
+    data, encoding = compress_body(html.encode('utf-8'), accept_encoding)
+    headers = {'Cache-Control': 'no-store', 'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    if state_cookie is not None:
+        headers['Set-Cookie'] = sync_server.oauth_state_cookie(None)
+    return status, data, 'text/html; charset=utf-8', headers
+
+
+def _json_body(body):
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return None
+
+
+def _rate_limited(scope, data, endpoint):
+    """Giống limit_verify_rate của bản Flask: phản hồi 429 hoặc None nếu được phép"""
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+    ip = sync_server.client_ip((scope.get('client') or ('', 0))[0], headers.get('x-forwarded-for'))
+    retry_after = sync_server.verify_rate_limited(ip, data)
+    if retry_after is None:
+        return None
+    payload, extra_headers = sync_server.rate_limited_payload(retry_after)
+    sync_server.REQUEST_SECONDS.observe(0.0, endpoint, '429')
+    return 429, _jsonify(payload), 'application/json', extra_headers
+
+
+async def verify_google_auth(scope, body):
+    """Xác minh mã và đăng nhập - cùng JSON contract với bản Flask"""
+    data = _json_body(body)
+    limited = await run_blocking(_rate_limited, scope, data, 'verify_google_auth')
+    if limited is not None:
+        return limited
+    start = time.perf_counter()
+    payload, status = await sync_server.verify_flights.do_async(
+        sync_server.verify_flight_key(data),
+        lambda: run_upstream_steps_async(sync_server.verify_and_remember_steps(data), async_upstream)
+    )
+    sync_server.REQUEST_SECONDS.observe(time.perf_counter() - start, 'verify_google_auth', str(status))
+    return status, _jsonify(payload), 'application/json', (sync_server.retry_after_headers() if status == 503 else None)
+
+
+async def google_auth_refresh(scope, body):
+    """Đăng nhập lại bằng refresh token đã lưu - cùng JSON contract với bản Flask"""
+    data = _json_body(body)
+    limited = await run_blocking(_rate_limited, scope, data, 'google_auth_refresh')
+    if limited is not None:
+        return limited
+    start = time.perf_counter()
+    payload, status = await sync_server.verify_flights.do_async(
+        sync_server.refresh_flight_key(data),
+        lambda: run_upstream_steps_async(sync_server.refresh_login_steps(data), async_upstream)
+    )
+    sync_server.REQUEST_SECONDS.observe(time.perf_counter() - start, 'google_auth_refresh', str(status))
+    return status, _jsonify(payload), 'application/json', (sync_server.retry_after_headers() if status == 503 else None)
+
+
+async def wait_for_device_login_async(key, data, timeout):
+    """Bản asyncio của sync_server.wait_for_device_login: chờ trên Future, không giữ thread"""
+    deadline = time.monotonic() + timeout
+    async with sync_server.device_waiters.async_waiter(key) as waiter:
+        while not await run_blocking(sync_server.device_login_ready, data):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await waiter.wait(sync_server.device_wait_slice(remaining))
+    return True
+
+
+async def google_auth_poll(scope, body):
+    """Long-poll của device flow - cùng JSON contract với bản Flask"""
+    query = {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+    key, data, timeout = sync_server.device_poll_params(query)
+    if key is None:
+        return 400, _jsonify(sync_server.DEVICE_INVALID_PAYLOAD), 'application/json', None
+    limited = await run_blocking(_rate_limited, scope, data, 'google_auth_poll')
+    if limited is not None:
+        return limited
+    if not await wait_for_device_login_async(key, data, timeout):
+        return 202, _jsonify(sync_server.DEVICE_PENDING_PAYLOAD), 'application/json', None
+    start = time.perf_counter()
+    payload, status = await sync_server.verify_flights.do_async(
+        sync_server.verify_flight_key(data),
+        lambda: run_upstream_steps_async(sync_server.device_verify_steps(data), async_upstream)
+    )
+    sync_server.REQUEST_SECONDS.observe(time.perf_counter() - start, 'google_auth_poll', str(status))
+    return status, _jsonify(payload), 'application/json', (sync_server.retry_after_headers() if status == 503 else None)
+
+
+def _overloaded(endpoint):
+    """Phản hồi 503 + Retry-After giống bản Flask khi endpoint đã đủ giới hạn đồng thời"""
+    sync_server.REQUEST_SECONDS.observe(0.0, endpoint, '503')
+    headers = sync_server.retry_after_headers()
+    if endpoint == 'google_callback':
+        return 503, sync_server.OVERLOADED_HTML.encode('utf-8'), 'text/html; charset=utf-8', headers
+    return 503, _jsonify({'success': False, 'message': sync_server.OVERLOADED_MESSAGE}), 'application/json', headers
+
+
+# (method, path) -> (handler, tên endpoint trong async_endpoint_bulkheads)
+ASYNC_ROUTES = {
+    ('GET', '/api/google-callback'): (google_callback, 'google_callback'),
+    ('POST', '/api/verify-google-auth'): (verify_google_auth, 'verify_google_auth'),
+    ('GET', '/api/google-auth/poll'): (google_auth_poll, 'google_auth_poll'),
+    ('POST', '/api/google-auth/refresh'): (google_auth_refresh, 'google_auth_refresh'),
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await async_upstream.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_upstream.close()
+            # uvicorn chạy trực tiếp (không qua worker_exit của gunicorn): dừng keep-warm và thread gửi đăng ký,
+            # ghi snapshot mã còn hạn, xả hàng đợi log trước khi thoát
+            await asyncio.get_running_loop().run_in_executor(None, sync_server.stop_background_jobs)
+            step_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entrypoint"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = await _read_body(receive)
+    route = ASYNC_ROUTES.get((scope['method'], scope['path']))
+    if route is not None:
+        handler, endpoint = route
+        bulkhead = async_endpoint_bulkheads[endpoint]
+        if not bulkhead.try_acquire():
+            status, data, content_type, headers = _overloaded(endpoint)
+        else:
+            try:
+                status, data, content_type, headers = await handler(scope, body)
+            finally:
+                bulkhead.release()
+        await _send_response(send, status, data, content_type, headers)
+        return
+
+    # Route nhẹ (/, /ping, /api/google-auth, /api/check-config) chạy app Flask trong thread pool
+    status, headers, data = await asyncio.to_thread(_call_flask, scope, body)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    })
+    await send({'type': 'http.response.body', 'body': data})
@@ -0,0 +1,1832 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark cho Google OAuth Server
+Chạy: python benchmark_google_oauth.py store [--sizes 10000 100000 1000000]
+      python benchmark_google_oauth.py workers [--workers 1 4 8] [--codes 20000]
+      python benchmark_google_oauth.py backends [--redis-url redis://localhost:6379/0]
+      python benchmark_google_oauth.py pool [--requests 200]
+      python benchmark_google_oauth.py keepwarm [--verifies 5] [--gap 2.5]
+      python benchmark_google_oauth.py asgi [--logins 200] [--concurrency 50]
+      python benchmark_google_oauth.py idtoken [--callbacks 200] [--google-latency 0.05]
+      python benchmark_google_oauth.py prefetch [--logins 50] [--admin-latency 0.1]
+      python benchmark_google_oauth.py metrics [--observations 1000000]
+      python benchmark_google_oauth.py logging [--verifies 2000] [--concurrency 8] [--consumer-delay 0.002]
+      python benchmark_google_oauth.py breaker [--verifies 40] [--concurrency 10] [--hang 6] [--deadline 4]
+      python benchmark_google_oauth.py bulkhead [--duration 10] [--concurrency 64] [--threads 16]
+      python benchmark_google_oauth.py ratelimit [--ops 200000] [--redis-url redis://localhost:6379/0]
+      python benchmark_google_oauth.py singleflight [--codes 50] [--duplicates 3] [--admin-latency 0.2]
+      python benchmark_google_oauth.py longpoll [--waiters 2000] [--idle 10] [--interval 1]
+      python benchmark_google_oauth.py refresh [--logins 50] [--google-latency 0.08] [--admin-latency 0.15]
+      python benchmark_google_oauth.py workerclass [--logins 400] [--concurrency 64] [--workers 1]
+      python benchmark_google_oauth.py e2e [--logins 500] [--concurrency 16] [--server gthread] [--workers 1]
+                                           [--google-latency 0.08] [--admin-latency 0.15] [--jitter 0.2]
+                                           [--google-error-rate 0] [--admin-error-rate 0] [--env KEY=VALUE ...]
+                                           [--json kết-quả.json] [--compare kết-quả-commit-trước.json]
+      python benchmark_google_oauth.py writebehind [--verifies 200] [--concurrency 16] [--admin-latency 0.15]
+                                                   [--appends 5000] [--threads 1 8 32]
+      python benchmark_google_oauth.py allocator [--live 100000 300000 600000] [--threads 8] [--workers 4]
+      python benchmark_google_oauth.py snapshot [--sizes 10000 100000 300000] [--restart-codes 100000]
+      python benchmark_google_oauth.py html [--renders 20000]
+      python benchmark_google_oauth.py profiler [--verifies 1000] [--concurrency 8] [--hz 100 1000] [--rounds 2]
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import requests
+
+from metrics import MetricsRegistry
+from rate_limit import RedisTokenBucketLimiter, TokenBucketLimiter
+from code_allocator import CodeAllocator
+from registration_journal import RegistrationJournal
+from mock_upstreams import StandInServer, admin_routes, generate_rsa_key, generate_self_signed_cert, google_routes
+from structured_log import StructuredLogger
+from upstream_client import CircuitBreaker, SingleFlight, UpstreamClient
+from verification_store import (
+    MemoryVerificationStore, RedisVerificationStore, SQLiteVerificationStore, VerificationSnapshotter, read_snapshot,
+    write_snapshot
+)
+
+# ============================================
+# TIỆN ÍCH ĐO THỜI GIAN
+# ============================================
+
+def timed(fn):
+    """Chạy fn() và trả về (kết quả, số giây)"""
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def print_row(*cols):
+    print("  ".join(f"{c:>14}" for c in cols))
+
+
+def fmt_ns(seconds, count):
+    return f"{seconds / max(count, 1) * 1e9:.0f} ns/op"
+
+
+def percentile(samples, pct):
+    """Percentile theo nearest-rank của danh sách đã sort"""
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples))) - 1))
+    return samples[index]
+
+
+def fmt_latency(samples):
+    samples = sorted(samples)
+    return f"{percentile(samples, 50) * 1e6:.0f}/{percentile(samples, 99) * 1e6:.0f} us"
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_env(**overrides):
+    """Biến môi trường tối thiểu để chạy server_google_oauth_example trong benchmark"""
+    env = dict(os.environ)
+    env.update({
+        'GOOGLE_CLIENT_ID': 'bench-client-id',
+        'GOOGLE_CLIENT_SECRET': 'bench-client-secret',
+        'GOOGLE_REDIRECT_URI': 'http://127.0.0.1/api/google-callback',
+        'OAUTH_STATE_KEYS': 'bench-state-key',
+        'ADMIN_KEEP_WARM_INTERVAL': '0',
+        # Mọi request benchmark đến từ 127.0.0.1: bỏ giới hạn tần suất (xem lệnh ratelimit)
+        'VERIFY_RATE_PER_IP': '100000000',
+        'VERIFY_BURST_PER_IP': '100000000',
+        'VERIFY_RATE_PER_MACHINE': '100000000',
+        'VERIFY_BURST_PER_MACHINE': '100000000',
+    })
+    env.update({key: str(value) for key, value in overrides.items()})
+    return env
+
+
+def import_server(**overrides):
+    """Import server_google_oauth_example trong process hiện tại với cấu hình benchmark"""
+    os.environ.update(server_env(**overrides))
+    import server_google_oauth_example
+    return server_google_oauth_example
+
+
+def start_server_process(cmd, port, env, timeout=20):
+    """Chạy server (gunicorn/uvicorn) ở process riêng, chờ tới khi /ping trả lời"""
+    proc = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/ping", timeout=1).status_code == 200:
+                return proc
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"Server không khởi động được: {' '.join(cmd)}")
+
+
+def drive_verifies(base_url, codes, concurrency):
+    """Gửi verify song song, trả về (wall giây, danh sách độ trễ, số lần thành công, Counter status)"""
+    def one(code):
+        start = time.perf_counter()
+        response = requests.post(f"{base_url}/api/verify-google-auth",
+                                 json={'auth_code': code, 'machine_id': f"machine-{code}"}, timeout=120)
+        ok = response.status_code == 200 and response.json().get('success')
+        return time.perf_counter() - start, ok, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, codes))
+    wall = time.perf_counter() - start
+    return wall, sorted(r[0] for r in results), sum(1 for r in results if r[1]), Counter(r[2] for r in results)
+
+
+def assert_logins(statuses, ok, admin):
+    """
+    Kết quả đúng: chỉ 200 hoặc 503 (bị từ chối vì quá tải) và mỗi lần đăng nhập thành công đúng một
+    lời gọi /api/register (máy mới) hoặc /api/login (máy đã đăng ký ở lần chạy trước)
+    """
+    assert set(statuses) <= {200, 503}, f"status ngoài 200/503: {dict(statuses)}"
+    calls = admin.calls['/api/register'] + admin.calls['/api/login']
+    assert calls == ok, f"{calls} lần register/login cho {ok} lần đăng nhập thành công"
+
+# ============================================
+# STORE: dict cũ vs MemoryVerificationStore
+# ============================================
+
+def bench_store(sizes, expired_ratio=0.1):
+    """So sánh insert / lookup / expire giữa dict cũ và MemoryVerificationStore"""
+    print_row("size", "impl", "insert", "lookup", "expire", "expired")
+    for size in sizes:
+        codes = [f"{i:07d}" for i in range(size)]
+        expired_count = int(size * expired_ratio)
+        now = time.time()
+
+        # Dict cũ: lưu đủ 5 trường, dọn dẹp bằng cách duyệt toàn bộ
+        store = {}
+
+        def dict_insert():
+            for i, code in enumerate(codes):
+                store[code] = {
+                    'email': 'user@example.com',
+                    'name': 'User',
+                    'picture': 'https://example.com/p.png',
+                    'access_token': 'ya29.token',
+                    'expires_at': now - 1 if i < expired_count else now + 300
+                }
+
+        def dict_lookup():
+            for code in codes:
+                store.get(code)
+
+        def dict_expire():
+            expired = [c for c, d in store.items() if d['expires_at'] < now]
+            for c in expired:
+                del store[c]
+            return len(expired)
+
+        _, t_insert = timed(dict_insert)
+        _, t_lookup = timed(dict_lookup)
+        removed, t_expire = timed(dict_expire)
+        print_row(size, "dict", fmt_ns(t_insert, size), fmt_ns(t_lookup, size),
+                  f"{t_expire * 1000:.1f} ms", removed)
+        del store
+
+        # MemoryVerificationStore: timing wheel, chỉ duyệt các mã hết hạn
+        vstore = MemoryVerificationStore(max_entries=size)
+
+        def store_insert():
+            for i, code in enumerate(codes):
+                vstore.put(code, 'user@example.com', 'User', ttl=60 if i < expired_count else 300)
+
+        def store_lookup():
+            for code in codes:
+                vstore.get(code)
+
+        # Các mã "hết hạn" sống 60s, dọn ở mốc +120s để insert không tự dọn trước
+        _, t_insert = timed(store_insert)
+        _, t_lookup = timed(store_lookup)
+        removed, t_expire = timed(lambda: vstore.expire(now=now + 120))
+        print_row(size, "wheel-store", fmt_ns(t_insert, size), fmt_ns(t_lookup, size),
+                  f"{t_expire * 1000:.1f} ms", removed)
+        del vstore
+
+# ============================================
+# WORKERS: throughput verify trên SQLite dùng chung
+# ============================================
+
+def _verify_worker(path, codes, result_queue):
+    """Một "worker": tra mã, kiểm tra hết hạn rồi lấy-và-xóa như verify_google_auth"""
+    store = SQLiteVerificationStore(path)
+    found = 0
+    start = time.perf_counter()
+    for code in codes:
+        entry = store.get(code)
+        if entry and not entry.is_expired() and store.pop(code):
+            found += 1
+    result_queue.put((found, time.perf_counter() - start))
+
+
+def bench_workers(worker_counts, code_count):
+    """Mã được tạo ở process chính, các worker khác lấy ra - giống callback/verify khác worker"""
+    print_row("workers", "codes", "found", "wall", "verify/s")
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'verification.db')
+            store = SQLiteVerificationStore(path, max_entries=code_count * 2)
+            codes = [f"{i:06d}" for i in range(code_count)]
+            for code in codes:
+                store.put(code, 'user@example.com', 'User')
+
+            result_queue = multiprocessing.Queue()
+            procs = [
+                multiprocessing.Process(target=_verify_worker, args=(path, codes[i::workers], result_queue))
+                for i in range(workers)
+            ]
+            start = time.perf_counter()
+            for proc in procs:
+                proc.start()
+            results = [result_queue.get() for _ in procs]
+            for proc in procs:
+                proc.join()
+            wall = time.perf_counter() - start
+            found = sum(r[0] for r in results)
+            print_row(workers, code_count, found, f"{wall:.2f} s", f"{found / wall:.0f}")
+
+# ============================================
+# BACKENDS: độ trễ put/get/pop của từng backend
+# ============================================
+
+def _make_redis_store(redis_url):
+    if redis_url:
+        return RedisVerificationStore(redis_url), redis_url
+    try:
+        import fakeredis
+    except ImportError:
+        return None, "bỏ qua (cần --redis-url hoặc pip install fakeredis)"
+    return RedisVerificationStore(client=fakeredis.FakeRedis()), "fakeredis (trong process)"
+
+
+def bench_backends(ops, redis_url=None):
+    """Độ trễ p50/p99 mỗi thao tác của memory, sqlite và redis"""
+    tmp = tempfile.TemporaryDirectory()
+    redis_store, redis_note = _make_redis_store(redis_url)
+    backends = [
+        ('memory', MemoryVerificationStore(max_entries=ops * 2)),
+        ('sqlite', SQLiteVerificationStore(os.path.join(tmp.name, 'verification.db'), max_entries=ops * 2)),
+        ('redis', redis_store),
+    ]
+    print(f"redis: {redis_note}")
+    print_row("backend", "put p50/p99", "get p50/p99", "pop p50/p99")
+    codes = [f"{i:06d}" for i in range(ops)]
+    for name, store in backends:
+        if store is None:
+            continue
+        latencies = {'put': [], 'get': [], 'pop': []}
+        for code in codes:
+            start = time.perf_counter()
+            store.put(code, 'user@example.com', 'User')
+            latencies['put'].append(time.perf_counter() - start)
+        for code in codes:
+            start = time.perf_counter()
+            store.get(code)
+            latencies['get'].append(time.perf_counter() - start)
+        for code in codes:
+            start = time.perf_counter()
+            store.pop(code)
+            latencies['pop'].append(time.perf_counter() - start)
+        print_row(name, fmt_latency(latencies['put']), fmt_latency(latencies['get']),
+                  fmt_latency(latencies['pop']))
+    tmp.cleanup()
+
+# ============================================
+# POOL: requests.* trực tiếp vs UpstreamClient (đếm TLS handshake)
+# ============================================
+
+def bench_pool(request_count):
+    """Gọi stand-in TLS theo thứ tự ping -> check-machine như verify_google_auth"""
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile, keyfile = generate_self_signed_cert(tmp)
+        server = StandInServer(
+            routes={
+                ('GET', '/ping'): lambda **_: (200, {'status': 'ok'}),
+                ('POST', '/api/check-machine'): lambda **_: (200, {'exists': False}),
+            },
+            certfile=certfile, keyfile=keyfile
+        ).start()
+        client = UpstreamClient(verify=certfile)
+
+        def direct():
+            for _ in range(request_count):
+                responses = (requests.get(f"{server.url}/ping", timeout=10, verify=certfile),
+                             requests.post(f"{server.url}/api/check-machine", json={'machine_id': 'm'},
+                                           timeout=10, verify=certfile))
+                assert all(response.status_code == 200 for response in responses)
+
+        def pooled():
+            for _ in range(request_count):
+                responses = (client.get(f"{server.url}/ping", timeout=10),
+                             client.post(f"{server.url}/api/check-machine", json={'machine_id': 'm'}, timeout=10))
+                assert all(response.status_code == 200 for response in responses)
+
+        print_row("client", "requests", "handshakes", "total", "per request")
+        for name, fn in (('requests.*', direct), ('UpstreamClient', pooled)):
+            server.reset_counters()
+            _, elapsed = timed(fn)
+            total = request_count * 2
+            print_row(name, total, server.handshakes, f"{elapsed:.2f} s", f"{elapsed / total * 1000:.2f} ms")
+            if fn is pooled:
+                assert server.handshakes == 1, f"UpstreamClient mở {server.handshakes} kết nối TLS"
+        print(f"UpstreamClient stats: {client.stats.snapshot()}")
+        server.stop()
+
+# ============================================
+# KEEPWARM: ping trước mỗi verify vs thread keep-warm (server admin có cold start)
+# ============================================
+
+def bench_keepwarm(verifies, gap, idle_timeout=2.0, cold_start_delay=1.5):
+    """Các lần verify cách nhau gap giây; server giả lập ngủ sau idle_timeout giây rảnh"""
+    admin = StandInServer(routes=admin_routes(), idle_timeout=idle_timeout,
+                          cold_start_delay=cold_start_delay).start()
+    client = UpstreamClient()
+
+    def run(name, verify_once, request_pings):
+        admin.reset_counters()
+        latencies = []
+        pings_before = request_pings()
+        for i in range(verifies):
+            if i:
+                time.sleep(gap)
+            start = time.perf_counter()
+            verify_once(i)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        pings = request_pings() - pings_before
+        print_row(name, verifies, f"{percentile(latencies, 50) * 1000:.0f} ms",
+                  f"{latencies[-1] * 1000:.0f} ms", sum(admin.calls.values()), admin.cold_starts, pings)
+        return pings
+
+    print_row("mode", "verifies", "p50", "max", "admin calls", "cold starts", "request pings")
+
+    # Code cũ: ping trước mỗi lần check-machine
+    def ping_each(i):
+        client.get(f"{admin.url}/ping", timeout=10)
+        client.post(f"{admin.url}/api/check-machine", json={'machine_id': f'm-{i}'}, timeout=30)
+
+    run('ping-each', ping_each, lambda: admin.calls['/ping'])
+
+    # Verify thật qua app Flask, thread keep-warm của server ping theo lịch trong nền
+    srv = import_server(ADMIN_SERVER_URL=admin.url, ADMIN_KEEP_WARM_INTERVAL=max(1, int(idle_timeout / 2)),
+                        ADMIN_WARM_WINDOW=int(idle_timeout), GOOGLE_ID_TOKEN_LOCAL=0, LOG_ENABLED=0)
+    flask_client = srv.app.test_client()
+    time.sleep(cold_start_delay + 0.2)  # Lần ping đầu tiên của thread keep-warm đánh thức server
+
+    def verify(i):
+        code = f"keepwarm-{i}"
+        srv.verification_store.put(code, f"{code}@example.com", code)
+        response = flask_client.post('/api/verify-google-auth', json={'auth_code': code, 'machine_id': f'm-{code}'})
+        assert response.status_code == 200, response.get_json()
+
+    # Ping trong request = ensure_warm phải đánh thức server (wakeups_total), không tính ping theo lịch
+    request_pings = run('keep-warm', verify, lambda: srv.admin_keep_warm.wakeups_total)
+    assert request_pings == 0, f"verify đã ping server admin {request_pings} lần"
+    srv.admin_keep_warm.stop()
+    admin.stop()
+
+# ============================================
+# ASGI: Flask sync worker vs bản ASGI (1 worker, server admin giả lập chậm)
+# ============================================
+
+def bench_asgi(logins, concurrency, admin_latency):
+    """Số lượt đăng nhập đồng thời mỗi worker: gunicorn sync vs uvicorn + async_server"""
+    admin = StandInServer(routes=admin_routes(), default_latency=admin_latency).start()
+    modes = [
+        ('flask-sync', lambda port: [sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f'127.0.0.1:{port}',
+                                     'server_google_oauth_example:app']),
+        ('asgi', lambda port: [sys.executable, '-m', 'uvicorn', 'async_server:app', '--host', '127.0.0.1',
+                               '--port', str(port), '--log-level', 'warning']),
+    ]
+    print(f"admin latency {admin_latency * 1000:.0f} ms/call, {logins} logins, concurrency {concurrency}")
+    print_row("mode", "ok", "wall", "logins/s", "p50", "p99")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, make_cmd in modes:
+            path = os.path.join(tmp, f'{name}.db')
+            store = SQLiteVerificationStore(path)
+            codes = [f"{i:06d}" for i in range(logins)]
+            for code in codes:
+                store.put(code, f'user{code}@example.com', 'User')
+            port = free_port()
+            env = server_env(ADMIN_SERVER_URL=admin.url, VERIFICATION_STORE_BACKEND='sqlite',
+                             VERIFICATION_STORE_PATH=path)
+            proc = start_server_process(make_cmd(port), port, env)
+            admin.reset_counters()
+            try:
+                wall, latencies, ok, statuses = drive_verifies(f"http://127.0.0.1:{port}", codes, concurrency)
+            finally:
+                proc.terminate()
+                proc.wait()
+            assert_logins(statuses, ok, admin)
+            print_row(name, ok, f"{wall:.2f} s", f"{logins / wall:.1f}",
+                      f"{percentile(latencies, 50) * 1000:.0f} ms", f"{percentile(latencies, 99) * 1000:.0f} ms")
+    admin.stop()
+
+# ============================================
+# IDTOKEN: callback gọi userinfo vs xác minh id_token tại chỗ
+# ============================================
+
+def bench_idtoken(callbacks, google_latency):
+    """Độ trễ google_callback với Google giả lập (token + userinfo + JWKS)"""
+    key = generate_rsa_key()
+    google = StandInServer(routes=google_routes('bench-client-id', key), default_latency=google_latency).start()
+    srv = import_server(GOOGLE_TOKEN_URL=f"{google.url}/token", GOOGLE_USERINFO_URL=f"{google.url}/userinfo",
+                        GOOGLE_JWKS_URL=f"{google.url}/certs", GOOGLE_ID_TOKEN_LOCAL='0')
+    srv.google_jwks.refresh()
+    client = srv.app.test_client()
+
+    print(f"Google latency {google_latency * 1000:.0f} ms/call, {callbacks} callbacks")
+    print_row("mode", "ok", "p50", "p99", "google calls")
+    for name, local in (('userinfo', False), ('local id_token', True)):
+        srv.GOOGLE_ID_TOKEN_LOCAL = local
+        google.reset_counters()
+        latencies, ok = [], 0
+        for i in range(callbacks):
+            # Như trình duyệt đã qua /api/google-auth: state kèm cookie nonce
+            nonce = f'bench-nonce-{i}'
+            state = srv.oauth_state_signer.create(nonce=nonce)
+            client.set_cookie(srv.OAUTH_STATE_COOKIE, nonce, path=srv.OAUTH_STATE_COOKIE_PATH)
+            start = time.perf_counter()
+            response = client.get('/api/google-callback', query_string={'code': f'user{i}', 'state': state})
+            latencies.append(time.perf_counter() - start)
+            ok += response.status_code == 200
+        latencies.sort()
+        print_row(name, ok, f"{percentile(latencies, 50) * 1000:.1f} ms",
+                  f"{percentile(latencies, 99) * 1000:.1f} ms", sum(google.calls.values()))
+    google.stop()
+
+# ============================================
+# PREFETCH: độ trễ verify có/không prefetch check-machine trong callback
+# ============================================
+
+def login_through_flask(client, machine_id, google_code, pass_machine_id):
+    """google-auth -> callback trên Flask test client, trả về mã xác minh 6 số"""
+    query = {'machine_id': machine_id} if pass_machine_id else {}
+    location = client.get('/api/google-auth', query_string=query).headers['Location']
+    state = parse_qs(urlparse(location).query)['state'][0]
+    html = client.get('/api/google-callback', query_string={'code': google_code, 'state': state}).get_data(as_text=True)
+    return re.search(r'<div class="code">(\d{6})</div>', html).group(1)
+
+
+def bench_prefetch(logins, admin_latency, think_time):
+    """User mất think_time giây để nhập mã; đo riêng độ trễ của verify"""
+    key = generate_rsa_key()
+    google = StandInServer(routes=google_routes('bench-client-id', key)).start()
+    admin = StandInServer(routes=admin_routes(), default_latency=admin_latency).start()
+    srv = import_server(GOOGLE_TOKEN_URL=f"{google.url}/token", GOOGLE_USERINFO_URL=f"{google.url}/userinfo",
+                        GOOGLE_JWKS_URL=f"{google.url}/certs", ADMIN_SERVER_URL=admin.url)
+    srv.google_jwks.refresh()
+    client = srv.app.test_client()
+
+    print(f"admin latency {admin_latency * 1000:.0f} ms/call, think time {think_time * 1000:.0f} ms, {logins} logins")
+    print_row("mode", "ok", "verify p50", "verify p99", "admin calls")
+    for name, prefetch in (('no prefetch', False), ('prefetch', True)):
+        admin.reset_counters()
+        latencies, ok = [], 0
+        for i in range(logins):
+            machine_id = f"{name}-machine-{i}"
+            code = login_through_flask(client, machine_id, f"{name}-user{i}", prefetch)
+            time.sleep(think_time)
+            start = time.perf_counter()
+            response = client.post('/api/verify-google-auth', json={'auth_code': code, 'machine_id': machine_id})
+            latencies.append(time.perf_counter() - start)
+            ok += bool(response.get_json().get('success'))
+        latencies.sort()
+        print_row(name, ok, f"{percentile(latencies, 50) * 1000:.1f} ms",
+                  f"{percentile(latencies, 99) * 1000:.1f} ms", sum(admin.calls.values()))
+    google.stop()
+    admin.stop()
+
+
+def bench_metrics(observations):
+    """Chi phí ghi nhận histogram (đường request) và render /metrics (lúc scrape)"""
+    registry = MetricsRegistry()
+    histogram = registry.histogram('bench_seconds', 'bench', ('stage', 'outcome'))
+    stages = ('google_token', 'google_userinfo', 'admin_check_machine', 'admin_login', 'admin_register', 'admin_ping')
+    outcomes = ('ok', 'http_4xx', 'http_5xx', 'error')
+    labels = [(stages[i % len(stages)], outcomes[i % len(outcomes)]) for i in range(1000)]
+    values = [(i % 997) / 1000 for i in range(1000)]
+
+    print_row("operation", "count", "total", "per op")
+    _, elapsed = timed(lambda: [histogram.observe(values[i % 1000], *labels[i % 1000]) for i in range(observations)])
+    print_row("observe", observations, f"{elapsed * 1000:.1f} ms", fmt_ns(elapsed, observations))
+
+    def timed_block(count):
+        for i in range(count):
+            with histogram.time(*labels[i % 1000]):
+                pass
+    _, elapsed = timed(lambda: timed_block(observations // 10))
+    print_row("time() span", observations // 10, f"{elapsed * 1000:.1f} ms", fmt_ns(elapsed, observations // 10))
+
+    text, elapsed = timed(registry.render)
+    print_row("render", f"{len(text.splitlines())} lines", f"{elapsed * 1000:.2f} ms", "")
+
+# ============================================
+# LOGGING: throughput verify khi log tắt / bật, consumer nhanh / chậm
+# ============================================
+
+class SlowStream:
+    """stdout có consumer chậm (pipe đầy, log shipper nghẽn): mỗi lần write tốn delay giây"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, text):
+        time.sleep(self.delay)
+        self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+def bench_logging(verifies, concurrency, consumer_delay):
+    """Verify qua Flask test client (admin stand-in không trễ), đổi logger của server giữa các lượt"""
+    admin = StandInServer(routes=admin_routes()).start()
+    srv = import_server(ADMIN_SERVER_URL=admin.url, GOOGLE_ID_TOKEN_LOCAL=0)
+    original_logger = srv.logger
+
+    modes = (
+        ('off', lambda: StructuredLogger(enabled=False)),
+        ('async, fast', lambda: StructuredLogger(stream=open(os.devnull, 'w'), level='debug')),
+        ('async, slow', lambda: StructuredLogger(stream=SlowStream(consumer_delay), level='debug', max_queue=1000)),
+        ('sync, slow', lambda: StructuredLogger(stream=SlowStream(consumer_delay), level='debug', asynchronous=False)),
+    )
+    print(f"{verifies} verifies, concurrency {concurrency}, slow consumer {consumer_delay * 1000:.1f} ms/write")
+    print_row("logging", "verifies/s", "p50", "p99", "written", "dropped")
+    for name, make_logger in modes:
+        srv.logger = make_logger()
+        codes = [f"{name.replace(', ', '-')}-{i}" for i in range(verifies)]
+        for code in codes:
+            srv.verification_store.put(code, f"{code}@example.com", code)
+
+        def one(code):
+            client = srv.app.test_client()
+            start = time.perf_counter()
+            response = client.post('/api/verify-google-auth', json={'auth_code': code, 'machine_id': f"m-{code}"})
+            return time.perf_counter() - start, response.get_json().get('success')
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, codes))
+        wall = time.perf_counter() - start
+        latencies = sorted(r[0] for r in results)
+        # Phần còn trong hàng đợi được ghi sau khi đo xong
+        srv.logger.flush(timeout=60)
+        stats = srv.logger.stats()
+        print_row(name, f"{verifies / wall:.0f}", f"{percentile(latencies, 50) * 1000:.2f} ms",
+                  f"{percentile(latencies, 99) * 1000:.2f} ms", stats['written'], stats['dropped'])
+    srv.logger = original_logger
+    admin.stop()
+
+# ============================================
+# BREAKER: verify khi server admin treo / trả 5xx, có và không có breaker + deadline
+# ============================================
+
+def bench_breaker(verifies, concurrency, hang, deadline):
+    """Đo thời gian worker bị giữ khi server admin sập"""
+    admin = StandInServer(routes=admin_routes()).start()
+    srv = import_server(ADMIN_SERVER_URL=admin.url, GOOGLE_ID_TOKEN_LOCAL=0)
+    srv.logger = StructuredLogger(enabled=False)
+    original_breakers, original_deadline = dict(srv.admin_breakers), srv.VERIFY_DEADLINE
+
+    configs = (
+        ('no breaker', 10 ** 9, 10 ** 9),  # như trước: ping 10s + mỗi lời gọi 30s
+        ('breaker+deadline', 5, deadline),
+    )
+    print(f"{verifies} verifies, concurrency {concurrency}, hang {hang}s, deadline {deadline}s")
+    print_row("outage", "mode", "wall", "p50", "p99", "statuses", "admin calls")
+    for outage in ('hang', '503'):
+        admin.default_latency = hang if outage == 'hang' else 0.0
+        admin.fail_status = 503 if outage == '503' else None
+        for name, threshold, budget in configs:
+            srv.admin_breakers.update({
+                key: CircuitBreaker(f'admin_{key}', failure_threshold=threshold, reset_timeout=60)
+                for key in srv.admin_breakers
+            })
+            srv.VERIFY_DEADLINE = budget
+            srv.admin_keep_warm.mark_cold()
+            admin.reset_counters()
+            codes = [f"{outage}-{name}-{i}" for i in range(verifies)]
+            for code in codes:
+                srv.verification_store.put(code, f"{code}@example.com", code)
+
+            def one(code):
+                client = srv.app.test_client()
+                start = time.perf_counter()
+                response = client.post('/api/verify-google-auth', json={'auth_code': code, 'machine_id': f"m-{code}"})
+                return time.perf_counter() - start, response.status_code
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                results = list(pool.map(one, codes))
+            wall = time.perf_counter() - start
+            latencies = sorted(r[0] for r in results)
+            counts = Counter(r[1] for r in results)
+            statuses = ','.join(f"{status}x{count}" for status, count in sorted(counts.items()))
+            print_row(outage, name, f"{wall:.1f} s", f"{percentile(latencies, 50):.2f} s",
+                      f"{percentile(latencies, 99):.2f} s", statuses, sum(admin.calls.values()))
+            # Server admin treo: /api/register có thể đã tới nơi khi verify hết deadline, chỉ kiểm tra status
+            assert set(counts) <= {200, 500, 503}, f"status ngoài 200/500/503: {dict(counts)}"
+            # Lỗi tạm thời không làm mất mã: user gửi lại được sau khi server admin hồi phục
+            lost = [code for code, (_, status) in zip(codes, results) if status >= 500 and code not in srv.verification_store]
+            assert not lost, f"{len(lost)} mã bị mất sau lỗi 5xx"
+            if threshold < 10 ** 9:
+                assert latencies[-1] <= budget + 1.0, f"verify bị giữ {latencies[-1]:.1f}s, deadline {budget}s"
+    srv.admin_breakers.update(original_breakers)
+    srv.VERIFY_DEADLINE = original_deadline
+    admin.stop()
+
+# ============================================
+# BULKHEAD: độ trễ /ping trong lúc verify làm bão hòa worker (gunicorn gthread)
+# ============================================
+
+def bench_bulkhead(duration, concurrency, threads, admin_latency):
+    """Bão verify (admin chậm) vào 1 worker gthread; đo /ping song song, có và không có giới hạn"""
+    admin = StandInServer(routes=admin_routes(), default_latency=admin_latency).start()
+    modes = (
+        ('no limits', {'VERIFY_MAX_CONCURRENT': 0, 'ADMIN_MAX_CONCURRENT': 0}),
+        # Chừa 4 thread: tối đa threads - 4 verify chạy + 2 chờ, /ping luôn có thread rảnh
+        ('bulkhead', {'VERIFY_MAX_CONCURRENT': threads - 4, 'ADMIN_MAX_CONCURRENT': threads - 4,
+                      'ENDPOINT_QUEUE_SIZE': 2}),
+    )
+    print(f"1 gunicorn worker x {threads} threads, admin latency {admin_latency * 1000:.0f} ms/call, "
+          f"{concurrency} verify clients for {duration:.0f}s")
+    print_row("mode", "verify 200", "verify 503", "ping p50", "ping p99", "ping max")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, limits in modes:
+            path = os.path.join(tmp, f"{name.replace(' ', '-')}.db")
+            store = SQLiteVerificationStore(path)
+            port = free_port()
+            env = server_env(ADMIN_SERVER_URL=admin.url, VERIFICATION_STORE_BACKEND='sqlite',
+                             VERIFICATION_STORE_PATH=path, GOOGLE_ID_TOKEN_LOCAL=0, LOG_ENABLED=0,
+                             RETRY_AFTER_SECONDS=1, **limits)
+            cmd = [sys.executable, '-m', 'gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(threads),
+                   '-b', f'127.0.0.1:{port}', 'server_google_oauth_example:app']
+            proc = start_server_process(cmd, port, env)
+            admin.reset_counters()
+            base_url = f"http://127.0.0.1:{port}"
+            stop_at = time.time() + duration
+            statuses = Counter()
+
+            def flood(worker):
+                session = requests.Session()
+                i = 0
+                while time.time() < stop_at:
+                    code = f"{worker:03d}{i:05d}"
+                    store.put(code, f"user{code}@example.com", 'User')
+                    try:
+                        response = session.post(f"{base_url}/api/verify-google-auth",
+                                                json={'auth_code': code, 'machine_id': f"m-{code}"}, timeout=60)
+                        statuses[response.status_code] += 1
+                        if response.status_code == 503:
+                            # Client làm theo Retry-After như app desktop
+                            time.sleep(int(response.headers.get('Retry-After', 1)))
+                    except requests.RequestException:
+                        statuses['error'] += 1
+                    i += 1
+
+            ping_latencies = []
+            try:
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    for worker in range(concurrency):
+                        pool.submit(flood, worker)
+                    time.sleep(1.0)  # để bão verify chiếm hết thread trước khi đo
+                    ping_session = requests.Session()
+                    while time.time() < stop_at:
+                        start = time.perf_counter()
+                        ping_session.get(f"{base_url}/ping", timeout=60)
+                        ping_latencies.append(time.perf_counter() - start)
+                        time.sleep(0.05)
+            finally:
+                proc.terminate()
+                proc.wait()
+            ping_latencies.sort()
+            print_row(name, statuses[200], statuses[503], f"{percentile(ping_latencies, 50) * 1000:.1f} ms",
+                      f"{percentile(ping_latencies, 99) * 1000:.1f} ms", f"{ping_latencies[-1] * 1000:.1f} ms")
+            assert_logins(statuses, statuses[200], admin)
+    admin.stop()
+
+# ============================================
+# RATE LIMIT: chi phí mỗi request của limiter
+# ============================================
+
+def bench_ratelimit(ops, redis_url=None):
+    """allow() theo số key khác nhau, và verify (mã sai) qua Flask khi bật/tắt limiter"""
+    print_row("limiter", "keys", "ops", "per op", "tracked keys")
+    for key_count in (1, 10000, 1000000):
+        # rate thấp + burst lớn: bucket không kịp đầy lại nên key được giữ tới khi vượt max_keys
+        # max_keys nhỏ hơn số key để đo cả chi phí bỏ bucket
+        limiter = TokenBucketLimiter(rate=1.0, burst=1e9, max_keys=100000)
+        keys = [f"10.0.{i // 256 % 256}.{i % 256}-{i}" for i in range(min(key_count, ops))]
+        _, elapsed = timed(lambda: [limiter.allow(keys[i % len(keys)]) for i in range(ops)])
+        print_row("memory", len(keys), ops, fmt_ns(elapsed, ops), len(limiter))
+
+    if redis_url:
+        client = __import__('redis').Redis.from_url(redis_url)
+        label = 'redis'
+    else:
+        import fakeredis
+        client = fakeredis.FakeRedis()
+        label = 'fakeredis'
+    limiter = RedisTokenBucketLimiter(rate=1.0, burst=1e9, prefix='bench:', client=client)
+    redis_ops = min(ops, 20000)
+    _, elapsed = timed(lambda: [limiter.allow(f"ip-{i % 1000}") for i in range(redis_ops)])
+    print_row(label, 1000, redis_ops, fmt_ns(elapsed, redis_ops), '')
+
+    srv = import_server(LOG_ENABLED=0, GOOGLE_ID_TOKEN_LOCAL=0)
+    client = srv.app.test_client()
+    verifies = min(ops, 5000)
+    print_row("verify (bad code)", "limiter", "verifies", "per request", "")
+    for name, enabled in (('off', False), ('memory', True)):
+        original = srv.verify_rate_limited
+        if not enabled:
+            srv.verify_rate_limited = lambda ip, data: None
+        _, elapsed = timed(lambda: [client.post('/api/verify-google-auth',
+                                                json={'auth_code': '000000', 'machine_id': f"m{i}"})
+                                    for i in range(verifies)])
+        srv.verify_rate_limited = original
+        print_row("", name, verifies, f"{elapsed / verifies * 1e6:.1f} us", "")
+
+# ============================================
+# SINGLE-FLIGHT: verify gửi trùng (cùng auth_code) đồng thời và đến muộn
+# ============================================
+
+class _NoCoalescing:
+    """Thay cho verify_flights để đo hành vi cũ: mỗi lần gửi chạy riêng"""
+
+    def do(self, key, fn):
+        return fn()
+
+
+def bench_singleflight(codes, duplicates, admin_latency):
+    """Mỗi mã gửi `duplicates` lần cùng lúc + 1 lần đến muộn; đếm lời gọi server admin"""
+    admin = StandInServer(routes=admin_routes(), default_latency=admin_latency).start()
+    srv = import_server(ADMIN_SERVER_URL=admin.url, GOOGLE_ID_TOKEN_LOCAL=0, LOG_ENABLED=0,
+                        VERIFY_MAX_CONCURRENT=0, ADMIN_MAX_CONCURRENT=0)
+    srv.admin_keep_warm.mark_warm()
+    original = srv.verify_flights
+
+    print(f"{codes} codes x {duplicates} concurrent submissions + 1 late, admin latency {admin_latency * 1000:.0f} ms")
+    print_row("mode", "success", "failed", "check-machine", "register", "late ok")
+    for name, flights in (('no coalescing', _NoCoalescing()), ('single-flight', SingleFlight())):
+        srv.verify_flights = flights
+        admin.reset_counters()
+        batch = [f"{name[:2]}{i:04d}" for i in range(codes)]
+        for code in batch:
+            srv.verification_store.put(code, f"{name[:2]}{code}@example.com", 'User')
+
+        def submit(code):
+            response = srv.app.test_client().post('/api/verify-google-auth',
+                                                  json={'auth_code': code, 'machine_id': f"m-{code}"})
+            return bool(response.get_json().get('success'))
+
+        with ThreadPoolExecutor(max_workers=codes * duplicates) as pool:
+            results = list(pool.map(submit, [code for code in batch for _ in range(duplicates)]))
+        late = [submit(code) for code in batch]
+        print_row(name, sum(results), len(results) - sum(results), admin.calls['/api/check-machine'],
+                  admin.calls['/api/register'], f"{sum(late)}/{len(late)}")
+        # Mỗi mã một lần đăng ký; lần gửi đến muộn không nhận lại token (mã đã dùng)
+        assert admin.calls['/api/register'] == codes, f"{admin.calls['/api/register']} lần /api/register cho {codes} mã"
+        assert not any(late), "lần gửi đến muộn vẫn đăng nhập được"
+        if isinstance(flights, SingleFlight):
+            assert all(results), "lần gửi trùng đồng thời không nhận được kết quả chung"
+    srv.verify_flights = original
+    admin.stop()
+
+# ============================================
+# LONGPOLL: app desktop chờ đăng nhập bằng long-poll vs hỏi lại định kỳ
+# ============================================
+
+def process_cpu_seconds(pid):
+    """utime + stime của process (Linux /proc)"""
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def process_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+class _RawHTTPConnection:
+    """
+    Kết nối HTTP/1.1 keep-alive tối giản trên asyncio cho lệnh longpoll: httpx chậm đi rõ rệt
+    khi giữ hàng nghìn kết nối cùng lúc, làm sai số đo độ trễ đánh thức
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self._reader = self._writer = None
+
+    async def get(self, path, params):
+        """Trả về (status, body); lỗi kết nối -> ConnectionError, lần gọi sau tự mở kết nối mới"""
+        try:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_connection('127.0.0.1', self.port)
+            self._writer.write(f"GET {path}?{urlencode(params)} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode('ascii'))
+            await self._writer.drain()
+            lines = (await self._reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+            length = next((int(line.split(':', 1)[1]) for line in lines if line.lower().startswith('content-length:')), 0)
+            return int(lines[0].split()[1]), await self._reader.readexactly(length)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as error:
+            self.close()
+            raise ConnectionError(str(error)) from error
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+
+async def _run_on_connections(port, connections, jobs):
+    """Chạy các job (async fn nhận kết nối) lần lượt trên `connections` kết nối keep-alive"""
+    jobs = iter(jobs)
+
+    async def worker():
+        connection = _RawHTTPConnection(port)
+        for job in jobs:
+            await job(connection)
+        connection.close()
+
+    await asyncio.gather(*(worker() for _ in range(connections)))
+
+
+async def _drive_device_logins(port, pid, waiters, idle, interval):
+    """
+    N app cùng chờ đăng nhập (interval=None: long-poll, ngược lại: hỏi lại mỗi interval giây),
+    sau `idle` giây mới hoàn tất callback. Trả về (số poll, số lỗi kết nối, số thành công, độ trễ
+    đánh thức, CPU giây của server trong nửa sau khoảng idle, RSS tăng thêm MB)
+    """
+    rss_before = process_rss_mb(pid)
+    logins = {}
+
+    def start_login(i):
+        async def job(connection):
+            _, body = await connection.get('/api/google-auth', {'device': '1', 'machine_id': f'm{i}'})
+            data = json.loads(body)
+            logins[i] = data['handle'], parse_qs(urlparse(data['auth_url']).query)['state'][0]
+        return job
+
+    await _run_on_connections(port, 50, [start_login(i) for i in range(waiters)])
+
+    polls = Counter()
+    finished = {}
+    completed = {}
+
+    async def wait_login(i, handle):
+        connection = _RawHTTPConnection(port)
+        params = {'handle': handle, 'machine_id': f'm{i}', 'timeout': '60' if interval is None else '0'}
+        while True:
+            polls['sent'] += 1
+            try:
+                status, body = await connection.get('/api/google-auth/poll', params)
+            except ConnectionError:
+                # Như app thật: mất kết nối thì chờ chút rồi poll lại
+                polls['errors'] += 1
+                await asyncio.sleep(0.5)
+                continue
+            if status != 202:
+                finished[i] = (time.perf_counter(), bool(json.loads(body).get('success')))
+                connection.close()
+                return
+            if interval is not None:
+                await asyncio.sleep(interval)
+
+    pollers = []
+    for i in range(waiters):
+        pollers.append(asyncio.ensure_future(wait_login(i, logins[i][0])))
+        if i % 100 == 99:
+            await asyncio.sleep(0.05)  # Mở kết nối từng đợt, không dồn hết vào backlog của socket
+    # Nửa đầu khoảng idle để mọi app kịp bắt đầu chờ, đo ở nửa sau
+    await asyncio.sleep(idle / 2)
+    cpu_start = process_cpu_seconds(pid)
+    rss_waiting = process_rss_mb(pid)
+    await asyncio.sleep(idle / 2)
+    idle_cpu = process_cpu_seconds(pid) - cpu_start
+
+    def complete(i):
+        async def job(connection):
+            for _ in range(3):
+                try:
+                    await connection.get('/api/google-callback', {'code': f'device-user{i}', 'state': logins[i][1]})
+                    break
+                except ConnectionError:
+                    polls['errors'] += 1
+            completed[i] = time.perf_counter()
+        return job
+
+    await _run_on_connections(port, 16, [complete(i) for i in range(waiters)])
+    _, stuck = await asyncio.wait(pollers, timeout=60)
+    for poller in stuck:
+        poller.cancel()
+    wake = sorted(max(0.0, finished[i][0] - completed[i]) for i in finished)
+    ok = sum(success for _, success in finished.values())
+    return polls['sent'], polls['errors'], ok, wake, idle_cpu, rss_waiting - rss_before
+
+
+def bench_longpoll(waiters, idle, interval):
+    """uvicorn + async_server: CPU/RSS khi N app đang chờ và độ trễ từ callback tới lúc app nhận kết quả"""
+    # Callback lấy user qua userinfo: stand-in không cần ký id_token, CPU dành cho server
+    google = StandInServer(routes=google_routes('bench-client-id', generate_rsa_key(), id_token=False)).start()
+    admin = StandInServer(routes=admin_routes()).start()
+    print(f"{waiters} waiting apps, callbacks after {idle:.0f} s idle")
+    print_row("mode", "success", "poll reqs", "conn errors", "idle CPU", "RSS delta", "wake p50", "wake p99")
+    for name, poll_interval in (('long-poll', None), (f'poll every {interval:g}s', interval)):
+        port = free_port()
+        env = server_env(GOOGLE_TOKEN_URL=f"{google.url}/token", GOOGLE_USERINFO_URL=f"{google.url}/userinfo",
+                         GOOGLE_ID_TOKEN_LOCAL=0, ADMIN_SERVER_URL=admin.url, LOG_ENABLED=0,
+                         DEVICE_POLL_TIMEOUT=60)
+        # CPU bận xử lý callback thì app có thể gửi poll kế tiếp sau hơn 5s (keep-alive mặc định
+        # của uvicorn) trên kết nối đã bị đóng: nới keep-alive để không đo nhầm lỗi kết nối
+        proc = start_server_process([sys.executable, '-m', 'uvicorn', 'async_server:app', '--host', '127.0.0.1',
+                                     '--port', str(port), '--log-level', 'warning', '--backlog', str(waiters + 64),
+                                     '--timeout-keep-alive', '120'],
+                                    port, env)
+        admin.reset_counters()
+        try:
+            polls, errors, ok, wake, idle_cpu, rss_delta = asyncio.run(
+                _drive_device_logins(port, proc.pid, waiters, idle, poll_interval)
+            )
+        finally:
+            proc.terminate()
+            proc.wait()
+        assert ok == waiters, f"chỉ {ok}/{waiters} app đăng nhập được"
+        assert admin.calls['/api/register'] + admin.calls['/api/login'] == waiters, \
+            f"{dict(admin.calls)} cho {waiters} lần đăng nhập"
+        print_row(name, f"{ok}/{waiters}", polls, errors, f"{idle_cpu / (idle / 2) * 100:.1f} %", f"{rss_delta:.1f} MB",
+                  f"{percentile(wake, 50) * 1000:.0f} ms", f"{percentile(wake, 99) * 1000:.0f} ms")
+    google.stop()
+    admin.stop()
+
+# ============================================
+# REFRESH: user quay lại - luồng đầy đủ qua trình duyệt vs refresh token đã lưu
+# ============================================
+
+def bench_refresh(logins, google_latency, admin_latency):
+    """Thời gian phía server của một lần đăng nhập lại; máy đã đăng ký với đúng email"""
+    google = StandInServer(routes=google_routes('bench-client-id', generate_rsa_key(), id_token=False),
+                           default_latency=google_latency).start()
+    admin = StandInServer(routes=admin_routes(), default_latency=admin_latency).start()
+    srv = import_server(GOOGLE_TOKEN_URL=f"{google.url}/token", GOOGLE_USERINFO_URL=f"{google.url}/userinfo",
+                        GOOGLE_ID_TOKEN_LOCAL=0, ADMIN_SERVER_URL=admin.url, LOG_ENABLED=0)
+    srv.admin_keep_warm.mark_warm()
+    client = srv.app.test_client()
+
+    def full_login(machine_id, google_code, remember):
+        """google-auth -> callback -> verify, trả về (số giây từng bước, payload của verify)"""
+        query = {'machine_id': machine_id, 'remember': '1' if remember else '0'}
+        start = time.perf_counter()
+        location = client.get('/api/google-auth', query_string=query).headers['Location']
+        auth_done = time.perf_counter()
+        state = parse_qs(urlparse(location).query)['state'][0]
+        html = client.get('/api/google-callback', query_string={'code': google_code, 'state': state})
+        callback_done = time.perf_counter()
+        code = re.search(r'<div class="code">(\d{6})</div>', html.get_data(as_text=True)).group(1)
+        payload = client.post('/api/verify-google-auth', json={'auth_code': code, 'machine_id': machine_id}).get_json()
+        return (auth_done - start, callback_done - auth_done, time.perf_counter() - callback_done), payload
+
+    # Lần đăng nhập đầu: đăng ký máy và chọn "ghi nhớ đăng nhập"
+    users = []
+    for i in range(logins):
+        machine_id, google_code = f"machine-{i}", f"user{i}"
+        _, payload = full_login(machine_id, google_code, remember=True)
+        assert payload.get('success') and payload.get('remember_token'), payload
+        users.append((machine_id, google_code, payload['user_data']['email'], payload['remember_token']))
+
+    print(f"{logins} returning users, Google latency {google_latency * 1000:.0f} ms/call, "
+          f"admin latency {admin_latency * 1000:.0f} ms/call")
+    print("(không tính thời gian tải trang Google, chọn tài khoản/đồng ý và gõ mã - chỉ luồng đầy đủ mới có)")
+    print_row("mode", "ok", "p50", "p95", "p99", "app requests", "browser hops", "upstream calls")
+
+    google.reset_counters()
+    admin.reset_counters()
+    stages, totals, ok = ([], [], []), [], 0
+    for machine_id, google_code, _, _ in users:
+        durations, payload = full_login(machine_id, google_code, remember=False)
+        for samples, duration in zip(stages, durations):
+            samples.append(duration)
+        totals.append(sum(durations))
+        ok += bool(payload.get('success'))
+    totals.sort()
+    upstream_calls = sum(google.calls.values()) + sum(admin.calls.values())
+    print_row("full flow", ok, *(f"{percentile(totals, pct) * 1000:.1f} ms" for pct in (50, 95, 99)),
+              3, 2, f"{upstream_calls / logins:.1f}/login")
+    # Máy đã đăng ký: đăng nhập lại không được đăng ký thêm
+    assert ok == logins and admin.calls['/api/register'] == 0, (ok, dict(admin.calls))
+    for name, samples in zip(('  google-auth', '  callback', '  verify'), stages):
+        samples.sort()
+        print_row(name, "", *(f"{percentile(samples, pct) * 1000:.1f} ms" for pct in (50, 95, 99)), "", "", "")
+
+    google.reset_counters()
+    admin.reset_counters()
+    totals, ok = [], 0
+    for machine_id, _, email, remember_token in users:
+        start = time.perf_counter()
+        response = client.post('/api/google-auth/refresh', json={
+            'email': email, 'machine_id': machine_id, 'remember_token': remember_token
+        })
+        totals.append(time.perf_counter() - start)
+        ok += bool(response.get_json().get('success'))
+    totals.sort()
+    upstream_calls = sum(google.calls.values()) + sum(admin.calls.values())
+    print_row("refresh token", ok, *(f"{percentile(totals, pct) * 1000:.1f} ms" for pct in (50, 95, 99)),
+              1, 0, f"{upstream_calls / logins:.1f}/login")
+    assert ok == logins and admin.calls['/api/register'] == 0, (ok, dict(admin.calls))
+    google.stop()
+    admin.stop()
+
+# ============================================
+# WORKERCLASS: gunicorn.conf.py với sync / gthread / gevent
+# ============================================
+
+def bench_workerclass(logins, concurrency, workers, admin_latency):
+    """Throughput verify với server admin chậm, rồi SIGTERM khi còn `concurrency` verify đang chạy"""
+    admin = StandInServer(routes=admin_routes(), default_latency=admin_latency).start()
+    classes = ['sync', 'gthread']
+    if importlib.util.find_spec('gevent') is not None:
+        classes.append('gevent')
+    else:
+        print("(bỏ qua gevent: chưa cài đặt - pip install gevent)")
+    print(f"{workers} worker(s), admin latency {admin_latency * 1000:.0f} ms/call, {logins} logins, "
+          f"concurrency {concurrency}")
+    print_row("worker class", "ok", "logins/s", "p50", "p99", "SIGTERM ok", "shutdown")
+    with tempfile.TemporaryDirectory() as tmp:
+        for worker_class in classes:
+            path = os.path.join(tmp, f'{worker_class}.db')
+            store = SQLiteVerificationStore(path)
+            codes = [f"{i:06d}" for i in range(logins + concurrency)]
+            for code in codes:
+                store.put(code, f'user{code}@example.com', 'User')
+            port = free_port()
+            env = server_env(PORT=port, ADMIN_SERVER_URL=admin.url, VERIFICATION_STORE_BACKEND='sqlite',
+                             VERIFICATION_STORE_PATH=path, GOOGLE_ID_TOKEN_LOCAL=0, LOG_ENABLED=0,
+                             GUNICORN_WORKER_CLASS=worker_class, WEB_CONCURRENCY=workers,
+                             VERIFY_MAX_CONCURRENT=0, ADMIN_MAX_CONCURRENT=0)
+            proc = start_server_process([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                                         'server_google_oauth_example:app'], port, env)
+            base_url = f"http://127.0.0.1:{port}"
+            admin.reset_counters()
+            try:
+                wall, latencies, ok, statuses = drive_verifies(base_url, codes[:logins], concurrency)
+                assert_logins(statuses, ok, admin)
+
+                # Tắt êm: request đã được nhận phải được trả lời trước khi worker thoát
+                def in_flight(code):
+                    try:
+                        response = requests.post(f"{base_url}/api/verify-google-auth",
+                                                 json={'auth_code': code, 'machine_id': f"machine-{code}"},
+                                                 timeout=60)
+                        return response.status_code == 200
+                    except requests.RequestException:
+                        return False
+
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    futures = [pool.submit(in_flight, code) for code in codes[logins:]]
+                    time.sleep(admin_latency)
+                    stop_start = time.perf_counter()
+                    proc.terminate()
+                    graceful_ok = sum(future.result() for future in futures)
+                    proc.wait()
+                    shutdown = time.perf_counter() - stop_start
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            print_row(worker_class, ok, f"{logins / wall:.1f}", f"{percentile(latencies, 50) * 1000:.0f} ms",
+                      f"{percentile(latencies, 99) * 1000:.0f} ms", f"{graceful_ok}/{concurrency}",
+                      f"{shutdown:.2f} s")
+    admin.stop()
+
+# ============================================
+# E2E: google-auth -> trang Google -> callback -> verify qua server thật, upstream giả lập
+# ============================================
+
+E2E_STAGES = ('google_auth', 'google_login', 'callback', 'verify')
+
+
+def _e2e_server_cmd(server, port):
+    if server == 'asgi':
+        return [sys.executable, '-m', 'uvicorn', 'async_server:app', '--host', '127.0.0.1', '--port', str(port),
+                '--log-level', 'warning', '--backlog', '2048']
+    return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'server_google_oauth_example:app']
+
+
+def _e2e_login(session, base_url, machine_id, think_time):
+    """Một lượt đăng nhập như trình duyệt + app desktop: ({bước: giây}, (bước, status) nếu lỗi)"""
+    durations = {}
+
+    def step(stage, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, allow_redirects=False, timeout=60, **kwargs)
+        except requests.RequestException:
+            return None
+        durations[stage] = time.perf_counter() - start
+        return response
+
+    response = step('google_auth', 'GET', f"{base_url}/api/google-auth", params={'machine_id': machine_id})
+    if response is None or response.status_code != 302:
+        return durations, ('google_auth', response.status_code if response is not None else 'error')
+    # Trình duyệt mở trang đăng nhập Google (stand-in chuyển hướng ngay về callback)
+    response = step('google_login', 'GET', response.headers['Location'])
+    if response is None or response.status_code != 302:
+        return durations, ('google_login', response.status_code if response is not None else 'error')
+    response = step('callback', 'GET', response.headers['Location'])
+    match = re.search(r'<div class="code">(\d{6})</div>', response.text) if response is not None else None
+    if match is None:
+        return durations, ('callback', response.status_code if response is not None else 'error')
+    if think_time:
+        time.sleep(think_time)
+    response = step('verify', 'POST', f"{base_url}/api/verify-google-auth",
+                    json={'auth_code': match.group(1), 'machine_id': machine_id})
+    if response is None or response.status_code != 200:
+        return durations, ('verify', response.status_code if response is not None else 'error')
+    return durations, None
+
+
+def _e2e_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_e2e(logins, concurrency, server, workers, google_latency, admin_latency, jitter,
+              google_error_rate, admin_error_rate, think_time, id_token, env_overrides, json_path, compare_path):
+    """Throughput và p50/p95/p99 từng bước của luồng đăng nhập đầy đủ; lưu/so sánh kết quả giữa các commit"""
+    key = generate_rsa_key() if id_token else None
+    google = StandInServer(routes=google_routes('bench-client-id', key, id_token=id_token),
+                           default_latency=google_latency, jitter=jitter, error_rate=google_error_rate).start()
+    # Trang đăng nhập (trình duyệt) không tính là lời gọi upstream của server: không trễ, không lỗi
+    google.latency['/auth'] = 0.0
+    google.error_rates['/auth'] = 0.0
+    admin = StandInServer(routes=admin_routes(), default_latency=admin_latency, jitter=jitter,
+                          error_rate=admin_error_rate).start()
+    port = free_port()
+    tmp = tempfile.TemporaryDirectory()
+    overrides = {
+        'PORT': port,
+        'GOOGLE_AUTH_URL': f"{google.url}/auth",
+        'GOOGLE_TOKEN_URL': f"{google.url}/token",
+        'GOOGLE_USERINFO_URL': f"{google.url}/userinfo",
+        'GOOGLE_JWKS_URL': f"{google.url}/certs",
+        'GOOGLE_REDIRECT_URI': f"http://127.0.0.1:{port}/api/google-callback",
+        'GOOGLE_ID_TOKEN_LOCAL': int(id_token),
+        'ADMIN_SERVER_URL': admin.url,
+        'LOG_ENABLED': 0,
+        'GUNICORN_WORKER_CLASS': server if server != 'asgi' else 'gthread',
+        'WEB_CONCURRENCY': workers,
+    }
+    if server != 'asgi' and workers > 1:
+        # Callback và verify có thể rơi vào hai worker khác nhau
+        overrides.update(VERIFICATION_STORE_BACKEND='sqlite', VERIFICATION_STORE_PATH=os.path.join(tmp.name, 'codes.db'))
+    overrides.update(env_overrides)
+    proc = start_server_process(_e2e_server_cmd(server, port), port, server_env(**overrides))
+    base_url = f"http://127.0.0.1:{port}"
+
+    sessions = {}
+
+    def one(i):
+        session = sessions.setdefault(threading.get_ident(), requests.Session())
+        return _e2e_login(session, base_url, f"e2e-machine-{i}", think_time)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            # Làm nóng: kết nối keep-alive, JWKS, thread pool của worker
+            list(pool.map(one, range(-concurrency, 0)))
+            google.reset_counters()
+            admin.reset_counters()
+            start = time.perf_counter()
+            results = list(pool.map(one, range(logins)))
+            wall = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+        tmp.cleanup()
+
+    failures = Counter(failure for _, failure in results if failure is not None)
+    ok = sum(1 for _, failure in results if failure is None)
+    samples = {stage: sorted(d[stage] for d, _ in results if stage in d) for stage in E2E_STAGES}
+    samples['total'] = sorted(sum(d.values()) for d, failure in results if failure is None)
+    report = {
+        'commit': _e2e_git_commit(),
+        'config': {'logins': logins, 'concurrency': concurrency, 'server': server, 'workers': workers,
+                   'google_latency': google_latency, 'admin_latency': admin_latency, 'jitter': jitter,
+                   'google_error_rate': google_error_rate, 'admin_error_rate': admin_error_rate,
+                   'think_time': think_time, 'id_token': id_token, 'env': env_overrides},
+        'ok': ok,
+        'logins_per_second': ok / wall,
+        'failures': {f"{stage} {status}": count for (stage, status), count in sorted(failures.items(), key=str)},
+        'upstream_calls_per_login': {
+            'google': (sum(google.calls.values()) - google.calls['/auth']) / max(logins, 1),
+            'admin': sum(admin.calls.values()) / max(logins, 1),
+        },
+        'stages': {
+            stage: {f"p{pct}": percentile(values, pct) for pct in (50, 95, 99)}
+            for stage, values in samples.items()
+        },
+    }
+    google.stop()
+    admin.stop()
+
+    print(f"{server} x {workers} worker(s), {logins} logins, concurrency {concurrency}, "
+          f"Google {google_latency * 1000:.0f} ms, admin {admin_latency * 1000:.0f} ms (±{jitter * 100:.0f}%), "
+          f"error rate Google {google_error_rate:.1%} / admin {admin_error_rate:.1%}")
+    print(f"ok {ok}/{logins}, {report['logins_per_second']:.1f} logins/s, upstream calls/login: "
+          f"Google {report['upstream_calls_per_login']['google']:.2f}, admin {report['upstream_calls_per_login']['admin']:.2f}")
+    for failure, count in report['failures'].items():
+        print(f"  failed at {failure}: {count}")
+    print_row("stage", "p50", "p95", "p99")
+    for stage, values in report['stages'].items():
+        print_row(stage, *(f"{values[f'p{pct}'] * 1000:.1f} ms" for pct in (50, 95, 99)))
+
+    if compare_path:
+        with open(compare_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\nso với {compare_path} (commit {baseline.get('commit')}): "
+              f"logins/s {baseline['logins_per_second']:.1f} -> {report['logins_per_second']:.1f}")
+        print_row("stage", "p50 Δ", "p95 Δ", "p99 Δ")
+        for stage, values in report['stages'].items():
+            base = baseline['stages'].get(stage)
+            if base:
+                print_row(stage, *(f"{(values[f'p{pct}'] / base[f'p{pct}'] - 1) * 100:+.1f} %"
+                                   if base[f'p{pct}'] else "n/a" for pct in (50, 95, 99)))
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+# ============================================
+# WRITE-BEHIND: verify của user mới - đăng ký đồng bộ vs ghi journal rồi gửi sau
+# ============================================
+
+def _crashing_journal_writer(directory, entries):
+    """Process con ghi journal rồi chết trước khi gửi được yêu cầu nào"""
+    journal = RegistrationJournal(directory)
+    journal.open()
+    for i in range(entries):
+        journal.append({'email': f"crash{i}@example.com", 'machine_id': f"crash-{i}", 'name': 'User'})
+    os._exit(0)
+
+
+def bench_writebehind(verifies, concurrency, admin_latency, appends, thread_counts):
+    """Độ trễ verify (máy chưa đăng ký), throughput của journal và thời gian replay sau crash"""
+    journal_dir = tempfile.mkdtemp(prefix='bench_register_journal_')
+    admin = StandInServer(routes=admin_routes(), default_latency=admin_latency).start()
+    srv = import_server(ADMIN_SERVER_URL=admin.url, GOOGLE_ID_TOKEN_LOCAL=0, LOG_ENABLED=0,
+                        REGISTER_WRITE_BEHIND=1, REGISTER_JOURNAL_DIR=journal_dir,
+                        VERIFY_MAX_CONCURRENT=0, ADMIN_MAX_CONCURRENT=0)
+    srv.admin_keep_warm.mark_warm()
+
+    print(f"{verifies} verifies of new machines, concurrency {concurrency}, "
+          f"admin latency {admin_latency * 1000:.0f} ms/call")
+    print_row("mode", "ok", "p50", "p95", "p99", "register calls", "drained after")
+    for name, write_behind in (('sync register', False), ('write-behind', True)):
+        srv.REGISTER_WRITE_BEHIND = write_behind
+        admin.reset_counters()
+        codes = [f"{name[:2]}{i:05d}" for i in range(verifies)]
+        for code in codes:
+            srv.verification_store.put(code, f"{code}@example.com", 'User')
+
+        def submit(code):
+            start = time.perf_counter()
+            response = srv.app.test_client().post('/api/verify-google-auth',
+                                                  json={'auth_code': code, 'machine_id': f"m-{code}"})
+            return time.perf_counter() - start, bool(response.get_json().get('success'))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(submit, codes))
+        register_calls = admin.calls['/api/register']
+        # Đợi thread nền gửi hết (admin nhận đủ yêu cầu đăng ký)
+        while len(srv.registration_journal):
+            time.sleep(0.01)
+        drained = time.perf_counter() - start
+        latencies = sorted(r[0] for r in results)
+        print_row(name, sum(r[1] for r in results),
+                  *(f"{percentile(latencies, pct) * 1000:.1f} ms" for pct in (50, 95, 99)),
+                  f"{register_calls} -> {admin.calls['/api/register']}", f"{drained:.2f} s")
+    srv.registration_flusher.stop()
+    admin.stop()
+
+    print(f"\njournal append: {appends} registrations (group commit - các thread chờ chung một fsync)")
+    print_row("fsync", "threads", "appends/s", "p50", "p99", "writes")
+    for fsync in (True, False):
+        for threads in thread_counts:
+            journal = RegistrationJournal(tempfile.mkdtemp(prefix='bench_register_journal_'), fsync=fsync)
+            journal.open()
+
+            def append(i):
+                start = time.perf_counter()
+                journal.append({'email': f"user{i}@example.com", 'machine_id': f"machine-{i}", 'name': 'User'})
+                return time.perf_counter() - start
+
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                latencies, elapsed = timed(lambda: sorted(pool.map(append, range(appends))))
+            print_row("on" if fsync else "off", threads, f"{appends / elapsed:.0f}",
+                      f"{percentile(latencies, 50) * 1e6:.0f} us", f"{percentile(latencies, 99) * 1e6:.0f} us",
+                      journal.syncs_total)
+
+    crash_dir = tempfile.mkdtemp(prefix='bench_register_journal_')
+    child = multiprocessing.Process(target=_crashing_journal_writer, args=(crash_dir, appends))
+    child.start()
+    child.join()
+    survivor = RegistrationJournal(crash_dir)
+    claimed, elapsed = timed(survivor.open)
+    print(f"\nreplay sau crash: process con ghi {appends} yêu cầu rồi chết, "
+          f"process khác nhận lại {claimed} trong {elapsed * 1000:.1f} ms")
+
+# ============================================
+# ALLOCATOR: mã xác minh khi có rất nhiều mã đang sống
+# ============================================
+
+def _random_code():
+    """Cách tạo mã trước đây (không kiểm tra trùng)"""
+    return ''.join([str(secrets.randbelow(10)) for _ in range(6)])
+
+
+def _allocator_worker(path, count, result_queue):
+    """Một worker gunicorn: allocator riêng, store SQLite dùng chung"""
+    store = SQLiteVerificationStore(path, max_entries=10 ** 7)
+    allocator = CodeAllocator(store, 300, grow_at=1.0)
+    codes = [allocator.allocate(f"user{i}@example.com", 'User') for i in range(count)]
+    result_queue.put((codes, allocator.collisions_total))
+
+
+def bench_allocator(live_counts, threads, workers):
+    """Lấp đầy không gian 6 chữ số tới N mã đang sống: mã bị ghi đè, chi phí cấp mã, nhiều thread/worker"""
+    print("random 6 digits + put (trước đây) vs CodeAllocator (bitmap + store.add), memory store")
+    print_row("live codes", "mode", "overwritten", "store size", "last 10k", "p99")
+    for live in live_counts:
+        store = MemoryVerificationStore(max_entries=10 ** 7)
+        overwritten = 0
+        for i in range(live):
+            code = _random_code()
+            overwritten += code in store
+            store.put(code, f"user{i}@example.com", 'User')
+        print_row(live, "random+put", overwritten, len(store), "", "")
+
+        store = MemoryVerificationStore(max_entries=10 ** 7)
+        allocator = CodeAllocator(store, 300, grow_at=1.0)
+        latencies = []
+        for i in range(live):
+            start = time.perf_counter()
+            allocator.allocate(f"user{i}@example.com", 'User')
+            latencies.append(time.perf_counter() - start)
+        tail = sorted(latencies[-10000:])
+        print_row(live, "allocator", live - len(store), len(store),
+                  f"{sum(tail) / len(tail) * 1e6:.1f} us/op", f"{percentile(tail, 99) * 1e6:.0f} us")
+
+    live = live_counts[-1]
+    print(f"\n{threads} thread cấp {live} mã cùng lúc (một allocator)")
+    store = MemoryVerificationStore(max_entries=10 ** 7)
+    allocator = CodeAllocator(store, 300, grow_at=1.0)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        codes, elapsed = timed(lambda: list(pool.map(
+            lambda i: allocator.allocate(f"user{i}@example.com", 'User'), range(live))))
+    print_row("codes", "unique", "store size", "allocs/s")
+    print_row(len(codes), len(set(codes)), len(store), f"{live / elapsed:.0f}")
+
+    print("\ngrow_at mặc định (0.1): mã 8 chữ số khi hơn 10% không gian 6 chữ số đang được dùng")
+    store = MemoryVerificationStore(max_entries=10 ** 7)
+    allocator = CodeAllocator(store, 300)
+    codes = [allocator.allocate(f"user{i}@example.com", 'User') for i in range(live)]
+    lengths = Counter(len(code) for code in codes)
+    print_row("codes", "6 digits", "8 digits", "store size")
+    print_row(len(codes), lengths[6], lengths[8], len(store))
+
+    per_worker = min(live, 200000) // workers
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_allocator_'), 'codes.db')
+    SQLiteVerificationStore(path)
+    print(f"\n{workers} worker (process), mỗi worker cấp {per_worker} mã vào SQLite dùng chung")
+    result_queue = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_allocator_worker, args=(path, per_worker, result_queue))
+             for _ in range(workers)]
+    start = time.perf_counter()
+    for proc in procs:
+        proc.start()
+    results = [result_queue.get() for _ in procs]
+    elapsed = time.perf_counter() - start
+    for proc in procs:
+        proc.join()
+    codes = [code for worker_codes, _ in results for code in worker_codes]
+    print_row("codes", "unique", "store size", "collisions", "allocs/s")
+    print_row(len(codes), len(set(codes)), len(SQLiteVerificationStore(path)),
+              sum(collisions for _, collisions in results), f"{len(codes) / elapsed:.0f}")
+
+# ============================================
+# SNAPSHOT: giữ mã đang chờ qua restart (SIGTERM -> ghi, khởi động -> nạp trong nền)
+# ============================================
+
+def _fill_memory_store(count, ttl=300):
+    store = MemoryVerificationStore(ttl=ttl, max_entries=max(count, 1))
+    for i in range(count):
+        store.put(f"{i:06d}" if i < 10 ** 6 else f"{i:08d}", f"user{i}@example.com", 'Nguyễn Văn A')
+    return store
+
+
+def bench_snapshot(sizes, restart_codes):
+    """Thời gian ghi/nạp snapshot theo số mã, rồi restart gunicorn thật với restart_codes mã đang chờ"""
+    tmp = tempfile.mkdtemp(prefix='bench_snapshot_')
+    print("ghi snapshot (SIGTERM) và nạp lại (khởi động) trong process")
+    print_row("codes", "file size", "save", "restore", "restored")
+    quiet = StructuredLogger(enabled=False)
+    for size in sizes:
+        path = os.path.join(tmp, f'{size}.snapshot')
+        saved, save_seconds = timed(VerificationSnapshotter(_fill_memory_store(size), path, logger=quiet).save)
+        file_size = os.path.getsize(path)
+        store = MemoryVerificationStore(max_entries=size)
+        restored, restore_seconds = timed(VerificationSnapshotter(store, path, logger=quiet).restore)
+        print_row(saved, f"{file_size / 1024:.0f} KB", f"{save_seconds * 1000:.0f} ms",
+                  f"{restore_seconds * 1000:.0f} ms", restored)
+
+    # Restart thật: snapshot của lần chạy trước -> gunicorn khởi động (nạp trong nền) -> verify -> SIGTERM -> lại
+    path = os.path.join(tmp, 'server.snapshot')
+    codes = [f"{i:06d}" for i in range(restart_codes)]
+    admin = StandInServer(routes=admin_routes()).start()
+    print(f"\nrestart gunicorn với {restart_codes} mã đang chờ (VERIFICATION_SNAPSHOT_PATH)")
+    print_row("run", "ready (/ping)", "restored after", "restored", "verify ok", "SIGTERM exit", "saved")
+    write_snapshot(path, _fill_memory_store(restart_codes).snapshot_entries())
+    sample = 0
+    for run, snapshot_path in (('snapshot', path), ('snapshot', path), ('no snapshot', '')):
+        port = free_port()
+        env = server_env(PORT=port, ADMIN_SERVER_URL=admin.url, GOOGLE_ID_TOKEN_LOCAL=0, LOG_ENABLED=0,
+                         VERIFICATION_STORE_MAX_ENTRIES=restart_codes + 1000,
+                         VERIFICATION_SNAPSHOT_PATH=snapshot_path, WEB_CONCURRENCY=1)
+        start = time.perf_counter()
+        proc = start_server_process([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                                     'server_google_oauth_example:app'], port, env)
+        ready = time.perf_counter() - start
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            restored, restored_after = 0, None
+            if snapshot_path:
+                while True:
+                    snapshot = requests.get(f"{base_url}/api/check-config", timeout=10).json()['verification_snapshot']
+                    if not snapshot['restoring']:
+                        restored, restored_after = snapshot['restored'], time.perf_counter() - start
+                        break
+                    time.sleep(0.01)
+            # Mỗi lần chạy dùng 200 mã khác nhau (mã đã verify không được sống lại ở lần sau)
+            batch = codes[sample:sample + 200]
+            sample += 200
+            _, _, ok, statuses = drive_verifies(base_url, batch, 8)
+            # Có snapshot: mã đang chờ trước restart vẫn dùng được; không có snapshot thì mất hết (400)
+            assert ok == len(batch) if snapshot_path else statuses == {400: len(batch)}, dict(statuses)
+            stop_start = time.perf_counter()
+            proc.terminate()
+            proc.wait(timeout=60)
+            stopped = time.perf_counter() - stop_start
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        saved = len(read_snapshot(path)) if snapshot_path else "-"
+        print_row(run, f"{ready:.2f} s", f"{restored_after:.2f} s" if restored_after else "-", restored,
+                  f"{ok}/{len(batch)}", f"{stopped:.2f} s", saved)
+    admin.stop()
+
+# ============================================
+# HTML: dựng trang mỗi request (f-string) vs biên dịch một lần + nén sẵn
+# ============================================
+
+def _as_fstring(source, fields):
+    """Hàm dựng trang bằng f-string như code cũ (cùng nguồn, cùng tên trường)"""
+    return eval(f"lambda {', '.join(sorted(fields))}: f{source!r}")
+
+
+def bench_html(renders):
+    """Chi phí dựng trang và số byte gửi đi của trang chủ và trang mã xác minh"""
+    srv = import_server(LOG_ENABLED=0, GOOGLE_ID_TOKEN_LOCAL=0)
+    from html_pages import brotli, compress_body
+    fields = {'email': 'nguyen.van.a@example.com', 'name': 'Nguyễn Văn A',
+              'instruction': 'Vui lòng nhập mã xác minh sau vào ứng dụng:', 'code': '123456'}
+    index_fields = {'client_id_preview': 'bench-client-id', 'redirect_uri': 'http://127.0.0.1/api/google-callback'}
+    index_source = srv.INDEX_DEVELOPMENT_PAGE.source
+    callback = srv.CALLBACK_SUCCESS_PAGE
+
+    index_fstring = _as_fstring(index_source, index_fields)
+    callback_fstring = _as_fstring(callback.source, fields)
+
+    print(f"chi phí mỗi request ({renders} lần, không tính Flask)")
+    print_row("page", "mode", "per request")
+    _, elapsed = timed(lambda: [index_fstring(**index_fields) for _ in range(renders)])
+    print_row("index (dev)", "f-string", fmt_ns(elapsed, renders))
+    _, elapsed = timed(lambda: [srv.INDEX_DEVELOPMENT.respond('gzip, deflate, br') for _ in range(renders)])
+    print_row("index (dev)", "static", fmt_ns(elapsed, renders))
+    _, elapsed = timed(lambda: [callback_fstring(**fields) for _ in range(renders)])
+    print_row("callback", "f-string", fmt_ns(elapsed, renders))
+    _, elapsed = timed(lambda: [callback.render(**fields) for _ in range(renders)])
+    print_row("callback", "template", fmt_ns(elapsed, renders))
+    _, elapsed = timed(lambda: [compress_body(callback.render(**fields).encode('utf-8'), 'gzip, deflate')
+                                for _ in range(renders)])
+    print_row("callback", "template+gzip", fmt_ns(elapsed, renders))
+
+    print("\nbyte trong body gửi đi" + ("" if brotli else " (brotli chưa cài đặt: pip install brotli)"))
+    print_row("page", "before", "minified", "gzip", "br", "304")
+    pages = (
+        ('index (dev)', index_source.format(**index_fields), srv.INDEX_DEVELOPMENT),
+        ('index (prod)', srv.INDEX_PRODUCTION.body.decode('utf-8'), srv.INDEX_PRODUCTION),
+        ('callback', callback.source.format(**fields), None),
+    )
+    for name, before, static in pages:
+        minified = static.body if static else callback.render(**fields).encode('utf-8')
+        if static:
+            gzipped = len(static.encoded.get('gzip', minified))
+            brotlied = len(static.encoded['br']) if 'br' in static.encoded else "-"
+            not_modified = len(static.respond('gzip', static.etag('gzip'))[1])
+        else:
+            gzipped = len(compress_body(minified, 'gzip')[0])
+            brotlied = len(compress_body(minified, 'br')[0]) if brotli else "-"
+            not_modified = "-"
+        print_row(name, len(before.encode('utf-8')), len(minified), gzipped, brotlied, not_modified)
+
+# ============================================
+# PROFILER: throughput verify khi tắt / đang profile / đang bật tracemalloc
+# ============================================
+
+def _short_stack(stack, frames=4):
+    """Vài frame cuối của một collapsed stack để in gọn"""
+    return ';'.join(stack.split(';')[-frames:])
+
+
+def bench_profiler(verifies, concurrency, rates, rounds):
+    """Verify qua Flask test client (admin stand-in không trễ) trong khi /debug/* đang chạy"""
+    admin = StandInServer(routes=admin_routes()).start()
+    srv = import_server(ADMIN_SERVER_URL=admin.url, GOOGLE_ID_TOKEN_LOCAL=0, LOG_ENABLED=0)
+
+    modes = [('off', None, False)] + [(f"profile {hz} Hz", hz, False) for hz in rates] + [
+        ('tracemalloc', None, True), (f"both ({rates[-1]} Hz)", rates[-1], True)]
+    # Các chế độ chạy xen kẽ qua nhiều vòng: độ trễ của admin stand-in trôi theo thời gian
+    totals = {name: {'wall': 0.0, 'latencies': [], 'ticks': 0, 'stacks': Counter()} for name, _, _ in modes}
+    growth = None
+
+    def one(code):
+        client = srv.app.test_client()
+        start = time.perf_counter()
+        response = client.post('/api/verify-google-auth', json={'auth_code': code, 'machine_id': f"m-{code}"})
+        return time.perf_counter() - start, response.get_json().get('success')
+
+    for round_index in range(rounds):
+        for name, hz, tracing in modes:
+            codes = [f"profiler-{round_index}-{name}-{i}" for i in range(verifies)]
+            for code in codes:
+                srv.verification_store.put(code, f"{code}@example.com", code)
+            if tracing:
+                srv.allocation_tracker.start()
+            profile_result = {}
+            profile_thread = None
+            if hz:
+                profile_thread = threading.Thread(target=lambda: profile_result.update(
+                    result=srv.profiler.profile(60, 1 / hz, srv.PROFILE_FUNCTIONS)))
+                profile_thread.start()
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                results = list(pool.map(one, codes))
+            total = totals[name]
+            total['wall'] += time.perf_counter() - start
+            total['latencies'].extend(r[0] for r in results)
+            assert all(r[1] for r in results), f"verify lỗi ở chế độ {name}"
+            if profile_thread is not None:
+                srv.profiler.cancel()
+                profile_thread.join()
+                stacks, ticks = profile_result['result']
+                total['stacks'].update(stacks)
+                total['ticks'] += ticks
+            if tracing:
+                # Mã đã verify bị xóa khỏi store: diff chỉ còn phần thật sự tăng thêm
+                growth = srv.allocation_tracker.diff(limit=3, files=['verification_store.py', 'html_pages.py'])
+                srv.allocation_tracker.stop()
+
+    print(f"{verifies} verifies x {rounds} vòng, concurrency {concurrency}")
+    print_row("mode", "verifies/s", "p50", "p99", "ticks/s", "samples")
+    for name, hz, _ in modes:
+        total = totals[name]
+        latencies = sorted(total['latencies'])
+        print_row(name, f"{verifies * rounds / total['wall']:.0f}", f"{percentile(latencies, 50) * 1000:.2f} ms",
+                  f"{percentile(latencies, 99) * 1000:.2f} ms",
+                  f"{total['ticks'] / total['wall']:.0f}" if hz else "-",
+                  sum(total['stacks'].values()) if hz else "-")
+
+    name = f"profile {rates[-1]} Hz"
+    stacks = totals[name]['stacks']
+    print(f"\nstack nhiều mẫu nhất ({name}, 4 frame cuối)")
+    for stack, count in stacks.most_common(5):
+        print(f"  {count / max(sum(stacks.values()), 1):6.1%}  {_short_stack(stack)}")
+    print(f"\ntracemalloc diff (verification_store.py, html_pages.py) sau lượt cuối: "
+          f"{growth['traced_kb']} KB đang theo dõi")
+    for row in growth['stats']:
+        print(f"  {row['where']:<32} {row['size_diff_kb']:+8.1f} KB  {row['count_diff']:+6d} objects")
+    if not growth['stats']:
+        print("  (không có dòng nào tăng)")
+    admin.stop()
+
+# ============================================
+# MAIN
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Google OAuth Server")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_store = sub.add_parser('store', help='insert/lookup/expire của verification_store')
+    p_store.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    p_store.add_argument('--expired-ratio', type=float, default=0.1)
+
+    p_workers = sub.add_parser('workers', help='throughput verify với SQLite store dùng chung')
+    p_workers.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    p_workers.add_argument('--codes', type=int, default=20000)
+
+    p_backends = sub.add_parser('backends', help='độ trễ put/get/pop của từng backend')
+    p_backends.add_argument('--ops', type=int, default=5000)
+    p_backends.add_argument('--redis-url', default=None)
+
+    p_pool = sub.add_parser('pool', help='số TLS handshake: requests.* vs UpstreamClient')
+    p_pool.add_argument('--requests', type=int, default=200)
+
+    p_keepwarm = sub.add_parser('keepwarm', help='độ trễ verify khi server admin có cold start')
+    p_keepwarm.add_argument('--verifies', type=int, default=5)
+    p_keepwarm.add_argument('--gap', type=float, default=2.5)
+
+    p_asgi = sub.add_parser('asgi', help='đăng nhập đồng thời: Flask sync vs ASGI (cần gunicorn, uvicorn, httpx)')
+    p_asgi.add_argument('--logins', type=int, default=200)
+    p_asgi.add_argument('--concurrency', type=int, default=50)
+    p_asgi.add_argument('--admin-latency', type=float, default=0.1)
+
+    p_idtoken = sub.add_parser('idtoken', help='độ trễ callback: userinfo vs id_token tại chỗ')
+    p_idtoken.add_argument('--callbacks', type=int, default=200)
+    p_idtoken.add_argument('--google-latency', type=float, default=0.05)
+
+    p_prefetch = sub.add_parser('prefetch', help='độ trễ verify có/không prefetch check-machine')
+    p_prefetch.add_argument('--logins', type=int, default=50)
+    p_prefetch.add_argument('--admin-latency', type=float, default=0.1)
+    p_prefetch.add_argument('--think-time', type=float, default=0.3)
+
+    p_metrics = sub.add_parser('metrics', help='chi phí observe histogram và render /metrics')
+    p_metrics.add_argument('--observations', type=int, default=1000000)
+
+    p_logging = sub.add_parser('logging', help='throughput verify: log tắt / bật, consumer nhanh / chậm')
+    p_logging.add_argument('--verifies', type=int, default=2000)
+    p_logging.add_argument('--concurrency', type=int, default=8)
+    p_logging.add_argument('--consumer-delay', type=float, default=0.002)
+
+    p_breaker = sub.add_parser('breaker', help='verify khi server admin treo/5xx: có và không có breaker + deadline')
+    p_breaker.add_argument('--verifies', type=int, default=40)
+    p_breaker.add_argument('--concurrency', type=int, default=10)
+    p_breaker.add_argument('--hang', type=float, default=6.0)
+    p_breaker.add_argument('--deadline', type=float, default=4.0)
+
+    p_bulkhead = sub.add_parser('bulkhead', help='độ trễ /ping khi verify làm bão hòa worker (cần gunicorn)')
+    p_bulkhead.add_argument('--duration', type=float, default=10.0)
+    p_bulkhead.add_argument('--concurrency', type=int, default=64)
+    p_bulkhead.add_argument('--threads', type=int, default=16)
+    p_bulkhead.add_argument('--admin-latency', type=float, default=0.5)
+
+    p_ratelimit = sub.add_parser('ratelimit', help='chi phí mỗi request của rate limiter')
+    p_ratelimit.add_argument('--ops', type=int, default=200000)
+    p_ratelimit.add_argument('--redis-url', default=None)
+
+    p_singleflight = sub.add_parser('singleflight', help='verify gửi trùng: số lời gọi admin có/không gộp')
+    p_singleflight.add_argument('--codes', type=int, default=50)
+    p_singleflight.add_argument('--duplicates', type=int, default=3)
+    p_singleflight.add_argument('--admin-latency', type=float, default=0.2)
+
+    p_longpoll = sub.add_parser('longpoll', help='N app chờ đăng nhập: long-poll vs hỏi lại định kỳ (cần uvicorn)')
+    p_longpoll.add_argument('--waiters', type=int, default=2000)
+    p_longpoll.add_argument('--idle', type=float, default=10.0)
+    p_longpoll.add_argument('--interval', type=float, default=1.0)
+
+    p_refresh = sub.add_parser('refresh', help='user quay lại: luồng đầy đủ vs đăng nhập bằng refresh token')
+    p_refresh.add_argument('--logins', type=int, default=50)
+    p_refresh.add_argument('--google-latency', type=float, default=0.08)
+    p_refresh.add_argument('--admin-latency', type=float, default=0.15)
+
+    p_workerclass = sub.add_parser('workerclass', help='gunicorn.conf.py: sync vs gthread vs gevent (cần gunicorn)')
+    p_workerclass.add_argument('--logins', type=int, default=400)
+    p_workerclass.add_argument('--concurrency', type=int, default=64)
+    p_workerclass.add_argument('--workers', type=int, default=1)
+    p_workerclass.add_argument('--admin-latency', type=float, default=0.2)
+
+    p_e2e = sub.add_parser('e2e', help='luồng đăng nhập đầy đủ qua server thật: throughput + p50/p95/p99 từng bước')
+    p_e2e.add_argument('--logins', type=int, default=500)
+    p_e2e.add_argument('--concurrency', type=int, default=16)
+    p_e2e.add_argument('--server', choices=['gthread', 'gevent', 'sync', 'asgi'], default='gthread')
+    p_e2e.add_argument('--workers', type=int, default=1)
+    p_e2e.add_argument('--google-latency', type=float, default=0.08)
+    p_e2e.add_argument('--admin-latency', type=float, default=0.15)
+    p_e2e.add_argument('--jitter', type=float, default=0.2)
+    p_e2e.add_argument('--google-error-rate', type=float, default=0.0)
+    p_e2e.add_argument('--admin-error-rate', type=float, default=0.0)
+    p_e2e.add_argument('--think-time', type=float, default=0.0, help='giây user đọc mã trước khi verify (không tính)')
+    p_e2e.add_argument('--id-token', action='store_true', help='Google trả id_token ký RS256, server xác minh tại chỗ')
+    p_e2e.add_argument('--env', nargs='*', default=[], metavar='KEY=VALUE', help='biến môi trường thêm cho server')
+    p_e2e.add_argument('--json', default=None, help='lưu kết quả để so sánh giữa các commit')
+    p_e2e.add_argument('--compare', default=None, help='file JSON của lần chạy trước')
+
+    p_writebehind = sub.add_parser('writebehind', help='verify user mới: đăng ký đồng bộ vs ghi journal rồi gửi sau')
+    p_writebehind.add_argument('--verifies', type=int, default=200)
+    p_writebehind.add_argument('--concurrency', type=int, default=16)
+    p_writebehind.add_argument('--admin-latency', type=float, default=0.15)
+    p_writebehind.add_argument('--appends', type=int, default=5000)
+    p_writebehind.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+
+    p_allocator = sub.add_parser('allocator', help='cấp mã xác minh khi có 100k+ mã đang sống: trùng mã, độ trễ')
+    p_allocator.add_argument('--live', type=int, nargs='+', default=[100000, 300000, 600000])
+    p_allocator.add_argument('--threads', type=int, default=8)
+    p_allocator.add_argument('--workers', type=int, default=4)
+
+    p_snapshot = sub.add_parser('snapshot', help='ghi/nạp snapshot mã đang chờ và restart gunicorn thật')
+    p_snapshot.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 300000])
+    p_snapshot.add_argument('--restart-codes', type=int, default=100000)
+
+    p_html = sub.add_parser('html', help='chi phí dựng trang và số byte gửi đi: f-string vs template + nén sẵn')
+    p_html.add_argument('--renders', type=int, default=20000)
+
+    p_profiler = sub.add_parser('profiler', help='throughput verify khi tắt / đang profile / đang bật tracemalloc')
+    p_profiler.add_argument('--verifies', type=int, default=1000)
+    p_profiler.add_argument('--concurrency', type=int, default=8)
+    p_profiler.add_argument('--hz', type=int, nargs='+', default=[100, 1000])
+    p_profiler.add_argument('--rounds', type=int, default=2)
+
+    args = parser.parse_args()
+    if args.command == 'store':
+        bench_store(args.sizes, args.expired_ratio)
+    elif args.command == 'workers':
+        bench_workers(args.workers, args.codes)
+    elif args.command == 'backends':
+        bench_backends(args.ops, args.redis_url)
+    elif args.command == 'pool':
+        bench_pool(args.requests)
+    elif args.command == 'keepwarm':
+        bench_keepwarm(args.verifies, args.gap)
+    elif args.command == 'asgi':
+        bench_asgi(args.logins, args.concurrency, args.admin_latency)
+    elif args.command == 'idtoken':
+        bench_idtoken(args.callbacks, args.google_latency)
+    elif args.command == 'prefetch':
+        bench_prefetch(args.logins, args.admin_latency, args.think_time)
+    elif args.command == 'metrics':
+        bench_metrics(args.observations)
+    elif args.command == 'logging':
+        bench_logging(args.verifies, args.concurrency, args.consumer_delay)
+    elif args.command == 'breaker':
+        bench_breaker(args.verifies, args.concurrency, args.hang, args.deadline)
+    elif args.command == 'bulkhead':
+        bench_bulkhead(args.duration, args.concurrency, args.threads, args.admin_latency)
+    elif args.command == 'ratelimit':
+        bench_ratelimit(args.ops, args.redis_url)
+    elif args.command == 'singleflight':
+        bench_singleflight(args.codes, args.duplicates, args.admin_latency)
+    elif args.command == 'longpoll':
+        bench_longpoll(args.waiters, args.idle, args.interval)
+    elif args.command == 'refresh':
+        bench_refresh(args.logins, args.google_latency, args.admin_latency)
+    elif args.command == 'workerclass':
+        bench_workerclass(args.logins, args.concurrency, args.workers, args.admin_latency)
+    elif args.command == 'e2e':
+        bench_e2e(args.logins, args.concurrency, args.server, args.workers, args.google_latency, args.admin_latency,
+                  args.jitter, args.google_error_rate, args.admin_error_rate, args.think_time, args.id_token,
+                  dict(item.split('=', 1) for item in args.env), args.json, args.compare)
+    elif args.command == 'writebehind':
+        bench_writebehind(args.verifies, args.concurrency, args.admin_latency, args.appends, args.threads)
+    elif args.command == 'allocator':
+        bench_allocator(args.live, args.threads, args.workers)
+    elif args.command == 'snapshot':
+        bench_snapshot(args.sizes, args.restart_codes)
+    elif args.command == 'html':
+        bench_html(args.renders)
+    elif args.command == 'profiler':
+        bench_profiler(args.verifies, args.concurrency, args.hz, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Cấp mã xác minh không trùng cho callback
+- Bitmap 1 bit/mã trên không gian len(alphabet)^length (10^6 mã 6 chữ số = 125 KB) đánh dấu các mã
+  đang sống trong process. Cấp mã: thử vài vị trí ngẫu nhiên, không trúng bit trống thì quét bitmap
+  (regex trên bytearray, chạy trong C) từ một byte ngẫu nhiên tới byte còn bit trống đầu tiên
+- Bit được xóa khi hết TTL (hàng đợi theo giây hết hạn, 4 byte/mã). Mã đã dùng vẫn giữ chỗ tới hết TTL
+- store.add() quyết định cuối cùng: mã đang do worker khác giữ (sqlite/redis dùng chung) hoặc còn
+  trong store từ trước khi restart thì giữ bit đó và chọn mã khác
+- Tỉ lệ lấp đầy vượt grow_at thì cấp mã trong không gian overflow (dài hơn / alphabet khác) - mã
+  6 chữ số càng đầy thì đoán bừa càng dễ trúng mã của người khác
+"""
+
+import re
+import secrets
+import threading
+import time
+from array import array
+from collections import deque
+
+DIGITS = '0123456789'
+# Không gian lớn hơn thì không dùng bitmap (2^26 bit = 8 MB): xác suất trùng đã rất nhỏ, store.add lo phần còn lại
+MAX_BITMAP_SPACE = 1 << 26
+# Byte còn ít nhất một bit trống
+_FREE_BYTE = re.compile(rb'[^\xff]')
+
+
+class CodeSpaceExhausted(Exception):
+    """Không tìm được mã trống sau max_attempts lần thử"""
+
+
+class CodeSpace:
+    """Không gian mã len(alphabet)^length, chuyển qua lại giữa mã và số thứ tự"""
+
+    def __init__(self, length, alphabet=DIGITS):
+        if length < 1 or len(alphabet) < 2 or len(set(alphabet)) != len(alphabet):
+            raise ValueError(f"Không gian mã không hợp lệ: length={length}, alphabet={alphabet!r}")
+        self.length = length
+        self.alphabet = alphabet
+        self.size = len(alphabet) ** length
+        self._digits = alphabet == DIGITS
+
+    def encode(self, index):
+        if self._digits:
+            return f"{index:0{self.length}d}"
+        base, chars = len(self.alphabet), []
+        for _ in range(self.length):
+            index, digit = divmod(index, base)
+            chars.append(self.alphabet[digit])
+        return ''.join(reversed(chars))
+
+    def random(self):
+        return self.encode(secrets.randbelow(self.size))
+
+
+class CodeAllocator:
+    """
+    Cấp mã chưa dùng và lưu vào store trong một bước: allocate(email, name) -> mã.
+    An toàn với nhiều thread (và greenlet khi gunicorn chạy gevent), kể cả các bộ đếm:
+    phần giữ lock không gọi I/O
+    """
+
+    def __init__(self, store, ttl, length=6, alphabet=DIGITS, grow_at=0.1, overflow_length=8,
+                 overflow_alphabet=None, probes=8, max_attempts=32):
+        self.store = store
+        self.ttl = ttl
+        self.space = CodeSpace(length, alphabet)
+        self.overflow_space = CodeSpace(overflow_length, overflow_alphabet or alphabet)
+        self.grow_at = grow_at
+        self.probes = probes
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._bitmap = None
+        if self.space.size <= MAX_BITMAP_SPACE:
+            self._bitmap = bytearray((self.space.size + 7) // 8)
+            # Bit thừa của byte cuối (ngoài không gian mã) luôn coi là đã dùng
+            for index in range(self.space.size, len(self._bitmap) * 8):
+                self._bitmap[index >> 3] |= 1 << (index & 7)
+        self._expiry = deque()  # (giây hết hạn, array số thứ tự mã), theo thứ tự thời gian
+        self.live = 0
+        self.allocated_total = 0
+        self.collisions_total = 0
+        self.overflow_total = 0
+
+    @property
+    def occupancy(self):
+        """Tỉ lệ mã đang sống trong không gian chính (theo những gì process này biết)"""
+        return self.live / self.space.size
+
+    def allocate(self, email, name):
+        """Chọn mã chưa dùng, lưu vào store và trả về mã; CodeSpaceExhausted nếu không tìm được"""
+        for _ in range(self.max_attempts):
+            code = self._pick()
+            if self.store.add(code, email, name) is not None:
+                with self._lock:
+                    self.allocated_total += 1
+                return code
+            # Mã đang được giữ ngoài tầm nhìn của bitmap: bit đã đánh dấu, chọn mã khác
+            with self._lock:
+                self.collisions_total += 1
+        raise CodeSpaceExhausted(f"Không cấp được mã sau {self.max_attempts} lần thử")
+
+    def _pick(self):
+        if self._bitmap is None and self.grow_at >= 1:
+            return self.space.random()
+        with self._lock:
+            if self._bitmap is not None:
+                now = time.time()
+                self._expire_locked(now)
+                if self.live < self.grow_at * self.space.size:
+                    index = self._reserve_locked()
+                    if index is not None:
+                        self._mark_locked(index, now)
+                        return self.space.encode(index)
+            self.overflow_total += 1
+        return self.overflow_space.random()
+
+    def _reserve_locked(self):
+        """Số thứ tự một mã có bit trống; None nếu bitmap đã đầy"""
+        bitmap, size = self._bitmap, self.space.size
+        for _ in range(self.probes):
+            index = secrets.randbelow(size)
+            if not bitmap[index >> 3] >> (index & 7) & 1:
+                return index
+        start = secrets.randbelow(len(bitmap))
+        match = _FREE_BYTE.search(bitmap, start) or _FREE_BYTE.search(bitmap, 0, start)
+        if match is None:
+            return None
+        byte_index = match.start()
+        free_bits = [bit for bit in range(8) if not bitmap[byte_index] >> bit & 1]
+        return byte_index * 8 + secrets.choice(free_bits)
+
+    def _mark_locked(self, index, now):
+        self._bitmap[index >> 3] |= 1 << (index & 7)
+        # Làm tròn lên: bit chỉ được xóa sau khi mã trong store chắc chắn đã hết hạn
+        second = int(now + self.ttl) + 1
+        if not self._expiry or self._expiry[-1][0] != second:
+            self._expiry.append((second, array('I')))
+        self._expiry[-1][1].append(index)
+        self.live += 1
+
+    def _expire_locked(self, now):
+        expiry, bitmap = self._expiry, self._bitmap
+        while expiry and expiry[0][0] <= now:
+            _, indices = expiry.popleft()
+            for index in indices:
+                bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+            self.live -= len(indices)
+
+    def stats(self):
+        return {
+            'length': self.space.length,
+            'space': self.space.size,
+            'live': self.live,
+            'occupancy': round(self.occupancy, 4),
+            'grow_at': self.grow_at,
+            'overflow_length': self.overflow_space.length,
+            'allocated': self.allocated_total,
+            'collisions': self.collisions_total,
+            'overflow': self.overflow_total,
+        }
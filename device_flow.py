@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Đăng nhập kiểu device flow: app desktop nhận handle từ /api/google-auth?device=1, mở trình duyệt
+rồi long-poll /api/google-auth/poll cho tới khi callback của handle đó hoàn tất.
+State OAuth (nằm trong URL đăng nhập, chỉ ký không mã hóa) chỉ mang device_key = hash(machine_id, handle):
+ai thấy URL cũng không poll được, và poll với machine_id khác máy đã tạo handle không khớp key.
+
+Request đang chờ không quay vòng kiểm tra: mỗi request đăng ký một waiter theo handle và ngủ
+trên threading.Event (thread, hoặc greenlet khi gunicorn chạy gevent) hoặc asyncio.Future
+(async_server) cho tới khi callback gọi notify(handle). Một waiter chỉ tốn vài trăm byte nên một
+worker async/gevent giữ được hàng nghìn request đang chờ; worker sync thì mỗi request giữ một thread.
+"""
+
+import asyncio
+import hashlib
+import secrets
+import threading
+
+# Handle ngẫu nhiên 192 bit, chỉ app đã tạo nó biết (dùng như mật khẩu dùng một lần)
+HANDLE_BYTES = 24
+MAX_HANDLE_LENGTH = 64
+
+
+def new_device_handle():
+    return secrets.token_urlsafe(HANDLE_BYTES)
+
+
+def is_valid_handle(handle):
+    return isinstance(handle, str) and 0 < len(handle) <= MAX_HANDLE_LENGTH
+
+
+def device_key(handle, machine_id=''):
+    """Key của handle trong state, kho mã và LongPollWaiters: gắn handle với machine_id đã tạo nó"""
+    return hashlib.sha256(f"{machine_id}\0{handle}".encode('utf-8')).hexdigest()
+
+
+class _Waiter:
+    """Một request đang chờ trong thread/greenlet"""
+
+    __slots__ = ('_registry', 'key', '_event')
+
+    def __init__(self, registry, key):
+        self._registry = registry
+        self.key = key
+        self._event = threading.Event()
+
+    def fire(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        """Ngủ tới khi được notify hoặc hết timeout; trả về True nếu đã được notify"""
+        fired = self._event.wait(timeout)
+        # Người gọi kiểm tra lại trạng thái sau mỗi lần thức dậy, nên xóa cờ để lần chờ sau lại ngủ
+        self._event.clear()
+        return fired
+
+    def close(self):
+        self._registry._remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _AsyncWaiter:
+    """Một coroutine đang chờ trong event loop; notify từ thread khác cũng an toàn"""
+
+    __slots__ = ('_registry', 'key', '_loop', '_future')
+
+    def __init__(self, registry, key):
+        self._registry = registry
+        self.key = key
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+    def fire(self):
+        self._loop.call_soon_threadsafe(self._resolve)
+
+    async def wait(self, timeout):
+        """Như _Waiter.wait; future chỉ được thay mới sau khi đã được notify"""
+        if self._future.done():
+            self._future = self._loop.create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def close(self):
+        self._registry._remove(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class LongPollWaiters:
+    """
+    Các request đang long-poll theo key. Đăng ký waiter TRƯỚC khi kiểm tra trạng thái để
+    notify xảy ra giữa lúc kiểm tra và lúc ngủ không bị lỡ:
+
+        with waiters.waiter(key) as waiter:
+            while not ready():
+                if not waiter.wait(remaining):
+                    break
+    """
+
+    def __init__(self):
+        self._waiters = {}  # key -> set các waiter đang chờ
+        self._lock = threading.Lock()
+        self.notified_total = 0
+        self.woken_total = 0
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _add(self, waiter):
+        with self._lock:
+            self._waiters.setdefault(waiter.key, set()).add(waiter)
+        return waiter
+
+    def _remove(self, waiter):
+        with self._lock:
+            waiters = self._waiters.get(waiter.key)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[waiter.key]
+
+    def waiter(self, key):
+        return self._add(_Waiter(self, key))
+
+    def async_waiter(self, key):
+        """Gọi trong event loop đang chạy"""
+        return self._add(_AsyncWaiter(self, key))
+
+    def notify(self, key):
+        """Đánh thức mọi request đang chờ key; trả về số waiter được đánh thức"""
+        with self._lock:
+            waiters = list(self._waiters.get(key, ()))
+            self.notified_total += 1
+            self.woken_total += len(waiters)
+        for waiter in waiters:
+            waiter.fire()
+        return len(waiters)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Xác minh id_token của Google tại chỗ (RS256) bằng khóa công khai JWKS đã cache
+Thay cho lời gọi /oauth2/v2/userinfo sau khi đổi code lấy token
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import re
+import threading
+import time
+
+from structured_log import StructuredLogger
+
+GOOGLE_JWKS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+# DigestInfo của SHA-256 trong EMSA-PKCS1-v1_5 (RFC 8017, mục 9.2)
+_SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+
+class IdTokenError(ValueError):
+    """id_token không hợp lệ (sai định dạng, sai chữ ký, hết hạn, sai audience...)"""
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _b64_to_int(text):
+    return int.from_bytes(_b64decode(text), 'big')
+
+
+def rsa_pkcs1_sha256_verify(n, e, message, signature):
+    """Kiểm tra chữ ký RSASSA-PKCS1-v1_5 + SHA-256 (thuật toán RS256 của JWT)"""
+    key_bytes = (n.bit_length() + 7) // 8
+    if len(signature) != key_bytes:
+        return False
+    decoded = pow(int.from_bytes(signature, 'big'), e, n).to_bytes(key_bytes, 'big')
+    digest = _SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+    expected = b'\x00\x01' + b'\xff' * (key_bytes - len(digest) - 3) + b'\x00' + digest
+    return hmac.compare_digest(decoded, expected)
+
+
+class GoogleJWKSCache:
+    """
+    Cache khóa công khai của Google trong bộ nhớ
+    Thời hạn lấy từ Cache-Control: max-age, thread nền làm mới trước khi hết hạn
+    """
+
+    def __init__(self, client, jwks_url=GOOGLE_JWKS_URL, refresh_margin=300, default_ttl=3600,
+                 retry_interval=60, fetch_timeout=10, logger=None):
+        self.client = client
+        # Mặc định ghi thẳng ra stdout (như khi dùng riêng module); server truyền logger chung
+        self.logger = logger or StructuredLogger(asynchronous=False)
+        self.jwks_url = jwks_url
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.retry_interval = retry_interval
+        self.fetch_timeout = fetch_timeout
+        self._keys = {}  # kid -> (n, e)
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_needed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.refreshes_total = 0
+
+    def _max_age(self, response):
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        if not match:
+            return self.default_ttl
+        return max(0, int(match.group(1)) - int(response.headers.get('Age', 0) or 0))
+
+    def refresh(self):
+        """Tải lại JWKS (gọi từ thread nền); trả về True nếu thành công"""
+        try:
+            response = self.client.get(self.jwks_url, timeout=self.fetch_timeout)
+            if response.status_code != 200:
+                return False
+            keys = {}
+            for jwk in response.json().get('keys', []):
+                if jwk.get('kty') == 'RSA' and jwk.get('kid'):
+                    keys[jwk['kid']] = (_b64_to_int(jwk['n']), _b64_to_int(jwk['e']))
+        except Exception as e:
+            self.logger.error('google_jwks_refresh_error', url=self.jwks_url, error=str(e))
+            return False
+        with self._lock:
+            self._keys = keys
+            self._expires_at = time.time() + self._max_age(response)
+        self.refreshes_total += 1
+        return True
+
+    def get_key(self, kid):
+        """Lấy khóa từ cache, không bao giờ gọi mạng; thiếu khóa thì báo thread nền tải lại"""
+        with self._lock:
+            key = self._keys.get(kid) if time.time() < self._expires_at else None
+        if key is None:
+            self._refresh_needed.set()
+        return key
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.refresh():
+                wait = max(self.retry_interval, self._expires_at - time.time() - self.refresh_margin)
+            else:
+                wait = self.retry_interval
+            # Thức dậy sớm nếu gặp kid lạ (Google vừa xoay khóa)
+            self._refresh_needed.wait(wait)
+            self._refresh_needed.clear()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='google-jwks-refresh', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._refresh_needed.set()
+
+
+def verify_id_token(id_token, jwks, audience, issuers=GOOGLE_ISSUERS, leeway=60):
+    """Kiểm tra chữ ký và các claim của id_token, trả về dict claims hoặc ném IdTokenError"""
+    if not id_token or id_token.count('.') != 2:
+        raise IdTokenError('id_token sai định dạng')
+    header_b64, payload_b64, signature_b64 = id_token.split('.')
+    try:
+        header = json.loads(_b64decode(header_b64))
+        claims = json.loads(_b64decode(payload_b64))
+        signature = _b64decode(signature_b64)
+    except ValueError:
+        raise IdTokenError('id_token sai định dạng')
+
+    if header.get('alg') != 'RS256':
+        raise IdTokenError(f"Thuật toán không hỗ trợ: {header.get('alg')}")
+    key = jwks.get_key(header.get('kid'))
+    if key is None:
+        raise IdTokenError(f"Chưa có khóa cho kid={header.get('kid')}")
+    if not rsa_pkcs1_sha256_verify(key[0], key[1], f"{header_b64}.{payload_b64}".encode('ascii'), signature):
+        raise IdTokenError('Chữ ký id_token không hợp lệ')
+
+    now = time.time()
+    if claims.get('iss') not in issuers:
+        raise IdTokenError('Sai issuer')
+    audiences = claims.get('aud')
+    if audience not in (audiences if isinstance(audiences, list) else [audiences]):
+        raise IdTokenError('Sai audience')
+    if claims.get('exp', 0) + leeway < now:
+        raise IdTokenError('id_token đã hết hạn')
+    if claims.get('iat', 0) - leeway > now:
+        raise IdTokenError('id_token phát hành trong tương lai')
+    # Email chưa xác minh thì không chứng minh được quyền sở hữu địa chỉ
+    if claims.get('email_verified') not in (True, 'true'):
+        raise IdTokenError('Email chưa được Google xác minh')
+    return claims
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Cấu hình gunicorn cho production
+Chạy: gunicorn -c gunicorn.conf.py server_google_oauth_example:app
+
+GUNICORN_WORKER_CLASS:
+- gthread (mặc định): mỗi worker GUNICORN_THREADS thread, request chờ Google/server admin giữ một thread
+- gevent: mỗi worker tối đa GUNICORN_WORKER_CONNECTIONS kết nối trên greenlet, hợp với long-poll
+  của device flow (cần cài đặt: pip install gevent)
+- sync: một request mỗi worker (như `gunicorn --bind` trước đây)
+Thread nền (dọn mã hết hạn, keep-warm, làm mới JWKS, gửi đăng ký ghi sau) được khởi động trong từng worker sau khi fork,
+không phải lúc import (thread của process cha không sống sót qua fork khi GUNICORN_PRELOAD=1).
+"""
+
+import os
+import sys
+
+# server_google_oauth_example không tự khởi động thread nền lúc import, post_worker_init sẽ làm việc đó
+os.environ['BACKGROUND_JOBS_POST_FORK'] = '1'
+
+bind = f"0.0.0.0:{os.getenv('PORT', '3000')}"
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# Backend memory của verification store chỉ đúng với 1 worker (mỗi worker một kho riêng)
+SHARED_STORE = os.getenv('VERIFICATION_STORE_BACKEND', 'memory') != 'memory'
+workers = int(os.getenv('WEB_CONCURRENCY', 2 if SHARED_STORE else 1))
+# gthread: đủ chỗ cho các bulkhead (CALLBACK/VERIFY/REFRESH/DEVICE_POLL_MAX_CONCURRENT + hàng chờ) và vẫn
+# còn thread cho /ping và /api/check-config. Chỉ áp dụng cho gthread: threads > 1 khiến gunicorn
+# tự chuyển worker sync sang gthread
+threads = int(os.getenv('GUNICORN_THREADS', 48)) if worker_class == 'gthread' else 1
+# gevent: số kết nối đồng thời tối đa mỗi worker (gthread: số kết nối keep-alive tối đa)
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Long-poll (DEVICE_POLL_TIMEOUT 30s) + verify (VERIFY_DEADLINE 20s) phải xong trước khi worker bị coi là treo
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+# SIGTERM (deploy/restart): ngừng nhận kết nối mới, chờ request đang chạy tối đa graceful_timeout giây
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+backlog = int(os.getenv('GUNICORN_BACKLOG', 2048))
+# Thay worker sau N request (0 = không bao giờ); jitter để các worker không restart cùng lúc
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+# gevent vá thư viện chuẩn trong worker, sau khi fork: app đã import trước đó (preload) sẽ giữ
+# lock/socket chưa được vá nên không preload khi chạy gevent
+preload_app = os.getenv('GUNICORN_PRELOAD') == '1' and worker_class != 'gevent'
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    if workers > 1 and not SHARED_STORE:
+        server.log.warning("VERIFICATION_STORE_BACKEND=memory với %s worker: mã xác minh chỉ có trong "
+                           "worker đã tạo ra nó - dùng sqlite/redis hoặc WEB_CONCURRENCY=1", workers)
+    if os.getenv('GUNICORN_PRELOAD') == '1' and worker_class == 'gevent':
+        server.log.warning("GUNICORN_PRELOAD=1 bị bỏ qua khi chạy gevent")
+
+
+def post_worker_init(worker):
+    # Sau fork và sau khi gevent đã vá thư viện chuẩn: app đã được load trong worker này
+    import server_google_oauth_example
+    server_google_oauth_example.start_background_jobs()
+
+
+def worker_exit(server, worker):
+    # Gọi khi worker thoát (sau khi đã phục vụ xong request đang chạy nếu tắt êm)
+    oauth_server = sys.modules.get('server_google_oauth_example')
+    if oauth_server is not None:
+        oauth_server.stop_background_jobs()
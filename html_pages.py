@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Trang HTML của server: biên dịch một lần lúc khởi động, mỗi request chỉ điền các trường động
+- PageTemplate: bỏ thụt lề, tách phần tĩnh và các chỗ {trường} một lần; render() escape HTML giá trị điền vào
+- StaticResponse: nội dung không đổi (trang chủ) - ETag, 304 Not Modified, bản gzip/brotli nén sẵn
+- compress_body: nén trang động theo Accept-Encoding (trang mã xác minh, trang lỗi)
+"""
+
+import gzip
+import hashlib
+import string
+from html import escape
+
+try:
+    import brotli
+except ImportError:  # Tùy chọn: không có thì chỉ dùng gzip
+    brotli = None
+
+# Nhỏ hơn ngưỡng này thì header nén còn tốn hơn số byte tiết kiệm được
+MIN_COMPRESS_SIZE = 256
+# Trang động: mức nén nhanh (vài chục µs cho trang vài KB); trang tĩnh nén sẵn ở mức cao nhất
+DYNAMIC_GZIP_LEVEL = 6
+DYNAMIC_BROTLI_QUALITY = 5
+
+
+class PageTemplate:
+    """
+    Template cú pháp str.format ({trường}, {{ và }} cho dấu ngoặc của CSS), biên dịch một lần:
+        CALLBACK_PAGE = PageTemplate(\"\"\"<p>{email}</p>\"\"\")
+        CALLBACK_PAGE.render(email=email)
+    """
+
+    def __init__(self, source):
+        self.source = source
+        # Thụt lề và dòng trống chỉ tốn byte trên đường truyền
+        compact = '\n'.join(line.strip() for line in source.splitlines() if line.strip()) + '\n'
+        self._parts = []
+        self._slots = []  # (vị trí trong _parts, tên trường)
+        for literal, field, _, _ in string.Formatter().parse(compact):
+            if literal:
+                self._parts.append(literal)
+            if field is not None:
+                self._slots.append((len(self._parts), field))
+                self._parts.append('')
+        self.fields = frozenset(field for _, field in self._slots)
+
+    def render(self, **values):
+        """Điền các trường (đã escape HTML) vào phần tĩnh"""
+        parts = self._parts.copy()
+        for index, field in self._slots:
+            parts[index] = escape(str(values[field]))
+        return ''.join(parts)
+
+
+def accepted_encodings(accept_encoding):
+    """Tập encoding client chấp nhận (q > 0) từ header Accept-Encoding"""
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name)
+    return accepted
+
+
+def _negotiate(accept_encoding, available):
+    accepted = accepted_encodings(accept_encoding)
+    for encoding in ('br', 'gzip'):
+        if encoding in available and (encoding in accepted or '*' in accepted):
+            return encoding
+    return None
+
+
+def compress_body(body, accept_encoding):
+    """Nén trang động nếu client chấp nhận; trả về (body, Content-Encoding hoặc None)"""
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+    encoding = _negotiate(accept_encoding, ('br', 'gzip') if brotli is not None else ('gzip',))
+    if encoding == 'br':
+        return brotli.compress(body, quality=DYNAMIC_BROTLI_QUALITY), 'br'
+    if encoding == 'gzip':
+        return gzip.compress(body, DYNAMIC_GZIP_LEVEL, mtime=0), 'gzip'
+    return body, None
+
+
+class StaticResponse:
+    """Response không đổi suốt vòng đời process: ETag và các bản nén tính một lần"""
+
+    def __init__(self, body, content_type, max_age=0):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.content_type = content_type
+        self._hash = hashlib.sha256(self.body).hexdigest()[:20]
+        self.encoded = {None: self.body}
+        if len(self.body) >= MIN_COMPRESS_SIZE:
+            self.encoded['gzip'] = gzip.compress(self.body, 9, mtime=0)
+            if brotli is not None:
+                self.encoded['br'] = brotli.compress(self.body, quality=11)
+        # max_age=0: trình duyệt vẫn giữ bản cũ nhưng hỏi lại mỗi lần (If-None-Match -> 304)
+        self.cache_control = f'public, max-age={max_age}' if max_age else 'no-cache'
+
+    def etag(self, encoding=None):
+        # Mỗi bản nén một ETag riêng (strong ETag gắn với đúng chuỗi byte gửi đi)
+        return f'"{self._hash}-{encoding}"' if encoding else f'"{self._hash}"'
+
+    def not_modified(self, if_none_match):
+        """If-None-Match khớp bất kỳ bản nào của nội dung này"""
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or tag.removeprefix('W/').strip('"').split('-', 1)[0] == self._hash:
+                return True
+        return False
+
+    def respond(self, accept_encoding=None, if_none_match=None):
+        """(status, body, headers) cho request có các header Accept-Encoding / If-None-Match đã cho"""
+        encoding = _negotiate(accept_encoding, self.encoded)
+        headers = {'ETag': self.etag(encoding), 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        if self.not_modified(if_none_match):
+            return 304, b'', headers
+        headers['Content-Type'] = self.content_type
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return 200, self.encoded[encoding], headers
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics tối giản theo định dạng text của Prometheus (không cần prometheus_client)
+Ghi nhận chỉ tốn một lần bisect + cộng số dưới lock, đủ rẻ để bật trong production.
+Mỗi worker gunicorn có registry riêng: mỗi lần scrape chỉ thấy số liệu của một worker.
+"""
+
+import bisect
+import threading
+import time
+
+# Bucket (giây) cho độ trễ request/upstream: từ 5ms tới 60s (timeout upstream là 30s)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Bộ đếm tăng dần theo nhãn"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, labels), value) for labels, value in items]
+
+
+class Gauge:
+    """Giá trị tức thời, đọc từ hàm callback lúc scrape (không tốn gì trên đường request)"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        return [(self.name, '', value)]
+
+
+class CallbackCounter(Gauge):
+    """Counter đọc từ bộ đếm có sẵn của đối tượng khác (vd expired_total của verification_store)"""
+
+    kind = 'counter'
+
+
+class Histogram:
+    """Histogram độ trễ theo nhãn, bucket cố định"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        samples = []
+        for labels, series in items:
+            cumulative = 0
+            for upper, count in zip(self.buckets, series):
+                cumulative += count
+                samples.append((f'{self.name}_bucket',
+                                _format_labels(self.labelnames, labels, f'le="{_format_value(upper)}"'), cumulative))
+            samples.append((f'{self.name}_bucket', _format_labels(self.labelnames, labels, 'le="+Inf"'), series[-1]))
+            samples.append((f'{self.name}_sum', _format_labels(self.labelnames, labels), series[-2]))
+            samples.append((f'{self.name}_count', _format_labels(self.labelnames, labels), series[-1]))
+        return samples
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labelvalues', 'start')
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+
+class MetricsRegistry:
+    """Tập hợp metrics của process, render ra text format 0.0.4 của Prometheus"""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Import lại module (vd benchmark) thì giữ metric cũ thay vì báo trùng
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function):
+        with self._lock:
+            # Gauge callback luôn trỏ tới đối tượng mới nhất
+            self._metrics[name] = Gauge(name, documentation, function)
+            return self._metrics[name]
+
+    def callback_counter(self, name, documentation, function):
+        with self._lock:
+            self._metrics[name] = CallbackCounter(name, documentation, function)
+            return self._metrics[name]
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+# Độ trễ từng lời gọi upstream (google_token, google_userinfo, admin_check_machine, ...)
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'google_oauth_upstream_seconds',
+    'Latency of upstream calls by stage and outcome',
+    ('stage', 'outcome')
+)
+
+
+def upstream_outcome(result):
+    """Phân loại kết quả UpstreamResult: ok / http_4xx / http_5xx / error"""
+    if result.error is not None:
+        return 'error'
+    if result.status_code >= 500:
+        return 'http_5xx'
+    if result.status_code >= 400:
+        return 'http_4xx'
+    return 'ok'
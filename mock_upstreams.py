@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Server giả lập (stand-in) cho Google và server admin, dùng cho benchmark chạy local
+Chạy trong thread nền, có đếm số request theo path và số kết nối/handshake TLS
+"""
+
+import base64
+import hashlib
+import json
+import os
+import random
+import secrets
+import socket
+import ssl
+import subprocess
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+def generate_self_signed_cert(directory, host='localhost'):
+    """Tạo cert tự ký bằng openssl CLI, trả về (certfile, keyfile)"""
+    certfile = os.path.join(directory, 'standin-cert.pem')
+    keyfile = os.path.join(directory, 'standin-key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-keyout', keyfile, '-out', certfile, '-subj', f'/CN={host}',
+         '-addext', f'subjectAltName=DNS:{host},IP:127.0.0.1'],
+        check=True, capture_output=True
+    )
+    return certfile, keyfile
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Giữ kết nối keep-alive như server thật
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        server = self.server.standin
+        parsed = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            body = json.loads(raw or b'{}')
+        else:
+            body = {key: values[0] for key, values in parse_qs(raw.decode('utf-8')).items()}
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+
+        server.record_call(parsed.path)
+        delay = server.cold_start_wait() + server.latency_for(parsed.path)
+        if delay:
+            time.sleep(delay)
+
+        handler = server.routes.get((method, parsed.path))
+        extra_headers = {}
+        fail_status = server.fail_status or server.error_for(parsed.path)
+        if fail_status:
+            status, payload = fail_status, {'error': 'stand-in failure'}
+        elif handler is None:
+            status, payload = 404, {'error': 'not found'}
+        else:
+            status, payload, *rest = handler(body=body, query=query, headers=self.headers)
+            if rest:
+                extra_headers = rest[0]
+
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in extra_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class _StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Benchmark mở hàng trăm kết nối cùng lúc: backlog mặc định (5) làm rớt kết nối
+    request_queue_size = 512
+
+    def __init__(self, standin, address, ssl_context=None):
+        self.standin = standin
+        self.ssl_context = ssl_context
+        super().__init__(address, _StandInHandler)
+
+    def handle_error(self, request, client_address):
+        # Client bỏ đi giữa chừng (timeout khi mô phỏng upstream treo) là chuyện bình thường
+        pass
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        # Tắt Nagle để header và body không bị delayed ACK giữ lại ~40ms
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.standin.record_connection()
+        if self.ssl_context is not None:
+            # Mỗi kết nối mới = một lần TLS handshake
+            sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        return sock, address
+
+
+class StandInServer:
+    """
+    Server giả lập: routes = {(method, path): handler(body, query, headers) -> (status, dict[, headers])}
+    latency = {path: giây} để mô phỏng upstream chậm; jitter: độ lệch ngẫu nhiên (0.2 = ±20%)
+    error_rates = {path: tỉ lệ} (mặc định error_rate): tỉ lệ request trả về error_status
+    idle_timeout/cold_start_delay: rảnh quá idle_timeout giây thì "ngủ", request kế tiếp
+    (và các request đến trong lúc đang khởi động) phải chờ cold_start_delay giây
+    fail_status: nếu set (vd 503), mọi request trả về status này; default_latency lớn = upstream treo
+    """
+
+    def __init__(self, routes=None, certfile=None, keyfile=None, default_latency=0.0,
+                 idle_timeout=None, cold_start_delay=0.0, jitter=0.0, error_rate=0.0, error_status=503):
+        self.routes = dict(routes or {})
+        self.latency = {}
+        self.default_latency = default_latency
+        self.jitter = jitter
+        self.error_rates = {}
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.errors = Counter()
+        self.fail_status = None
+        self.idle_timeout = idle_timeout
+        self.cold_start_delay = cold_start_delay
+        self.cold_starts = 0
+        self._last_request = 0.0
+        self._awake_at = 0.0
+        self.calls = Counter()
+        self.connections = 0
+        self._lock = threading.Lock()
+        ssl_context = None
+        if certfile:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(certfile, keyfile)
+        self.scheme = 'https' if ssl_context else 'http'
+        self._httpd = _StandInHTTPServer(self, ('127.0.0.1', 0), ssl_context)
+        self._thread = None
+
+    @property
+    def url(self):
+        host = 'localhost' if self.scheme == 'https' else '127.0.0.1'
+        return f"{self.scheme}://{host}:{self._httpd.server_address[1]}"
+
+    @property
+    def handshakes(self):
+        return self.connections if self.scheme == 'https' else 0
+
+    def record_call(self, path):
+        with self._lock:
+            self.calls[path] += 1
+
+    def cold_start_wait(self):
+        """Số giây request hiện tại phải chờ server giả lập khởi động"""
+        if self.idle_timeout is None:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._awake_at and now - self._last_request > self.idle_timeout:
+                self._awake_at = now + self.cold_start_delay
+                self.cold_starts += 1
+            self._last_request = max(now, self._awake_at)
+            return max(0.0, self._awake_at - now)
+
+    def latency_for(self, path):
+        latency = self.latency.get(path, self.default_latency)
+        if latency and self.jitter:
+            latency *= 1 + random.uniform(-self.jitter, self.jitter)
+        return latency
+
+    def error_for(self, path):
+        """error_status nếu request này được chọn để lỗi, ngược lại None"""
+        rate = self.error_rates.get(path, self.error_rate)
+        if rate and random.random() < rate:
+            with self._lock:
+                self.errors[path] += 1
+            return self.error_status
+        return None
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.connections = 0
+            self.cold_starts = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def admin_routes(machines=None):
+    """
+    Route giả lập server admin: /ping, /api/check-machine, /api/login, /api/register
+    machines = {machine_id: email} - máy đã đăng ký (register sẽ thêm vào)
+    register với header Idempotency-Key đã gặp thì trả lại kết quả cũ, không đăng ký lần nữa
+    """
+    machines = {} if machines is None else machines
+    lock = threading.Lock()
+    idempotency_keys = set()
+
+    def ping(**_):
+        return 200, {'status': 'ok'}
+
+    def check_machine(body, **_):
+        with lock:
+            email = machines.get(body.get('machine_id'))
+        if email is None:
+            return 200, {'exists': False}
+        return 200, {
+            'exists': True,
+            'user': {'name': 'User', 'email': email},
+            'last_registered': '',
+            'can_register_again': False,
+            'hours_since_last': 0,
+            'user_count': 1
+        }
+
+    def login(body, **_):
+        return 200, {'success': True, 'auth_token': 'admin-token', 'user_info': {'name': 'User'}}
+
+    def register(body, headers, **_):
+        key = headers.get('Idempotency-Key')
+        with lock:
+            if key and key in idempotency_keys:
+                return 200, {'success': True, 'duplicate': True}
+            if key:
+                idempotency_keys.add(key)
+            machines[body.get('machine_id')] = body.get('email')
+        return 200, {'success': True}
+
+    return {
+        ('GET', '/ping'): ping,
+        ('POST', '/api/check-machine'): check_machine,
+        ('POST', '/api/login'): login,
+        ('POST', '/api/register'): register,
+    }
+
+
+# ============================================
+# GOOGLE GIẢ LẬP (token, userinfo, JWKS, id_token ký RS256)
+# ============================================
+
+def _is_probable_prime(n, rounds=32):
+    if n < 4:
+        return n in (2, 3)
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d, r = d // 2, r + 1
+    for _ in range(rounds):
+        x = pow(secrets.randbelow(n - 3) + 2, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _random_prime(bits):
+    while True:
+        candidate = secrets.randbits(bits) | (1 << (bits - 1)) | 1
+        if _is_probable_prime(candidate):
+            return candidate
+
+
+def generate_rsa_key(bits=2048, e=65537):
+    """Tạo khóa RSA (chỉ dùng cho stand-in): trả về dict {kid, n, e, d}"""
+    while True:
+        p, q = _random_prime(bits // 2), _random_prime(bits // 2)
+        phi = (p - 1) * (q - 1)
+        if p != q and phi % e:
+            n = p * q
+            return {'kid': secrets.token_hex(8), 'n': n, 'e': e, 'd': pow(e, -1, phi)}
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _int_b64(value):
+    return _b64(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+
+
+def jwk_from_key(key):
+    return {'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': key['kid'],
+            'n': _int_b64(key['n']), 'e': _int_b64(key['e'])}
+
+
+def sign_jwt(claims, key):
+    """Ký JWT RS256 (RSASSA-PKCS1-v1_5 + SHA-256)"""
+    header = _b64(json.dumps({'alg': 'RS256', 'kid': key['kid'], 'typ': 'JWT'}).encode('utf-8'))
+    payload = _b64(json.dumps(claims).encode('utf-8'))
+    signing_input = f"{header}.{payload}".encode('ascii')
+    key_bytes = (key['n'].bit_length() + 7) // 8
+    digest = bytes.fromhex('3031300d060960864801650304020105000420') + hashlib.sha256(signing_input).digest()
+    encoded = b'\x00\x01' + b'\xff' * (key_bytes - len(digest) - 3) + b'\x00' + digest
+    signature = pow(int.from_bytes(encoded, 'big'), key['d'], key['n']).to_bytes(key_bytes, 'big')
+    return f"{header}.{payload}.{_b64(signature)}"
+
+
+def google_routes(client_id, key, users=None, jwks_max_age=3600, id_token=True):
+    """
+    Route giả lập Google: GET /auth (trang đăng nhập: chuyển hướng ngay về redirect_uri kèm code + state),
+    POST /token (trả về access_token + id_token), GET /userinfo, GET /certs
+    users = {authorization code: {email, name, picture}}; code lạ thì tạo user theo code
+    /auth nhận thêm login_hint để chọn code (mặc định mỗi lần đăng nhập một user mới)
+    /token trả refresh_token cho grant authorization_code và nhận grant_type=refresh_token
+    (refresh token lạ -> 400 invalid_grant, như token đã bị thu hồi)
+    id_token=False: /token không ký id_token (ký RSA thuần Python tốn ~40ms CPU mỗi lần)
+    """
+    users = {} if users is None else users
+    tokens = {}
+    refresh_tokens = {}
+    lock = threading.Lock()
+
+    def user_for(code):
+        return users.get(code) or {'email': f'{code}@example.com', 'name': f'User {code}', 'picture': ''}
+
+    def token(body, **_):
+        if body.get('grant_type') == 'refresh_token':
+            with lock:
+                user = refresh_tokens.get(body.get('refresh_token'))
+            if user is None:
+                return 400, {'error': 'invalid_grant', 'error_description': 'Token has been expired or revoked.'}
+        else:
+            code = body.get('code')
+            if not code:
+                return 400, {'error': 'invalid_grant'}
+            user = user_for(code)
+        access_token = secrets.token_urlsafe(16)
+        with lock:
+            tokens[access_token] = user
+        payload = {'access_token': access_token, 'expires_in': 3599,
+                   'token_type': 'Bearer', 'scope': 'openid email profile'}
+        if body.get('grant_type') != 'refresh_token':
+            payload['refresh_token'] = secrets.token_urlsafe(32)
+            with lock:
+                refresh_tokens[payload['refresh_token']] = user
+        if not id_token:
+            return 200, payload
+        now = int(time.time())
+        payload['id_token'] = sign_jwt({
+            'iss': 'https://accounts.google.com', 'aud': client_id, 'sub': hashlib.sha1(user['email'].encode()).hexdigest(),
+            'email': user['email'], 'email_verified': True, 'name': user['name'], 'picture': user.get('picture', ''),
+            'iat': now, 'exp': now + 3600
+        }, key)
+        return 200, payload
+
+    def auth(query, **_):
+        if query.get('client_id') != client_id or not query.get('redirect_uri'):
+            return 400, {'error': 'invalid_request'}
+        code = query.get('login_hint') or f"auth-{secrets.token_hex(8)}"
+        params = urlencode({'code': code, 'state': query.get('state', '')})
+        return 302, {'redirect': query['redirect_uri']}, {'Location': f"{query['redirect_uri']}?{params}"}
+
+    def userinfo(headers, **_):
+        with lock:
+            user = tokens.get(headers.get('Authorization', '').replace('Bearer ', ''))
+        if user is None:
+            return 401, {'error': 'invalid_token'}
+        return 200, {'email': user['email'], 'verified_email': True, 'name': user['name'],
+                     'picture': user.get('picture', '')}
+
+    def certs(**_):
+        return 200, {'keys': [jwk_from_key(key)]}, {'Cache-Control': f'public, max-age={jwks_max_age}'}
+
+    return {
+        ('GET', '/auth'): auth,
+        ('POST', '/token'): token,
+        ('GET', '/userinfo'): userinfo,
+        ('GET', '/certs'): certs,
+    }
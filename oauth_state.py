@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+State token cho Google OAuth: ký HMAC-SHA256, có thời hạn, không cần session
+Mọi worker/instance dùng chung key nên callback về worker nào cũng kiểm tra được
+Luồng trình duyệt còn đặt nonce của state vào cookie và so khớp ở callback (nonce_matches):
+state ký hợp lệ bị nhét vào trình duyệt của người khác không dùng được (login CSRF)
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+# State chỉ cần sống trong thời gian user đăng nhập Google
+DEFAULT_STATE_MAX_AGE = 600  # 10 phút
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class OAuthStateSigner:
+    """Tạo và kiểm tra state token; key đầu tiên dùng để ký, các key sau chỉ để kiểm tra (xoay key)"""
+
+    def __init__(self, keys, max_age=DEFAULT_STATE_MAX_AGE):
+        if not keys:
+            raise ValueError("Cần ít nhất một key để ký OAuth state")
+        self._keys = [key.encode('utf-8') if isinstance(key, str) else key for key in keys]
+        self.max_age = max_age
+
+    def _sign(self, key, payload):
+        return hmac.new(key, payload.encode('ascii'), hashlib.sha256).digest()
+
+    def create(self, data=None, nonce=None):
+        """Tạo state token chứa nonce (ngẫu nhiên nếu không truyền), thời điểm tạo và dữ liệu tùy chọn"""
+        body = {'n': nonce or secrets.token_urlsafe(16), 'iat': int(time.time())}
+        if data:
+            body['d'] = data
+        payload = _b64encode(json.dumps(body, separators=(',', ':')).encode('utf-8'))
+        return f"{payload}.{_b64encode(self._sign(self._keys[0], payload))}"
+
+    def verify(self, token):
+        """Trả về dữ liệu trong state nếu chữ ký hợp lệ và chưa hết hạn, ngược lại trả về None"""
+        if not token or token.count('.') != 1:
+            return None
+        payload, signature = token.split('.')
+        try:
+            signature = _b64decode(signature)
+        except ValueError:
+            return None
+        if not any(hmac.compare_digest(self._sign(key, payload), signature) for key in self._keys):
+            return None
+        try:
+            body = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        issued_at = body.get('iat', 0)
+        now = time.time()
+        if issued_at > now + 60 or now - issued_at > self.max_age:
+            return None
+        return body.get('d') or {}
+
+    @staticmethod
+    def nonce_matches(token, nonce):
+        """Nonce trong state (đã verify) khớp với nonce lưu ở trình duyệt"""
+        if not token or not nonce:
+            return False
+        try:
+            body = json.loads(_b64decode(token.split('.')[0]))
+        except ValueError:
+            return False
+        return hmac.compare_digest(str(body.get('n', '')).encode('utf-8'), nonce.encode('utf-8'))
+
+
+def load_state_keys():
+    """
+    Đọc key từ OAUTH_STATE_KEYS (nhiều key cách nhau bởi dấu phẩy, key mới nhất đứng đầu)
+    hoặc FLASK_SECRET_KEY. Không có key nào thì tạo key ngẫu nhiên (chỉ đúng với 1 worker).
+    """
+    keys = [key.strip() for key in os.getenv('OAUTH_STATE_KEYS', '').split(',') if key.strip()]
+    if not keys and os.getenv('FLASK_SECRET_KEY'):
+        keys = [os.getenv('FLASK_SECRET_KEY')]
+    if not keys:
+        print("⚠️  CẢNH BÁO: OAUTH_STATE_KEYS chưa được set, dùng key ngẫu nhiên - "
+              "state sẽ không hợp lệ giữa các worker và sau khi restart")
+        keys = [secrets.token_hex(32)]
+    return keys
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Công cụ chẩn đoán bật theo yêu cầu trong worker đang chạy (endpoint /debug/* của server)
+- SamplingProfiler: thread lấy mẫu stack của các thread khác (sys._current_frames) trong một khoảng thời
+  giới hạn, trả về collapsed stacks ("frame;frame;frame số_mẫu") cho flamegraph.pl / speedscope
+- AllocationTracker: tracemalloc với snapshot gốc, top cấp phát hiện tại và diff so với snapshot gốc,
+  tự tắt sau max_seconds
+
+Khi không dùng: không có thread, không có hook (sys.setprofile / tracemalloc) - chi phí bằng 0.
+Khi đang chạy: profiler tốn một lần duyệt stack mỗi interval (chặn dưới MIN_INTERVAL); tracemalloc làm
+mọi lần cấp phát chậm hơn nên luôn có thời hạn.
+Worker gevent: mọi greenlet chạy trên cùng một thread, nên việc lấy mẫu chạy trong thread thật của
+threadpool gevent và thấy greenlet đang chạy tại thời điểm lấy mẫu (greenlet đang chờ I/O không tốn CPU).
+"""
+
+import math
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Giới hạn chi phí khi đang chạy
+MIN_INTERVAL = 0.001
+# Dưới GUNICORN_TIMEOUT mặc định (60s): worker sync không bị coi là treo khi đang profile
+MAX_PROFILE_SECONDS = 30.0
+MAX_STACK_DEPTH = 64
+MAX_DISTINCT_STACKS = 20000
+MAX_TRACEMALLOC_FRAMES = 25
+MIN_TRACEMALLOC_SECONDS = 1.0
+
+
+def _gevent_patched():
+    # Không import gevent: chỉ kiểm tra khi worker gevent đã vá thư viện chuẩn
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+class ProfileBusy(Exception):
+    """Đang có một lần profile khác chạy trong worker này"""
+
+
+class SamplingProfiler:
+    """
+    Lấy mẫu stack mỗi `interval` giây trong `seconds` giây:
+        stacks = profiler.profile(seconds=10, functions={'verify_google_auth_steps'})
+    functions: chỉ đếm stack có frame thuộc một trong các hàm này (None = mọi thread)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = False
+        self._cancelled = False
+        self.profiles_total = 0
+        self.samples_total = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    def profile(self, seconds, interval=0.01, functions=None):
+        """Chặn tới khi lấy mẫu xong; trả về (Counter {collapsed stack: số mẫu}, số lần lấy mẫu)"""
+        # nan lọt qua min/max: seconds=nan không bao giờ hết hạn, interval=nan lấy mẫu liên tục
+        if not (math.isfinite(seconds) and math.isfinite(interval)):
+            raise ValueError("seconds/interval phải là số hữu hạn")
+        seconds = min(max(seconds, 0.0), MAX_PROFILE_SECONDS)
+        interval = min(max(interval, MIN_INTERVAL), 1.0)
+        with self._lock:
+            if self._running:
+                raise ProfileBusy("Đang có một lần profile khác")
+            self._running = True
+            self._cancelled = False
+        args = (seconds, interval, frozenset(functions) if functions else None)
+        try:
+            if _gevent_patched():
+                import gevent
+                # Greenlet gọi profile() chờ không chặn hub; thread lấy mẫu thấy greenlet đang chạy
+                return gevent.get_hub().threadpool.apply(self._sample, args)
+            return self._sample(*args)
+        finally:
+            self._running = False
+            self.profiles_total += 1
+
+    def _sample(self, seconds, interval, functions):
+        stacks = Counter()
+        labels = {}  # code object -> "file.py:hàm", mỗi hàm chỉ định dạng một lần
+        me = threading.get_ident()
+        ticks = 0
+        deadline = time.monotonic() + seconds
+        next_tick = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now >= deadline or self._cancelled:
+                break
+            if now < next_tick:
+                time.sleep(min(next_tick, deadline) - now)
+                continue
+            next_tick += interval
+            ticks += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                codes = []
+                while frame is not None and len(codes) < MAX_STACK_DEPTH:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                # Thread không chạy luồng cần profile: bỏ qua trước khi dựng chuỗi
+                if functions is not None and not any(code.co_name in functions for code in codes):
+                    continue
+                for code in codes:
+                    if code not in labels:
+                        labels[code] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+                stack = ';'.join([labels[code] for code in reversed(codes)])
+                if stack not in stacks and len(stacks) >= MAX_DISTINCT_STACKS:
+                    stack = '[truncated]'
+                stacks[stack] += 1
+            # Không để lượt lấy mẫu chậm dồn thành lấy mẫu liên tục
+            if next_tick < time.monotonic():
+                next_tick = time.monotonic() + interval
+        self.samples_total += sum(stacks.values())
+        return stacks, ticks
+
+    def cancel(self):
+        """Kết thúc sớm lần profile đang chạy (trả về các mẫu đã lấy)"""
+        self._cancelled = True
+
+
+def collapsed_stacks(stacks):
+    """Định dạng collapsed của flamegraph.pl / speedscope, stack nhiều mẫu nhất trước"""
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class AllocationTracker:
+    """tracemalloc bật theo yêu cầu, tự tắt sau max_seconds"""
+
+    def __init__(self, max_seconds=300.0):
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self._baseline = None
+        self._started_at = None
+        self._timer = None
+
+    @property
+    def running(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1, seconds=None):
+        """
+        Bật tracemalloc và lấy snapshot gốc; trả về số giây trước khi tự tắt.
+        frames: độ sâu traceback mỗi lần cấp phát - 1 đủ cho group_by lineno/filename, mỗi frame thêm
+        làm cấp phát chậm hơn nữa (verify chậm ~3x với 1 frame, ~15x với 10 frame)
+        """
+        if seconds is not None and not math.isfinite(seconds):
+            raise ValueError("seconds phải là số hữu hạn")
+        seconds = min(max(seconds, MIN_TRACEMALLOC_SECONDS), self.max_seconds) if seconds else self.max_seconds
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(min(max(int(frames), 1), MAX_TRACEMALLOC_FRAMES))
+            self._baseline = self._snapshot()
+            self._started_at = time.time()
+            self._timer = threading.Timer(seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+        return seconds
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._baseline = None
+            self._started_at = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    @staticmethod
+    def _snapshot():
+        # Bỏ cấp phát của chính tracemalloc và module này
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+
+    @staticmethod
+    def _filter(snapshot, files):
+        if not files:
+            return snapshot
+        return snapshot.filter_traces([tracemalloc.Filter(True, f"*{name}") for name in files])
+
+    @staticmethod
+    def _describe(stat):
+        frame = stat.traceback[0]
+        return {
+            'where': f"{os.path.basename(frame.filename)}:{frame.lineno}",
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count,
+        }
+
+    def top(self, limit=20, group_by='lineno', files=None):
+        """Các chỗ đang giữ nhiều bộ nhớ nhất; None nếu tracemalloc chưa bật"""
+        if not tracemalloc.is_tracing():
+            return None
+        stats = self._filter(self._snapshot(), files).statistics(group_by)
+        return self._report(stats[:limit], [self._describe(stat) for stat in stats[:limit]])
+
+    def diff(self, limit=20, group_by='lineno', files=None):
+        """Chỗ tăng bộ nhớ nhiều nhất so với snapshot gốc (lúc start); None nếu tracemalloc chưa bật"""
+        with self._lock:
+            baseline = self._baseline
+        if baseline is None or not tracemalloc.is_tracing():
+            return None
+        stats = self._filter(self._snapshot(), files).compare_to(self._filter(baseline, files), group_by)
+        rows = []
+        for stat in stats[:limit]:
+            row = self._describe(stat)
+            row.update(size_diff_kb=round(stat.size_diff / 1024, 1), count_diff=stat.count_diff)
+            rows.append(row)
+        return self._report(stats[:limit], rows)
+
+    def _report(self, stats, rows):
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'traced_kb': round(current / 1024, 1),
+            'peak_kb': round(peak / 1024, 1),
+            'tracing_seconds': round(time.time() - self._started_at, 1) if self._started_at else None,
+            'stats': rows,
+        }
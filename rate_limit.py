@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Giới hạn tần suất (token bucket) cho bước nhập mã xác minh
+- memory: trong process, mỗi key chỉ giữ một số float, tự bỏ bucket đã đầy lại, giới hạn số key
+- redis: dùng chung cho mọi worker/instance (WATCH/MULTI, không cần script Lua)
+
+Token bucket được lưu dưới dạng GCRA: thay vì (số token, thời điểm cập nhật) chỉ lưu
+"thời điểm bucket đầy trở lại" (tat). Mỗi request đẩy tat thêm 1/rate giây; nếu tat vượt
+quá now + burst/rate thì bucket đã cạn. tat <= now nghĩa là bucket đầy = giống key mới.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # Chỉ cần khi dùng backend redis
+    redis = None
+
+DEFAULT_MAX_KEYS = 100000
+DEFAULT_REDIS_URL = 'redis://localhost:6379/0'
+
+
+class TokenBucketLimiter:
+    """Token bucket trong bộ nhớ: rate token/giây, tối đa burst token, tối đa max_keys key"""
+
+    def __init__(self, rate, burst, max_keys=DEFAULT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._interval = 1.0 / rate
+        # Cộng thêm chút sai số để burst token liên tiếp luôn qua được (làm tròn số thực)
+        self._capacity = burst * self._interval + 1e-9
+        self._tat = OrderedDict()  # key -> thời điểm bucket đầy lại (monotonic), thứ tự LRU
+        self._lock = threading.Lock()
+        self.rejected_total = 0
+        self.evicted_total = 0
+
+    def __len__(self):
+        return len(self._tat)
+
+    def allow(self, key, cost=1):
+        """Trả về (allowed, retry_after giây)"""
+        now = time.monotonic()
+        with self._lock:
+            tat = self._tat.get(key, now)
+            new_tat = max(tat, now) + cost * self._interval
+            if new_tat - now > self._capacity:
+                self.rejected_total += 1
+                return False, new_tat - now - self._capacity
+            self._tat[key] = new_tat
+            self._tat.move_to_end(key)
+            self._evict(now)
+        return True, 0.0
+
+    def _evict(self, now):
+        # Key ít dùng nhất nằm đầu: bỏ các bucket đã đầy lại (không khác gì key mới)
+        tat = self._tat
+        while tat:
+            key, oldest = next(iter(tat.items()))
+            if oldest > now and len(tat) <= self.max_keys:
+                break
+            if oldest > now:
+                # Quá max_keys: bỏ key ít dùng nhất dù bucket chưa đầy
+                self.evicted_total += 1
+            del tat[key]
+
+    def reset(self, key):
+        with self._lock:
+            self._tat.pop(key, None)
+
+
+class RedisTokenBucketLimiter:
+    """Token bucket dùng chung qua Redis; Redis lỗi thì cho qua (fail open) và đếm errors_total"""
+
+    KEY_PREFIX = 'google_oauth:rate:'
+
+    def __init__(self, rate, burst, url=None, prefix='', socket_timeout=0.5, max_retries=5, client=None):
+        self.rate = rate
+        self.burst = burst
+        self.prefix = self.KEY_PREFIX + prefix
+        self.max_retries = max_retries
+        self._interval = 1.0 / rate
+        # Cộng thêm chút sai số để burst token liên tiếp luôn qua được (làm tròn số thực)
+        self._capacity = burst * self._interval + 1e-9
+        self.rejected_total = 0
+        self.errors_total = 0
+        if client is not None:
+            self._client = client
+        else:
+            if redis is None:
+                raise RuntimeError("Rate limit backend redis cần cài đặt: pip install redis")
+            self._client = redis.Redis.from_url(
+                url or DEFAULT_REDIS_URL,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_timeout
+            )
+
+    def __len__(self):
+        return sum(1 for _ in self._client.scan_iter(match=self.prefix + '*', count=1000))
+
+    def allow(self, key, cost=1):
+        """Trả về (allowed, retry_after giây)"""
+        redis_key = self.prefix + key
+        try:
+            with self._client.pipeline(transaction=True) as pipe:
+                for _ in range(self.max_retries):
+                    try:
+                        pipe.watch(redis_key)
+                        now = time.time()
+                        raw = pipe.get(redis_key)
+                        tat = float(raw) if raw else now
+                        new_tat = max(tat, now) + cost * self._interval
+                        if new_tat - now > self._capacity:
+                            pipe.unwatch()
+                            self.rejected_total += 1
+                            return False, new_tat - now - self._capacity
+                        pipe.multi()
+                        # Key tự hết hạn khi bucket đầy lại
+                        pipe.set(redis_key, repr(new_tat), px=max(1, math.ceil((new_tat - now) * 1000)))
+                        pipe.execute()
+                        return True, 0.0
+                    except redis.WatchError:
+                        continue
+        except Exception:
+            self.errors_total += 1
+            return True, 0.0
+        # Tranh chấp liên tục trên cùng key: coi như đã cạn
+        self.rejected_total += 1
+        return False, self._interval
+
+    def reset(self, key):
+        self._client.delete(self.prefix + key)
+
+
+def create_rate_limiter(backend, rate, burst, max_keys=DEFAULT_MAX_KEYS, url=None, prefix=''):
+    """Tạo limiter theo cấu hình (memory | redis); prefix tách các limiter dùng chung Redis"""
+    if backend == 'memory':
+        return TokenBucketLimiter(rate, burst, max_keys=max_keys)
+    if backend == 'redis':
+        return RedisTokenBucketLimiter(rate, burst, url=url, prefix=prefix)
+    raise ValueError(f"Backend rate limit không hợp lệ: {backend}")
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+Refresh token của Google cho user đăng nhập lại (chế độ "ghi nhớ đăng nhập")
+- Mã hóa khi lưu (AES-256-GCM của thư viện cryptography), key theo (email, machine_id)
+- Callback chỉ lưu tạm (staged); verify thành công mới kích hoạt và cấp remember_token cho app
+- App gửi (email, machine_id, remember_token) tới /api/google-auth/refresh: server làm mới token với
+  Google rồi đi thẳng tới bước login của server admin, không cần mở trình duyệt
+- Backend memory/sqlite/redis giống verification_store
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+try:
+    import redis
+except ImportError:  # Chỉ cần khi dùng backend redis
+    redis = None
+
+# Refresh token được giữ 180 ngày kể từ lần dùng cuối (Google thu hồi token không dùng sau 6 tháng)
+DEFAULT_TTL = 180 * 24 * 3600
+# Bản lưu tạm từ callback chỉ cần sống tới lúc verify (bằng thời hạn mã xác minh)
+DEFAULT_STAGING_TTL = 300
+DEFAULT_SQLITE_PATH = os.path.join(tempfile.gettempdir(), 'google_oauth_refresh_tokens.db')
+DEFAULT_REDIS_URL = 'redis://localhost:6379/0'
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class TokenCipher:
+    """
+    Mã hóa xác thực AES-256-GCM: bản mã = version || key id || nonce || ciphertext + tag
+    Key đầu tiên dùng để mã hóa, mọi key đều giải mã được (xoay key như OAUTH_STATE_KEYS);
+    key id cho biết bản mã dùng key nào, không phải thử lần lượt
+    """
+
+    VERSION = 2
+    KEY_ID_BYTES = 4
+    NONCE_BYTES = 12
+    TAG_BYTES = 16
+    # Tách key dùng cho refresh token khỏi key ký OAuth state khi dùng chung một secret
+    LABEL = b'google_oauth_refresh_token:'
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError("Cần ít nhất một key để mã hóa refresh token")
+        self._keys = {}
+        self._primary = None
+        for key in keys:
+            key = key.encode('utf-8') if isinstance(key, str) else key
+            key_id = hashlib.sha256(self.LABEL + b'id' + key).digest()[:self.KEY_ID_BYTES]
+            aes_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=self.LABEL + b'aes-gcm').derive(key)
+            self._keys.setdefault(key_id, AESGCM(aes_key))
+            if self._primary is None:
+                self._primary = key_id
+
+    def encrypt(self, plaintext, aad=b''):
+        """Mã hóa bytes, aad (vd key của bản ghi) gắn với bản mã để không chép sang bản ghi khác được"""
+        header = bytes([self.VERSION]) + self._primary
+        nonce = secrets.token_bytes(self.NONCE_BYTES)
+        return _b64encode(header + nonce + self._keys[self._primary].encrypt(nonce, plaintext, header + aad))
+
+    def decrypt(self, token, aad=b''):
+        """Trả về bytes đã giải mã, None nếu bản mã bị sửa, sai aad hoặc key đã bị loại"""
+        try:
+            raw = _b64decode(token)
+        except (ValueError, TypeError):
+            return None
+        header_len = 1 + self.KEY_ID_BYTES
+        if len(raw) < header_len + self.NONCE_BYTES + self.TAG_BYTES or raw[0] != self.VERSION:
+            return None
+        aesgcm = self._keys.get(raw[1:header_len])
+        if aesgcm is None:
+            return None
+        nonce = raw[header_len:header_len + self.NONCE_BYTES]
+        try:
+            return aesgcm.decrypt(nonce, raw[header_len + self.NONCE_BYTES:], raw[:header_len] + aad)
+        except InvalidTag:
+            return None
+
+
+def load_refresh_token_keys(fallback):
+    """REFRESH_TOKEN_KEYS (cách nhau bởi dấu phẩy, key mới nhất đứng đầu), không có thì dùng fallback"""
+    keys = [key.strip() for key in os.getenv('REFRESH_TOKEN_KEYS', '').split(',') if key.strip()]
+    return keys or list(fallback)
+
+
+# ============================================
+# BACKEND LƯU BẢN MÃ (key -> bản mã, có TTL)
+# ============================================
+
+class MemoryRecordBackend:
+    """
+    Trong process - chỉ dùng được với 1 worker, mất khi restart
+    Hết hạn theo bucket thời gian như kho mã xác minh: expire() chỉ duyệt các bucket đã qua
+    """
+
+    # Độ rộng một bucket (giây): cleanup_worker chạy mỗi phút, TTL tính bằng ngày
+    BUCKET_SECONDS = 60
+
+    def __init__(self):
+        self._records = {}  # key -> (bản mã, expires_at)
+        # {chỉ số bucket: deque[(key, record)]} - phần tử cũ (đã ghi đè/xóa) được bỏ qua khi dọn
+        self._buckets = {}
+        self._wheel_items = 0
+        self._next_bucket = int(time.time()) // self.BUCKET_SECONDS
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, key):
+        record = self._records.get(key)
+        if record is None or record[1] < time.time():
+            return None
+        return record[0]
+
+    def set(self, key, blob, ttl):
+        record = (blob, time.time() + ttl)
+        with self._lock:
+            self._records[key] = record
+            self._add_to_wheel_locked(key, record)
+
+    def _add_to_wheel_locked(self, key, record):
+        index = max(int(record[1]) // self.BUCKET_SECONDS, self._next_bucket)
+        bucket = self._buckets.get(index)
+        if bucket is None:
+            bucket = self._buckets[index] = deque()
+        bucket.append((key, record))
+        self._wheel_items += 1
+        # Ghi đè nhiều (update mỗi lần đăng nhập lại) -> wheel giữ nhiều phần tử rác -> xây lại
+        if self._wheel_items > 2 * len(self._records) + 1024:
+            self._buckets = {}
+            self._wheel_items = 0
+            for other_key, other_record in self._records.items():
+                index = max(int(other_record[1]) // self.BUCKET_SECONDS, self._next_bucket)
+                self._buckets.setdefault(index, deque()).append((other_key, other_record))
+                self._wheel_items += 1
+
+    def pop(self, key):
+        with self._lock:
+            record = self._records.pop(key, None)
+        return record[0] if record is not None and record[1] >= time.time() else None
+
+    def delete(self, key):
+        with self._lock:
+            return self._records.pop(key, None) is not None
+
+    def expire(self, now=None):
+        """Xóa bản ghi hết hạn trong các bucket đã qua, chi phí tỉ lệ với số bản ghi hết hạn"""
+        limit = int(time.time() if now is None else now) // self.BUCKET_SECONDS
+        removed = 0
+        with self._lock:
+            if limit <= self._next_bucket:
+                return 0
+            # Khoảng trống dài thì duyệt các bucket đang có thay vì từng chỉ số
+            if limit - self._next_bucket > len(self._buckets):
+                indexes = sorted(index for index in self._buckets if index < limit)
+            else:
+                indexes = range(self._next_bucket, limit)
+            records = self._records
+            for index in indexes:
+                bucket = self._buckets.pop(index, None)
+                if not bucket:
+                    continue
+                self._wheel_items -= len(bucket)
+                for key, record in bucket:
+                    if records.get(key) is record:
+                        del records[key]
+                        removed += 1
+            self._next_bucket = limit
+        return removed
+
+
+class SQLiteRecordBackend:
+    """Dùng chung cho mọi worker trên cùng máy (SQLite WAL)"""
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS refresh_tokens ("
+            " key TEXT PRIMARY KEY,"
+            " blob TEXT NOT NULL,"
+            " expires_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_expires_at ON refresh_tokens (expires_at)"
+        )
+
+    def _conn(self):
+        # Mỗi thread một connection; sau khi gunicorn fork thì mở connection mới
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            local.conn = conn
+            local.pid = os.getpid()
+        return conn
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM refresh_tokens").fetchone()[0]
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT blob FROM refresh_tokens WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, blob, ttl):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO refresh_tokens (key, blob, expires_at) VALUES (?, ?, ?)",
+            (key, blob, time.time() + ttl)
+        )
+
+    def pop(self, key):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT blob FROM refresh_tokens WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+            conn.execute("DELETE FROM refresh_tokens WHERE key = ?", (key,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row[0] if row else None
+
+    def delete(self, key):
+        return self._conn().execute("DELETE FROM refresh_tokens WHERE key = ?", (key,)).rowcount > 0
+
+    def expire(self, now=None):
+        cursor = self._conn().execute(
+            "DELETE FROM refresh_tokens WHERE expires_at < ?", (time.time() if now is None else now,)
+        )
+        return cursor.rowcount
+
+
+class RedisRecordBackend:
+    """Dùng chung cho mọi instance, hết hạn bằng TTL của Redis"""
+
+    KEY_PREFIX = 'google_oauth:refresh:'
+
+    def __init__(self, url=None, max_connections=20, socket_timeout=2.0, client=None):
+        if client is not None:
+            self._client = client
+        else:
+            if redis is None:
+                raise RuntimeError("Backend redis cần cài đặt: pip install redis")
+            pool = redis.BlockingConnectionPool.from_url(
+                url or DEFAULT_REDIS_URL,
+                max_connections=max_connections,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_timeout,
+                timeout=socket_timeout
+            )
+            self._client = redis.Redis(connection_pool=pool)
+
+    def __len__(self):
+        return sum(1 for _ in self._client.scan_iter(match=self.KEY_PREFIX + '*', count=1000))
+
+    def get(self, key):
+        raw = self._client.get(self.KEY_PREFIX + key)
+        return raw.decode('ascii') if isinstance(raw, bytes) else raw
+
+    def set(self, key, blob, ttl):
+        self._client.set(self.KEY_PREFIX + key, blob, ex=max(1, int(ttl)))
+
+    def pop(self, key):
+        pipe = self._client.pipeline(transaction=True)
+        pipe.get(self.KEY_PREFIX + key)
+        pipe.delete(self.KEY_PREFIX + key)
+        raw, _ = pipe.execute()
+        return raw.decode('ascii') if isinstance(raw, bytes) else raw
+
+    def delete(self, key):
+        return self._client.delete(self.KEY_PREFIX + key) > 0
+
+    def expire(self, now=None):
+        return 0
+
+
+# ============================================
+# KHO REFRESH TOKEN
+# ============================================
+
+class RefreshTokenStore:
+    """
+    Bản ghi (đã mã hóa) theo (email, machine_id): refresh_token, email, name, hash của remember_token
+    Chỉ lưu hash của remember_token - lộ kho (kể cả có key) cũng không dùng được để đăng nhập
+    """
+
+    STAGED_PREFIX = 'staged:'
+
+    def __init__(self, backend, cipher, ttl=DEFAULT_TTL, staging_ttl=DEFAULT_STAGING_TTL):
+        self.backend = backend
+        self.cipher = cipher
+        self.ttl = ttl
+        self.staging_ttl = staging_ttl
+        self.activated_total = 0
+        self.rejected_total = 0
+
+    def __len__(self):
+        return len(self.backend)
+
+    @staticmethod
+    def record_key(email, machine_id):
+        return _hash(f"{email.strip().lower()}\0{machine_id}")
+
+    def _save(self, key, record, ttl):
+        blob = self.cipher.encrypt(json.dumps(record, separators=(',', ':')).encode('utf-8'), key.encode('ascii'))
+        self.backend.set(key, blob, ttl)
+
+    def _load(self, key, blob):
+        if blob is None:
+            return None
+        plaintext = self.cipher.decrypt(blob, key.encode('ascii'))
+        return json.loads(plaintext) if plaintext is not None else None
+
+    def stage(self, email, machine_id, refresh_token, name=''):
+        """Lưu tạm refresh token nhận được ở callback, chờ verify thành công mới kích hoạt"""
+        key = self.STAGED_PREFIX + self.record_key(email, machine_id)
+        self._save(key, {'refresh_token': refresh_token, 'email': email, 'name': name}, self.staging_ttl)
+
+    def activate(self, email, machine_id):
+        """Kích hoạt bản lưu tạm (nếu có) và trả về remember_token mới cho app, None nếu không có gì"""
+        staged_key = self.STAGED_PREFIX + self.record_key(email, machine_id)
+        record = self._load(staged_key, self.backend.pop(staged_key))
+        if record is None:
+            return None
+        remember_token = secrets.token_urlsafe(32)
+        record['remember_hash'] = _hash(remember_token)
+        self._save(self.record_key(email, machine_id), record, self.ttl)
+        self.activated_total += 1
+        return remember_token
+
+    def check(self, email, machine_id, remember_token):
+        """Bản ghi đã giải mã nếu remember_token khớp, ngược lại None"""
+        key = self.record_key(email, machine_id)
+        record = self._load(key, self.backend.get(key))
+        if record is None or not hmac.compare_digest(record.get('remember_hash', ''), _hash(remember_token)):
+            self.rejected_total += 1
+            return None
+        return record
+
+    def update(self, email, machine_id, record):
+        """Ghi lại bản ghi (vd Google trả refresh token mới) và gia hạn TTL tính từ lần dùng này"""
+        self._save(self.record_key(email, machine_id), record, self.ttl)
+
+    def delete(self, email, machine_id):
+        """Xóa bản ghi (Google thu hồi token hoặc user đăng xuất)"""
+        return self.backend.delete(self.record_key(email, machine_id))
+
+    def expire(self, now=None):
+        return self.backend.expire(now)
+
+
+def create_refresh_token_store(keys, backend='memory', ttl=DEFAULT_TTL, staging_ttl=DEFAULT_STAGING_TTL,
+                               path=None, url=None):
+    """Tạo kho refresh token theo cấu hình (memory | sqlite | redis)"""
+    if backend == 'memory':
+        record_backend = MemoryRecordBackend()
+    elif backend == 'sqlite':
+        record_backend = SQLiteRecordBackend(path or DEFAULT_SQLITE_PATH)
+    elif backend == 'redis':
+        record_backend = RedisRecordBackend(url)
+    else:
+        raise ValueError(f"Backend refresh token store không hợp lệ: {backend}")
+    return RefreshTokenStore(record_backend, TokenCipher(keys), ttl=ttl, staging_ttl=staging_ttl)
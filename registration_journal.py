@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Đăng ký ghi trước, gửi sau (write-behind) cho /api/register của server admin
+- verify ghi yêu cầu đăng ký vào journal trên đĩa (fsync) rồi trả token cho user ngay
+- RegistrationFlusher gửi các yêu cầu đang chờ theo micro-batch, thử lại với backoff,
+  mỗi yêu cầu mang idempotency key cố định để server admin bỏ qua lần gửi trùng
+- Mỗi process ghi file journal riêng và giữ flock trên file đó; process chết (worker bị thay,
+  server restart) thì file của nó hết bị lock và process khác nhận lại (replay) các yêu cầu chưa gửi
+
+Định dạng journal: mỗi dòng một JSON
+    {"op": "register", "id": "<idempotency key>", "data": {...}, "ts": ...}
+    {"op": "done", "ids": [...], "outcome": "ok" | "rejected" | "dead"}
+Yêu cầu gửi lỗi quá max_attempts lần được chuyển sang file dead-letter (cùng thư mục, không bị replay)
+để xử lý tay, thay vì thử lại mãi
+"""
+
+import fcntl
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from structured_log import StructuredLogger
+
+JOURNAL_PREFIX = 'journal-'
+JOURNAL_SUFFIX = '.log'
+# Mọi process ghi chung một file dead-letter (tên không khớp JOURNAL_PREFIX nên không bị replay)
+DEAD_LETTER_NAME = 'dead-letter.jsonl'
+# Ghi lại file (chỉ giữ yêu cầu chưa gửi) khi file lớn hơn ngưỡng này
+DEFAULT_COMPACT_BYTES = 4 * 1024 * 1024
+
+
+def _read_pending(fileobj):
+    """Các yêu cầu chưa có bản ghi done trong file; dòng cuối bị cắt dở (crash khi đang ghi) bị bỏ qua"""
+    pending = OrderedDict()
+    for line in fileobj:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get('op') == 'register':
+            pending[record['id']] = record['data']
+        elif record.get('op') == 'done':
+            for entry_id in record.get('ids', ()):
+                pending.pop(entry_id, None)
+    return pending
+
+
+class RegistrationJournal:
+    """
+    Journal append-only của process hiện tại. append() chỉ trả về sau khi dòng đã được fsync;
+    nhiều thread append cùng lúc dùng chung một lần fsync (group commit)
+    """
+
+    def __init__(self, directory, fsync=True, compact_bytes=DEFAULT_COMPACT_BYTES):
+        self.directory = directory
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes
+        self.appended_total = 0
+        self.syncs_total = 0
+        self.replayed_total = 0
+        self.dead_lettered_total = 0
+        self._pid = None
+
+    def _reset(self):
+        # Gọi lại sau fork: file và lock của process cha không thuộc về worker này
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # id -> data, theo thứ tự ghi
+        self._buffer = []
+        self._next_seq = 0
+        self._durable_seq = 0
+        self._syncing = False
+        self._failed = []  # [(seq đầu, seq cuối, lỗi)] của các lần ghi thất bại gần đây
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._pid = os.getpid()
+
+    def _ensure_open(self):
+        """Mở file journal của process (gọi khi đang giữ self._cond)"""
+        if self._file is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{JOURNAL_PREFIX}{os.getpid()}-{secrets.token_hex(4)}{JOURNAL_SUFFIX}")
+        fileobj = open(path, 'a', encoding='utf-8')
+        fcntl.flock(fileobj, fcntl.LOCK_EX)
+        self._file, self._path, self._size = fileobj, path, 0
+
+    def open(self):
+        """Mở journal trong process hiện tại và nhận lại yêu cầu của các process đã chết"""
+        if self._pid != os.getpid():
+            self._reset()
+        with self._cond:
+            self._ensure_open()
+        return self.claim_orphans()
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        if self._pid != os.getpid():
+            return 0
+        with self._cond:
+            return len(self._pending)
+
+    def pending(self, limit=None):
+        """[(id, data)] đang chờ gửi, cũ nhất trước"""
+        if self._pid != os.getpid():
+            return []
+        with self._cond:
+            items = list(self._pending.items())
+        return items[:limit] if limit else items
+
+    def _write_lines(self, lines):
+        """Ghi + fsync ngoài lock (các thread khác vẫn đưa dòng mới vào buffer trong lúc chờ đĩa)"""
+        data = ''.join(lines)
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.syncs_total += 1
+        return len(data.encode('utf-8'))
+
+    def _commit(self, line):
+        """Đưa một dòng vào buffer và chờ tới khi nó đã nằm trên đĩa (group commit)"""
+        self._buffer.append(line)
+        self._next_seq += 1
+        seq = self._next_seq
+        while self._durable_seq < seq:
+            if self._syncing:
+                self._cond.wait()
+                continue
+            # Thread này ghi giúp mọi dòng đang có trong buffer
+            self._syncing = True
+            lines, self._buffer = self._buffer, []
+            first, last = self._durable_seq + 1, self._next_seq
+            self._cond.release()
+            error = None
+            try:
+                written = self._write_lines(lines)
+            except Exception as e:
+                error, written = e, 0
+            finally:
+                self._cond.acquire()
+            self._syncing = False
+            self._size += written
+            self._durable_seq = last
+            if error is not None:
+                self._failed = (self._failed + [(first, last, error)])[-16:]
+            self._cond.notify_all()
+        for first, last, error in self._failed:
+            if first <= seq <= last:
+                raise error
+
+    def append(self, data, entry_id=None):
+        """Ghi một yêu cầu đăng ký (đã fsync khi trả về); trả về idempotency key. Lỗi ghi được ném lại"""
+        entry_id = entry_id or secrets.token_hex(16)
+        self._append_entries([(entry_id, data)])
+        return entry_id
+
+    def _append_entries(self, entries):
+        """Ghi nhiều yêu cầu [(id, data)] bằng một lần fsync"""
+        if self._pid != os.getpid():
+            self.open()
+        now = time.time()
+        lines = ''.join(json.dumps({'op': 'register', 'id': entry_id, 'data': data, 'ts': now},
+                                   ensure_ascii=False, separators=(',', ':')) + '\n'
+                        for entry_id, data in entries)
+        with self._cond:
+            self._ensure_open()
+            self._pending.update(entries)
+            try:
+                self._commit(lines)
+            except Exception:
+                for entry_id, _ in entries:
+                    self._pending.pop(entry_id, None)
+                raise
+        self.appended_total += len(entries)
+
+    def mark_done(self, entry_ids, outcome='ok'):
+        """Ghi nhận đã gửi xong (hoặc bị từ chối hẳn); mất dòng này chỉ khiến yêu cầu được gửi lại"""
+        entry_ids = list(entry_ids)
+        if not entry_ids:
+            return
+        line = json.dumps({'op': 'done', 'ids': entry_ids, 'outcome': outcome}, separators=(',', ':')) + '\n'
+        with self._cond:
+            for entry_id in entry_ids:
+                self._pending.pop(entry_id, None)
+            self._commit(line)
+            if self._size >= self.compact_bytes:
+                self._compact()
+
+    def dead_letter(self, entries, attempts):
+        """
+        Chuyển [(id, data)] sang file dead-letter (fsync) rồi đánh dấu xong trong journal.
+        Crash giữa hai bước chỉ khiến yêu cầu được gửi lại và có thể nằm hai lần trong file dead-letter
+        """
+        entries = list(entries)
+        if not entries:
+            return
+        now = time.time()
+        lines = ''.join(json.dumps({'id': entry_id, 'data': data, 'attempts': attempts.get(entry_id), 'ts': now},
+                                   ensure_ascii=False, separators=(',', ':')) + '\n'
+                        for entry_id, data in entries)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, DEAD_LETTER_NAME), 'a', encoding='utf-8') as fileobj:
+            fcntl.flock(fileobj, fcntl.LOCK_EX)
+            fileobj.write(lines)
+            fileobj.flush()
+            if self.fsync:
+                os.fsync(fileobj.fileno())
+        self.mark_done([entry_id for entry_id, _ in entries], 'dead')
+        self.dead_lettered_total += len(entries)
+
+    def _compact(self):
+        """Ghi file mới chỉ gồm yêu cầu chưa gửi rồi rename đè file cũ (gọi khi đang giữ self._cond)"""
+        while self._syncing:
+            self._cond.wait()
+        tmp_path = self._path + '.compact'
+        fileobj = open(tmp_path, 'w', encoding='utf-8')
+        fcntl.flock(fileobj, fcntl.LOCK_EX)
+        for entry_id, data in self._pending.items():
+            fileobj.write(json.dumps({'op': 'register', 'id': entry_id, 'data': data, 'ts': time.time()},
+                                     ensure_ascii=False, separators=(',', ':')) + '\n')
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+        os.replace(tmp_path, self._path)
+        old, self._file = self._file, fileobj
+        self._size = fileobj.tell()
+        old.close()
+
+    def claim_orphans(self):
+        """Nhận lại yêu cầu chưa gửi từ file journal của process đã chết; trả về số yêu cầu nhận được"""
+        claimed = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not (name.startswith(JOURNAL_PREFIX) and name.endswith(JOURNAL_SUFFIX)) or path == self._path:
+                continue
+            try:
+                fileobj = open(path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            with fileobj:
+                try:
+                    fcntl.flock(fileobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # Process chủ còn sống
+                try:
+                    # File có thể vừa bị process chủ compact (rename) sau khi mình mở
+                    if os.fstat(fileobj.fileno()).st_ino != os.stat(path).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+                # Ghi sang journal của mình (giữ nguyên idempotency key) trước khi xóa file cũ
+                entries = list(_read_pending(fileobj).items())
+                if entries:
+                    self._append_entries(entries)
+                    claimed += len(entries)
+                os.unlink(path)
+        self.replayed_total += claimed
+        return claimed
+
+    def stats(self):
+        return {'path': self._path, 'pending': len(self), 'appended': self.appended_total,
+                'syncs': self.syncs_total, 'replayed': self.replayed_total,
+                'dead_lettered': self.dead_lettered_total}
+
+
+class RegistrationFlusher:
+    """
+    Thread nền gửi yêu cầu trong journal: mỗi lượt lấy tối đa batch_size yêu cầu đến hạn,
+    send(batch) trả về {id: 'ok' | 'rejected' | 'retry'}; 'retry' được thử lại theo exponential backoff,
+    sau max_attempts lần (0 = không giới hạn) thì chuyển sang dead-letter của journal
+    """
+
+    def __init__(self, journal, send, batch_size=32, interval=1.0, base_backoff=1.0, max_backoff=60.0,
+                 orphan_check_interval=60.0, max_attempts=50, logger=None):
+        self.journal = journal
+        self.send = send
+        self.batch_size = batch_size
+        self.interval = interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.orphan_check_interval = orphan_check_interval
+        self.max_attempts = max_attempts
+        # Mặc định ghi thẳng ra stdout (như khi dùng riêng module); server truyền logger chung
+        self.logger = logger or StructuredLogger(asynchronous=False)
+        self.flushed_total = 0
+        self.rejected_total = 0
+        self.retried_total = 0
+        self.batches_total = 0
+        self._retry_at = {}  # id -> (số lần thử, thời điểm được thử lại)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def notify(self):
+        """Có yêu cầu mới: gửi ngay thay vì chờ hết interval"""
+        self._wakeup.set()
+
+    def _due(self):
+        now = time.monotonic()
+        batch = []
+        for entry_id, data in self.journal.pending():
+            retry = self._retry_at.get(entry_id)
+            if retry is None or retry[1] <= now:
+                batch.append((entry_id, data))
+                if len(batch) >= self.batch_size:
+                    break
+        return batch
+
+    def flush_once(self):
+        """Gửi một micro-batch; trả về số yêu cầu đã gửi thử"""
+        batch = self._due()
+        if not batch:
+            return 0
+        outcomes = self.send(batch)
+        done = [entry_id for entry_id, _ in batch if outcomes.get(entry_id) == 'ok']
+        rejected = [entry_id for entry_id, _ in batch if outcomes.get(entry_id) == 'rejected']
+        self.journal.mark_done(done, 'ok')
+        self.journal.mark_done(rejected, 'rejected')
+        now = time.monotonic()
+        dead, dead_attempts = [], {}
+        for entry_id, data in batch:
+            if entry_id in done or entry_id in rejected:
+                self._retry_at.pop(entry_id, None)
+                continue
+            attempts = self._retry_at.get(entry_id, (0, 0))[0] + 1
+            if self.max_attempts and attempts >= self.max_attempts:
+                dead.append((entry_id, data))
+                dead_attempts[entry_id] = attempts
+                continue
+            delay = min(self.max_backoff, self.base_backoff * 2 ** (attempts - 1))
+            self._retry_at[entry_id] = (attempts, now + delay * random.uniform(0.5, 1.0))
+            self.retried_total += 1
+        if dead:
+            self.journal.dead_letter(dead, dead_attempts)
+            for entry_id, data in dead:
+                self._retry_at.pop(entry_id, None)
+                self.logger.error('register_dead_letter', entry=entry_id, email=data.get('email'),
+                                  attempts=dead_attempts[entry_id])
+        self.flushed_total += len(done)
+        self.rejected_total += len(rejected)
+        self.batches_total += 1
+        return len(batch)
+
+    def next_retry_in(self):
+        if not self._retry_at:
+            return None
+        return max(0.0, min(at for _, at in self._retry_at.values()) - time.monotonic())
+
+    def _run(self):
+        last_orphan_check = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                # Gửi liên tục khi còn yêu cầu đến hạn, mỗi lượt một micro-batch
+                while not self._stop.is_set() and self.flush_once():
+                    pass
+                if time.monotonic() - last_orphan_check >= self.orphan_check_interval:
+                    last_orphan_check = time.monotonic()
+                    self.journal.claim_orphans()
+            except Exception as e:
+                self.logger.exception('register_flush_error', error=str(e))
+            wait = self.interval
+            retry_in = self.next_retry_in()
+            if retry_in is not None:
+                wait = min(wait, retry_in)
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='register-flush', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """Dừng thread; yêu cầu chưa gửi vẫn nằm trong journal và được replay khi khởi động lại"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {'flushed': self.flushed_total, 'rejected': self.rejected_total,
+                'retried': self.retried_total, 'batches': self.batches_total}
@@ -4,15 +4,41 @@ Ví dụ Server Google OAuth cho Video Translator
 Cần cài đặt: pip install flask requests
 """
 
-from flask import Flask, request, jsonify, redirect, session
+from flask import Flask, request, jsonify, redirect
 import secrets
+import hmac
+import json
 import time
-import requests
 import threading
 import os
+import math
+import functools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from werkzeug.http import dump_cookie
+
+from code_allocator import DIGITS, CodeAllocator, CodeSpaceExhausted
+from device_flow import LongPollWaiters, device_key, is_valid_handle, new_device_handle
+from google_id_token import GoogleJWKSCache, IdTokenError, verify_id_token
+from html_pages import PageTemplate, StaticResponse, compress_body
+from metrics import REGISTRY
+from oauth_state import OAuthStateSigner, load_state_keys
+from profiling import AllocationTracker, ProfileBusy, SamplingProfiler, collapsed_stacks
+from rate_limit import create_rate_limiter
+from refresh_tokens import create_refresh_token_store, load_refresh_token_keys
+from registration_journal import RegistrationFlusher, RegistrationJournal
+from structured_log import StructuredLogger
+from upstream_client import (
+    Bulkhead, BulkheadFull, CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded, KeepWarmScheduler,
+    SingleFlight, TTLCache, UpstreamCall, UpstreamClient, run_upstream_steps
+)
+from verification_store import VerificationSnapshotter, create_verification_store
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(32)  # Secret key cho session
+# Secret key cho session - set FLASK_SECRET_KEY để mọi worker dùng chung
+app.secret_key = os.getenv('FLASK_SECRET_KEY') or secrets.token_hex(32)
 
 # ============================================
 # CẤU HÌNH GOOGLE OAUTH
@@ -67,10 +93,843 @@ if not GOOGLE_REDIRECT_URI:
         GOOGLE_REDIRECT_URI = "http://localhost:3000/api/google-callback"
         print("⚠️  CẢNH BÁO: GOOGLE_REDIRECT_URI chưa được set, sử dụng giá trị mặc định cho local: http://localhost:3000/api/google-callback")
 
+# ============================================
+# LOGGING (JSON lines qua hàng đợi, ghi bởi thread nền)
+# ============================================
+# LOG_LEVEL: debug/info/warning/error
+# LOG_QUEUE_SIZE + LOG_DROP_POLICY (newest/oldest): hàng đợi đầy thì bỏ bản ghi thay vì chặn request
+# LOG_DEBUG_SAMPLE_RATE: tỉ lệ giữ lại các dòng debug (0.0 - 1.0)
+# LOG_MASK=0 để tắt che email/mã xác minh (chỉ nên dùng khi debug local)
+logger = StructuredLogger(
+    level=os.getenv('LOG_LEVEL', 'info'),
+    max_queue=int(os.getenv('LOG_QUEUE_SIZE', 10000)),
+    drop_policy=os.getenv('LOG_DROP_POLICY', 'newest'),
+    debug_sample_rate=float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.1)),
+    mask=os.getenv('LOG_MASK', '1') != '0',
+    enabled=os.getenv('LOG_ENABLED', '1') != '0'
+)
+
+# ============================================
+# UPSTREAM (Google + server admin) - pool kết nối keep-alive dùng chung
+# ============================================
+GOOGLE_AUTH_URL = os.getenv('GOOGLE_AUTH_URL', 'https://accounts.google.com/o/oauth2/v2/auth')
+GOOGLE_TOKEN_URL = os.getenv('GOOGLE_TOKEN_URL', 'https://oauth2.googleapis.com/token')
+GOOGLE_USERINFO_URL = os.getenv('GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v2/userinfo')
+GOOGLE_JWKS_URL = os.getenv('GOOGLE_JWKS_URL', 'https://www.googleapis.com/oauth2/v3/certs')
+ADMIN_SERVER_URL = os.getenv('ADMIN_SERVER_URL', 'https://web-admin-srt212.onrender.com').rstrip('/')
+
+# Kích thước pool tính cho mỗi worker (mỗi host giữ tối đa UPSTREAM_POOL_MAXSIZE kết nối)
+upstream = UpstreamClient(
+    pool_connections=int(os.getenv('UPSTREAM_POOL_CONNECTIONS', 10)),
+    pool_maxsize=int(os.getenv('UPSTREAM_POOL_MAXSIZE', 10))
+)
+
+# Giữ server admin luôn thức bằng thread nền thay vì ping trước mỗi lần verify
+# ADMIN_KEEP_WARM_INTERVAL=0 để tắt ping định kỳ (vẫn đánh thức khi server cold)
+# ADMIN_KEEP_WARM_LOCK: file lock để chỉ 1 worker trên mỗi máy ping theo lịch
+ADMIN_KEEP_WARM_INTERVAL = int(os.getenv('ADMIN_KEEP_WARM_INTERVAL', 240))
+admin_keep_warm = KeepWarmScheduler(
+    upstream,
+    f"{ADMIN_SERVER_URL}/ping",
+    interval=ADMIN_KEEP_WARM_INTERVAL,
+    warm_window=int(os.getenv('ADMIN_WARM_WINDOW', 600)),
+    leader_lock_path=os.getenv('ADMIN_KEEP_WARM_LOCK')
+)
+
+# Circuit breaker cho từng endpoint của server admin: server sập thì verify báo lỗi ngay
+# thay vì giữ worker chờ timeout. ADMIN_BREAKER_FAILURES lỗi liên tiếp (timeout, lỗi kết nối, 5xx)
+# thì ngừng gọi trong ADMIN_BREAKER_RESET giây, sau đó cho một lời gọi thử
+admin_breakers = {
+    name: CircuitBreaker(
+        f'admin_{name}',
+        failure_threshold=int(os.getenv('ADMIN_BREAKER_FAILURES', 5)),
+        reset_timeout=float(os.getenv('ADMIN_BREAKER_RESET', 30))
+    )
+    for name in ('check_machine', 'login', 'register')
+}
+
+# Giới hạn số lời gọi đồng thời tới từng upstream trong mỗi worker (0 = không giới hạn)
+# Đủ giới hạn thì tối đa UPSTREAM_QUEUE_SIZE lời gọi được chờ UPSTREAM_QUEUE_TIMEOUT giây, còn lại báo lỗi ngay
+upstream_bulkheads = {
+    name: Bulkhead(
+        name,
+        max_concurrent=int(os.getenv(f'{name.upper()}_MAX_CONCURRENT', default)),
+        max_queue=int(os.getenv('UPSTREAM_QUEUE_SIZE', 4)),
+        queue_timeout=float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', 0.5))
+    )
+    for name, default in (('google', 16), ('admin', 8))
+}
+
+# Tổng thời gian tối đa (giây) cho mỗi request, chia cho các lời gọi upstream còn lại
+# (mỗi lời gọi vẫn không quá 30 giây như trước)
+CALLBACK_DEADLINE = float(os.getenv('CALLBACK_DEADLINE', 20))
+VERIFY_DEADLINE = float(os.getenv('VERIFY_DEADLINE', 20))
+
+# Khóa công khai của Google để xác minh id_token tại chỗ (thay cho lời gọi userinfo)
+# GOOGLE_ID_TOKEN_LOCAL=0 để luôn gọi userinfo như trước
+GOOGLE_ID_TOKEN_LOCAL = os.getenv('GOOGLE_ID_TOKEN_LOCAL', '1') == '1'
+google_jwks = GoogleJWKSCache(upstream, GOOGLE_JWKS_URL, logger=logger)
+
+# Cache kết quả /api/check-machine theo machine_id (client thường thử lại sau khi gõ sai mã)
+# Xóa entry khi login/register thành công; cache riêng mỗi worker nên TTL phải ngắn
+machine_check_cache = TTLCache(
+    ttl=int(os.getenv('MACHINE_CHECK_CACHE_TTL', 30)),
+    maxsize=int(os.getenv('MACHINE_CHECK_CACHE_SIZE', 10000))
+)
+
+# App desktop gửi lại verify (retry, mạng chậm) với cùng auth_code: các lần gửi trùng đang chạy
+# đồng thời chờ và dùng chung kết quả của lần đầu (chỉ 1 chuỗi check-machine + login/register).
+# Không giữ kết quả sau khi xong: kết quả thành công chứa auth_token, lần gửi đến muộn với cùng
+# auth_code + machine_id không được nhận lại token đó (mã đã bị dùng -> 400).
+# Chỉ gộp trong một worker - lần gửi trùng rơi vào worker khác vẫn chạy riêng
+verify_flights = SingleFlight()
+
+# Prefetch /api/check-machine ngay khi callback xong (user còn đang đọc mã 6 số)
+# Kết quả nằm trong machine_check_cache của worker xử lý callback, sống bằng thời hạn của mã
+MACHINE_PREFETCH_TTL = int(os.getenv('MACHINE_PREFETCH_TTL', 300))
+machine_prefetch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('MACHINE_PREFETCH_WORKERS', 4)),
+    thread_name_prefix='machine-prefetch'
+)
+
+# ============================================
+# OAUTH STATE (ký HMAC, không phụ thuộc session của worker)
+# ============================================
+# OAUTH_STATE_KEYS="key-mới,key-cũ": ký bằng key đầu, key cũ vẫn được chấp nhận khi xoay key
+OAUTH_STATE_KEYS = load_state_keys()
+oauth_state_signer = OAuthStateSigner(
+    OAUTH_STATE_KEYS,
+    max_age=int(os.getenv('OAUTH_STATE_MAX_AGE', 600))
+)
+
+# Luồng trình duyệt: nonce của state nằm trong cookie ngắn hạn, callback phải khớp (chống login CSRF)
+# Device flow không dùng cookie (trình duyệt đăng nhập khác app poll), state gắn với handle/machine_id
+OAUTH_STATE_COOKIE = 'oauth_state'
+OAUTH_STATE_COOKIE_PATH = '/api/google-callback'
+# Cookie Secure khi callback chạy trên https (trình duyệt không gửi cookie Secure qua http)
+OAUTH_STATE_COOKIE_SECURE = GOOGLE_REDIRECT_URI.startswith('https://')
+
+def oauth_state_cookie(nonce):
+    """Header Set-Cookie cho nonce của state; nonce rỗng = xóa cookie"""
+    return dump_cookie(
+        OAUTH_STATE_COOKIE, nonce or '',
+        max_age=oauth_state_signer.max_age if nonce else 0,
+        path=OAUTH_STATE_COOKIE_PATH,
+        secure=OAUTH_STATE_COOKIE_SECURE,
+        httponly=True,
+        samesite='Lax'
+    )
+
 # ============================================
 # LƯU TRỮ TẠM THỜI (Nên dùng Redis trong production)
 # ============================================
-verification_store = {}  # {code: {email, name, access_token, expires_at}}
+# {code: VerificationEntry(email, name, expires_at)} - hết hạn theo timing wheel, có giới hạn số mã
+# VERIFICATION_STORE_BACKEND:
+# - memory (mặc định): mỗi worker một kho riêng, chỉ dùng được với 1 worker
+# - sqlite: mọi worker gunicorn trên cùng máy dùng chung file VERIFICATION_STORE_PATH
+# - redis: mọi instance dùng chung Redis tại VERIFICATION_STORE_URL (hoặc REDIS_URL)
+VERIFICATION_CODE_TTL = 300  # 5 phút
+verification_store = create_verification_store(
+    backend=os.getenv('VERIFICATION_STORE_BACKEND', 'memory'),
+    ttl=VERIFICATION_CODE_TTL,
+    max_entries=int(os.getenv('VERIFICATION_STORE_MAX_ENTRIES', 100000)),
+    path=os.getenv('VERIFICATION_STORE_PATH'),
+    url=os.getenv('VERIFICATION_STORE_URL') or os.getenv('REDIS_URL')
+)
+# VERIFICATION_SNAPSHOT_PATH (chỉ backend memory): khi tắt worker (SIGTERM khi deploy/restart) ghi các mã
+# còn hạn ra file, worker mới nạp lại trong nền - user đang ở trang mã xác minh không phải đăng nhập lại.
+# File phải nằm trên đĩa còn giữ qua deploy (Render: persistent disk). VERIFICATION_SNAPSHOT_INTERVAL > 0:
+# ghi thêm mỗi N giây để còn mã khi process bị kill -9 (mã đã dùng sau lần ghi cuối có thể dùng lại được)
+verification_snapshots = VerificationSnapshotter(
+    verification_store,
+    path=os.getenv('VERIFICATION_SNAPSHOT_PATH') or None,
+    interval=float(os.getenv('VERIFICATION_SNAPSHOT_INTERVAL', 0)),
+    logger=logger
+)
+
+# Cấp mã không trùng: bitmap các mã đang sống + store.add (không ghi đè mã của người khác)
+# VERIFICATION_CODE_LENGTH / VERIFICATION_CODE_ALPHABET: không gian mã chính (mặc định 6 chữ số)
+# Khi tỉ lệ mã đang sống vượt VERIFICATION_CODE_GROW_AT (mặc định 10%, đoán bừa 1 lần trúng 10%),
+# cấp mã VERIFICATION_CODE_OVERFLOW_LENGTH ký tự (alphabet VERIFICATION_CODE_OVERFLOW_ALPHABET)
+code_allocator = CodeAllocator(
+    verification_store,
+    VERIFICATION_CODE_TTL,
+    length=int(os.getenv('VERIFICATION_CODE_LENGTH', 6)),
+    alphabet=os.getenv('VERIFICATION_CODE_ALPHABET') or DIGITS,
+    grow_at=float(os.getenv('VERIFICATION_CODE_GROW_AT', 0.1)),
+    overflow_length=int(os.getenv('VERIFICATION_CODE_OVERFLOW_LENGTH', 8)),
+    overflow_alphabet=os.getenv('VERIFICATION_CODE_OVERFLOW_ALPHABET') or None
+)
+
+# ============================================
+# GHI NHỚ ĐĂNG NHẬP (refresh token của Google, mã hóa khi lưu)
+# ============================================
+# /api/google-auth?remember=1&machine_id=...: xin quyền offline (prompt=consent) để Google trả refresh token;
+# verify thành công thì app nhận thêm remember_token. Lần sau app gọi POST /api/google-auth/refresh
+# và server làm mới token với Google rồi đăng nhập server admin luôn, không mở trình duyệt.
+# Không có remember=1 thì dùng prompt=select_account (không hiện lại màn hình cấp quyền mỗi lần đăng nhập)
+# REFRESH_TOKEN_KEYS="key-mới,key-cũ": key mã hóa (mặc định dùng OAUTH_STATE_KEYS)
+# REFRESH_TOKEN_STORE_BACKEND: memory | sqlite (REFRESH_TOKEN_STORE_PATH) | redis (REFRESH_TOKEN_STORE_URL)
+# REMEMBER_LOGIN=0 để tắt hẳn (mọi lần đăng nhập đều qua trình duyệt)
+REMEMBER_LOGIN = os.getenv('REMEMBER_LOGIN', '1') == '1'
+refresh_tokens = create_refresh_token_store(
+    load_refresh_token_keys(OAUTH_STATE_KEYS),
+    backend=os.getenv('REFRESH_TOKEN_STORE_BACKEND', 'memory'),
+    ttl=int(os.getenv('REFRESH_TOKEN_TTL', 180 * 24 * 3600)),
+    staging_ttl=VERIFICATION_CODE_TTL,
+    path=os.getenv('REFRESH_TOKEN_STORE_PATH'),
+    url=os.getenv('REFRESH_TOKEN_STORE_URL') or os.getenv('REDIS_URL')
+)
+# Mã xác minh nội bộ của lượt đăng nhập bằng refresh token (không hiển thị cho user)
+REFRESH_CODE_PREFIX = 'refresh:'
+
+# ============================================
+# METRICS (Prometheus text format tại /metrics)
+# ============================================
+# METRICS_TOKEN: nếu set, /metrics yêu cầu header "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'google_oauth_request_seconds',
+    'Latency of upstream-bound endpoints by endpoint and HTTP status',
+    ('endpoint', 'status')
+)
+REGISTRY.gauge('google_oauth_verification_store_size', 'Pending verification codes',
+               lambda: len(verification_store))
+REGISTRY.callback_counter('google_oauth_verification_store_expired_total', 'Verification codes removed after expiry',
+                          lambda: verification_store.expired_total)
+REGISTRY.callback_counter('google_oauth_verification_store_evicted_total', 'Verification codes evicted by the size cap',
+                          lambda: verification_store.evicted_total)
+REGISTRY.callback_counter('google_oauth_verification_snapshot_restored_total',
+                          'Pending verification codes reloaded from the shutdown snapshot',
+                          lambda: verification_snapshots.restored_total)
+REGISTRY.gauge('google_oauth_verification_code_occupancy', 'Share of the primary code space held by live codes',
+               lambda: code_allocator.occupancy)
+REGISTRY.callback_counter('google_oauth_verification_code_collisions_total',
+                          'Allocated codes already held in the store (another worker or a restart)',
+                          lambda: code_allocator.collisions_total)
+REGISTRY.callback_counter('google_oauth_verification_code_overflow_total',
+                          'Codes issued from the longer overflow space', lambda: code_allocator.overflow_total)
+REGISTRY.callback_counter('google_oauth_machine_check_cache_hits_total', 'check-machine cache hits',
+                          lambda: machine_check_cache.hits)
+REGISTRY.callback_counter('google_oauth_machine_check_cache_misses_total', 'check-machine cache misses',
+                          lambda: machine_check_cache.misses)
+REGISTRY.callback_counter('google_oauth_upstream_connections_created_total', 'New upstream connections (TCP+TLS)',
+                          lambda: sum(c['connections_created'] for c in upstream.stats.snapshot().values()))
+REGISTRY.callback_counter('google_oauth_upstream_pool_hits_total', 'Upstream requests served by a pooled connection',
+                          lambda: sum(c['pool_hits'] for c in upstream.stats.snapshot().values()))
+REGISTRY.callback_counter('google_oauth_log_dropped_total', 'Log records dropped because the queue was full',
+                          lambda: logger.dropped_total)
+REGISTRY.callback_counter('google_oauth_circuit_opened_total', 'Times an admin circuit breaker opened',
+                          lambda: sum(b.opened_total for b in admin_breakers.values()))
+REGISTRY.callback_counter('google_oauth_circuit_rejected_total', 'Admin calls rejected by an open circuit breaker',
+                          lambda: sum(b.rejected_total for b in admin_breakers.values()))
+REGISTRY.callback_counter('google_oauth_verify_coalesced_total', 'Duplicate verify submissions that shared a running one',
+                          lambda: verify_flights.coalesced_total)
+REGISTRY.callback_counter('google_oauth_remember_activated_total', 'Refresh tokens activated after a successful verify',
+                          lambda: refresh_tokens.activated_total)
+REGISTRY.callback_counter('google_oauth_remember_rejected_total', 'Refresh logins rejected for an unknown remember token',
+                          lambda: refresh_tokens.rejected_total)
+REGISTRY.gauge('google_oauth_admin_server_warm', 'Admin server known to be warm (1) or cold (0)',
+               lambda: int(admin_keep_warm.is_warm))
+
+# ============================================
+# GIỚI HẠN ĐỒNG THỜI THEO ENDPOINT (bulkhead + từ chối khi quá tải)
+# ============================================
+# Endpoint gọi upstream không được chiếm hết thread của worker (gunicorn --threads / gevent):
+# /ping và /api/check-config luôn còn chỗ. Quá giới hạn + hàng chờ thì trả 503 + Retry-After ngay.
+# Long-poll của device flow giữ thread tới DEVICE_POLL_TIMEOUT giây: giới hạn riêng DEVICE_POLL_MAX_CONCURRENT,
+# không có hàng chờ (app poll lại sau Retry-After). Nên đặt CALLBACK_MAX_CONCURRENT + VERIFY_MAX_CONCURRENT
+# + REFRESH_MAX_CONCURRENT + DEVICE_POLL_MAX_CONCURRENT + 3 * ENDPOINT_QUEUE_SIZE < số thread mỗi worker
+RETRY_AFTER_SECONDS = int(os.getenv('RETRY_AFTER_SECONDS', 5))
+endpoint_bulkheads = {
+    'google_callback': Bulkhead(
+        'google_callback',
+        max_concurrent=int(os.getenv('CALLBACK_MAX_CONCURRENT', 8)),
+        max_queue=int(os.getenv('ENDPOINT_QUEUE_SIZE', 4)),
+        queue_timeout=float(os.getenv('ENDPOINT_QUEUE_TIMEOUT', 0.5))
+    ),
+    'verify_google_auth': Bulkhead(
+        'verify_google_auth',
+        max_concurrent=int(os.getenv('VERIFY_MAX_CONCURRENT', 8)),
+        max_queue=int(os.getenv('ENDPOINT_QUEUE_SIZE', 4)),
+        queue_timeout=float(os.getenv('ENDPOINT_QUEUE_TIMEOUT', 0.5))
+    ),
+    'google_auth_refresh': Bulkhead(
+        'google_auth_refresh',
+        max_concurrent=int(os.getenv('REFRESH_MAX_CONCURRENT', 8)),
+        max_queue=int(os.getenv('ENDPOINT_QUEUE_SIZE', 4)),
+        queue_timeout=float(os.getenv('ENDPOINT_QUEUE_TIMEOUT', 0.5))
+    ),
+    'google_auth_poll': Bulkhead(
+        'google_auth_poll',
+        max_concurrent=int(os.getenv('DEVICE_POLL_MAX_CONCURRENT', 8)),
+        max_queue=0
+    ),
+}
+
+REGISTRY.callback_counter('google_oauth_load_shed_total', 'Requests rejected with 503 by an endpoint bulkhead',
+                          lambda: sum(b.rejected_total for b in endpoint_bulkheads.values()))
+REGISTRY.callback_counter('google_oauth_upstream_bulkhead_rejected_total', 'Upstream calls rejected by a full bulkhead',
+                          lambda: sum(b.rejected_total for b in upstream_bulkheads.values()))
+
+OVERLOADED_MESSAGE = 'Server đang quá tải. Vui lòng thử lại sau ít giây.'
+OVERLOADED_HTML = f"""
+<html>
+<head><title>Server quá tải</title></head>
+<body style="font-family: Arial; text-align: center; padding: 50px;">
+    <h1 style="color: #ff6600;">⏳ Server đang quá tải</h1>
+    <p>{OVERLOADED_MESSAGE}</p>
+    <p>Tải lại trang này sau vài giây để tiếp tục đăng nhập.</p>
+</body>
+</html>
+"""
+
+def retry_after_headers():
+    return {'Retry-After': str(RETRY_AFTER_SECONDS)}
+
+def shed_load(endpoint, overloaded):
+    """Decorator: giới hạn request đồng thời của endpoint; quá tải thì trả overloaded() (503) ngay"""
+    bulkhead = endpoint_bulkheads[endpoint]
+    
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not bulkhead.acquire():
+                logger.warning('load_shed', endpoint=endpoint, active=bulkhead.active)
+                REQUEST_SECONDS.observe(0.0, endpoint, '503')
+                return overloaded()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                bulkhead.release()
+        return wrapper
+    return decorator
+
+# ============================================
+# GIỚI HẠN TẦN SUẤT NHẬP MÃ (token bucket theo IP và machine_id)
+# ============================================
+# Mã chỉ có 6 chữ số: giới hạn số lần thử trước khi tra store hay gọi server admin
+# VERIFY_RATE_PER_IP / VERIFY_RATE_PER_MACHINE: số lần/phút, *_BURST: số lần liên tiếp tối đa
+# RATE_LIMIT_BACKEND=redis để mọi worker/instance dùng chung bucket (mặc định memory, riêng mỗi worker)
+# TRUSTED_PROXY_HOPS: số proxy tin cậy phía trước (Render = 1) để lấy IP thật từ X-Forwarded-For
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', 0))
+verify_ip_limiter = create_rate_limiter(
+    RATE_LIMIT_BACKEND,
+    rate=float(os.getenv('VERIFY_RATE_PER_IP', 20)) / 60,
+    burst=int(os.getenv('VERIFY_BURST_PER_IP', 10)),
+    max_keys=int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000)),
+    url=os.getenv('RATE_LIMIT_REDIS_URL') or os.getenv('REDIS_URL'),
+    prefix='verify_ip:'
+)
+verify_machine_limiter = create_rate_limiter(
+    RATE_LIMIT_BACKEND,
+    rate=float(os.getenv('VERIFY_RATE_PER_MACHINE', 10)) / 60,
+    burst=int(os.getenv('VERIFY_BURST_PER_MACHINE', 5)),
+    max_keys=int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000)),
+    url=os.getenv('RATE_LIMIT_REDIS_URL') or os.getenv('REDIS_URL'),
+    prefix='verify_machine:'
+)
+
+REGISTRY.callback_counter('google_oauth_rate_limited_total', 'Verify attempts rejected by the rate limiter',
+                          lambda: verify_ip_limiter.rejected_total + verify_machine_limiter.rejected_total)
+
+def client_ip(remote_addr, forwarded_for):
+    """IP của client; sau proxy tin cậy thì lấy từ X-Forwarded-For, đếm từ phải sang"""
+    if TRUSTED_PROXY_HOPS and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return remote_addr or 'unknown'
+
+def verify_rate_limited(ip, data):
+    """Kiểm tra bucket theo IP rồi theo machine_id; trả về số giây phải chờ, None nếu được phép"""
+    machine_id = data.get('machine_id') if isinstance(data, dict) else None
+    checks = [(verify_ip_limiter, ip)]
+    if machine_id:
+        checks.append((verify_machine_limiter, str(machine_id)[:128]))
+    for limiter, key in checks:
+        allowed, retry_after = limiter.allow(key)
+        if not allowed:
+            # debug (được lấy mẫu): khi bị dò mã, mỗi lần thử không được sinh ra một dòng log
+            logger.debug('rate_limited', ip=ip, machine_id=machine_id, retry_after=round(retry_after, 1))
+            return retry_after
+    return None
+
+def rate_limited_payload(retry_after):
+    seconds = max(1, math.ceil(retry_after))
+    return {
+        'success': False,
+        'message': f'Bạn đã nhập mã quá nhiều lần. Vui lòng thử lại sau {seconds} giây.'
+    }, {'Retry-After': str(seconds)}
+
+def limit_verify_rate(view):
+    """Decorator: từ chối (429) trước khi tra mã hay gọi upstream; dùng cho verify, refresh và poll"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        ip = client_ip(request.remote_addr, request.headers.get('X-Forwarded-For'))
+        # Poll (GET) gửi machine_id trong query
+        data = request.get_json(silent=True) if request.method == 'POST' else request.args.to_dict()
+        retry_after = verify_rate_limited(ip, data)
+        if retry_after is not None:
+            payload, headers = rate_limited_payload(retry_after)
+            REQUEST_SECONDS.observe(0.0, view.__name__, '429')
+            return jsonify(payload), 429, headers
+        return view(*args, **kwargs)
+    return wrapper
+
+# ============================================
+# DEVICE FLOW (app desktop long-poll thay vì bắt user gõ mã)
+# ============================================
+# /api/google-auth?device=1 trả về handle, state chỉ mang device_key(handle, machine_id). Callback lưu thêm
+# mục DEVICE_CODE_PREFIX + device_key trỏ tới mã 6 số vừa cấp (link = mã) và đánh thức các request đang
+# chờ ở /api/google-auth/poll. Poll và mã gõ tay dùng chung một mã: dùng một đường thì đường kia hết hiệu lực
+# Nên chạy bằng worker async (async_server) hoặc gevent: worker sync giữ một thread cho mỗi request đang chờ
+DEVICE_CODE_PREFIX = 'device:'
+DEVICE_POLL_TIMEOUT = float(os.getenv('DEVICE_POLL_TIMEOUT', 30))
+# Store dùng chung (sqlite/redis): callback có thể chạy ở worker/instance khác nên không đánh thức được
+# request đang chờ ở đây - kiểm tra lại store sau mỗi DEVICE_POLL_RECHECK giây
+DEVICE_SHARED_STORE = os.getenv('VERIFICATION_STORE_BACKEND', 'memory') != 'memory'
+DEVICE_POLL_RECHECK = float(os.getenv('DEVICE_POLL_RECHECK', 2))
+device_waiters = LongPollWaiters()
+
+DEVICE_PENDING_PAYLOAD = {
+    'success': False,
+    'pending': True,
+    'message': 'Đang chờ đăng nhập Google'
+}
+DEVICE_INVALID_PAYLOAD = {
+    'success': False,
+    'message': 'Handle không hợp lệ'
+}
+DEVICE_USED_PAYLOAD = {
+    'success': False,
+    'message': 'Phiên đăng nhập đã được dùng hoặc đã hết hạn. Vui lòng đăng nhập lại.'
+}
+
+REGISTRY.gauge('google_oauth_device_waiters', 'Device-flow long-poll requests currently waiting',
+               lambda: len(device_waiters))
+
+def wake_restored_device_logins(codes):
+    """Snapshot vừa nạp xong: đánh thức app đang long-poll handle có mã trong snapshot"""
+    for code in codes:
+        if code.startswith(DEVICE_CODE_PREFIX):
+            device_waiters.notify(code[len(DEVICE_CODE_PREFIX):])
+
+verification_snapshots.on_restored = wake_restored_device_logins
+
+def device_poll_params(args):
+    """(device_key, dữ liệu verify, timeout) từ query của /api/google-auth/poll; key None = handle không hợp lệ"""
+    handle = args.get('handle')
+    if not is_valid_handle(handle):
+        return None, None, 0.0
+    try:
+        timeout = float(args.get('timeout', DEVICE_POLL_TIMEOUT))
+    except (TypeError, ValueError):
+        timeout = DEVICE_POLL_TIMEOUT
+    if not math.isfinite(timeout):
+        timeout = DEVICE_POLL_TIMEOUT
+    machine_id = args.get('machine_id', '')[:128]
+    key = device_key(handle, machine_id)
+    data = {'auth_code': DEVICE_CODE_PREFIX + key, 'machine_id': machine_id}
+    return key, data, min(max(timeout, 0.0), DEVICE_POLL_TIMEOUT)
+
+def device_wait_slice(remaining):
+    """Thời gian ngủ tối đa của một lần chờ"""
+    return min(remaining, DEVICE_POLL_RECHECK) if DEVICE_SHARED_STORE else remaining
+
+def device_login_ready(data):
+    """Callback đã hoàn tất: mã còn trong store, hoặc một lần poll khác đang verify (lần này chờ chung kết quả)"""
+    return data['auth_code'] in verification_store or verify_flights.in_flight(verify_flight_key(data))
+
+def wait_for_device_login(key, data, timeout):
+    """Chờ tới khi callback của device_key hoàn tất (không quay vòng); False nếu hết timeout"""
+    deadline = time.monotonic() + timeout
+    with device_waiters.waiter(key) as waiter:
+        while not device_login_ready(data):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            waiter.wait(device_wait_slice(remaining))
+    return True
+
+def device_verify_steps(data):
+    """Poll thấy callback đã xong: lấy mục device rồi verify mã 6 số nó trỏ tới như khi user tự gõ mã"""
+    try:
+        device_entry = verification_store.pop(data['auth_code'])
+    except Exception as e:
+        logger.exception('device_verify_error', error=str(e))
+        return {'success': False, 'message': f'Lỗi server: {str(e)}'}, 500
+    if not device_entry or not device_entry.link or device_entry.is_expired():
+        return DEVICE_USED_PAYLOAD, 400
+    # Mã đã được gõ tay (đã bị lấy khỏi kho) thì bước này trả 400: một lần đăng nhập chỉ một phiên
+    payload, status = yield from verify_and_remember_steps(
+        {'auth_code': device_entry.link, 'machine_id': data['machine_id']}
+    )
+    if status >= 500:
+        release_verification_code(data['auth_code'], device_entry)
+    return payload, status
+
+# ============================================
+# ĐĂNG KÝ GHI TRƯỚC, GỬI SAU (journal trên đĩa + gửi theo micro-batch)
+# ============================================
+# REGISTER_WRITE_BEHIND=1: user mới nhận token ngay sau khi yêu cầu đăng ký được ghi (fsync) vào journal
+# trong REGISTER_JOURNAL_DIR; thread nền gửi /api/register theo micro-batch (REGISTER_FLUSH_BATCH yêu cầu,
+# REGISTER_FLUSH_CONCURRENCY lời gọi song song), lỗi 5xx/kết nối thì thử lại với backoff.
+# Mỗi yêu cầu có idempotency key (header Idempotency-Key + trường idempotency_key) để server admin bỏ
+# lần gửi trùng. Journal của worker đã chết được worker khác replay - REGISTER_JOURNAL_DIR phải nằm trên
+# đĩa bền (Render: persistent disk), mọi worker trên máy dùng chung thư mục.
+# Server admin từ chối (vd máy đã đủ tài khoản) lúc gửi thì user đã có token: chỉ ghi log + metric
+# Gửi lỗi REGISTER_FLUSH_MAX_ATTEMPTS lần (0 = thử mãi) thì chuyển sang REGISTER_JOURNAL_DIR/dead-letter.jsonl
+REGISTER_WRITE_BEHIND = os.getenv('REGISTER_WRITE_BEHIND', '0') == '1'
+registration_journal = RegistrationJournal(
+    os.getenv('REGISTER_JOURNAL_DIR') or os.path.join(tempfile.gettempdir(), 'google_oauth_register_journal'),
+    fsync=os.getenv('REGISTER_JOURNAL_FSYNC', '1') != '0'
+)
+register_flush_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('REGISTER_FLUSH_CONCURRENCY', 8)),
+    thread_name_prefix='register-flush'
+)
+
+def send_registration(entry_id, register_data):
+    """Gửi một yêu cầu trong journal tới /api/register; 'ok' | 'rejected' (không thử lại) | 'retry'"""
+    result = upstream.call(UpstreamCall(
+        'POST', f"{ADMIN_SERVER_URL}/api/register", stage='admin_register_flush',
+        breaker=admin_breakers['register'], bulkhead=upstream_bulkheads['admin'],
+        json=dict(register_data, idempotency_key=entry_id),
+        headers={'Content-Type': 'application/json', 'Accept': 'application/json', 'Idempotency-Key': entry_id},
+        timeout=30
+    ))
+    email = register_data.get('email')
+    if result.error is not None or result.status_code >= 500 or result.status_code == 429:
+        logger.warning('admin_register_flush_retry', email=email, entry=entry_id,
+                       status=result.status_code, error=str(result.error) if result.error else None)
+        return 'retry'
+    admin_keep_warm.mark_warm()
+    if result.status_code == 200 and result.json().get('success'):
+        logger.info('admin_registered', email=email, machine_id=register_data.get('machine_id'), entry=entry_id)
+        machine_check_cache.invalidate(register_data.get('machine_id'))
+        return 'ok'
+    logger.error('admin_register_flush_rejected', email=email, entry=entry_id, status=result.status_code,
+                 response=result.text[:200])
+    return 'rejected'
+
+def flush_registrations(batch):
+    """Gửi một micro-batch [(id, register_data)] song song qua pool keep-alive; {id: kết quả}"""
+    # Đánh thức server admin một lần cho cả batch (thay vì mỗi lời gọi tự chờ timeout)
+    if not admin_breakers['register'].is_open:
+        admin_keep_warm.ensure_warm()
+    outcomes = register_flush_executor.map(lambda entry: send_registration(*entry), batch)
+    return {entry_id: outcome for (entry_id, _), outcome in zip(batch, outcomes)}
+
+registration_flusher = RegistrationFlusher(
+    registration_journal,
+    flush_registrations,
+    batch_size=int(os.getenv('REGISTER_FLUSH_BATCH', 32)),
+    interval=float(os.getenv('REGISTER_FLUSH_INTERVAL', 1)),
+    max_backoff=float(os.getenv('REGISTER_FLUSH_MAX_BACKOFF', 60)),
+    max_attempts=int(os.getenv('REGISTER_FLUSH_MAX_ATTEMPTS', 50)),
+    logger=logger
+)
+
+REGISTRY.gauge('google_oauth_register_pending', 'Registrations in the journal waiting to be sent to the admin server',
+               lambda: len(registration_journal))
+REGISTRY.callback_counter('google_oauth_register_flushed_total', 'Journaled registrations accepted by the admin server',
+                          lambda: registration_flusher.flushed_total)
+REGISTRY.callback_counter('google_oauth_register_rejected_total', 'Journaled registrations rejected by the admin server',
+                          lambda: registration_flusher.rejected_total)
+REGISTRY.callback_counter('google_oauth_register_retried_total', 'Journaled registration sends that will be retried',
+                          lambda: registration_flusher.retried_total)
+REGISTRY.callback_counter('google_oauth_register_dead_lettered_total',
+                          'Journaled registrations moved to the dead-letter file after too many failed sends',
+                          lambda: registration_journal.dead_lettered_total)
+
+def queue_registration(register_data):
+    """Ghi trước, gửi sau; False nếu chế độ này tắt hoặc không ghi được journal (verify gọi admin như cũ)"""
+    if not REGISTER_WRITE_BEHIND:
+        return False
+    try:
+        entry_id = registration_journal.append(register_data)
+    except Exception as journal_error:
+        logger.error('register_journal_error', error=str(journal_error))
+        return False
+    registration_flusher.notify()
+    logger.info('admin_register_queued', email=register_data['email'], machine_id=register_data['machine_id'],
+                entry=entry_id)
+    machine_check_cache.invalidate(register_data['machine_id'])
+    return True
+
+# ============================================
+# TRANG HTML (biên dịch một lần lúc khởi động, xem html_pages.py)
+# ============================================
+# Trang chủ không đổi suốt vòng đời process: ETag + bản gzip/brotli nén sẵn, trình duyệt hỏi lại nhận 304.
+# Trang callback chỉ điền email/tên/mã (đã escape HTML) rồi nén theo Accept-Encoding. Nén trang chứa mã
+# không mở đường cho BREACH: trang đó không phản chiếu dữ liệu nào do người ngoài kiểm soát
+INDEX_PRODUCTION = StaticResponse(
+    json.dumps({
+        'service': 'Google OAuth Server',
+        'status': 'running',
+        'version': '1.0.0',
+        'endpoints': {
+            'auth': '/api/google-auth',
+            'callback': '/api/google-callback',
+            'verify': '/api/verify-google-auth',
+            'ping': '/ping',
+            'check_config': '/api/check-config',
+            'metrics': '/metrics'
+        },
+        'note': 'This is an API server. Use the endpoints to interact with the service.'
+    }, sort_keys=True, separators=(',', ':')) + '\n',
+    'application/json'
+)
+INDEX_DEVELOPMENT_PAGE = PageTemplate("""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Google OAuth Server - Video Translator (DEV)</title>
+    <style>
+        body {{
+            font-family: Arial, sans-serif;
+            max-width: 800px;
+            margin: 50px auto;
+            padding: 20px;
+            background: #f5f5f5;
+        }}
+        .container {{
+            background: white;
+            padding: 30px;
+            border-radius: 10px;
+            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+        }}
+        h1 {{
+            color: #0066cc;
+        }}
+        .endpoint {{
+            background: #f0f0f0;
+            padding: 10px;
+            margin: 10px 0;
+            border-left: 4px solid #0066cc;
+        }}
+        .method {{
+            display: inline-block;
+            padding: 3px 8px;
+            background: #0066cc;
+            color: white;
+            border-radius: 3px;
+            font-weight: bold;
+            margin-right: 10px;
+        }}
+        .status {{
+            display: inline-block;
+            padding: 5px 10px;
+            background: #4CAF50;
+            color: white;
+            border-radius: 5px;
+            font-weight: bold;
+        }}
+        .dev-badge {{
+            background: #ff9800;
+            color: white;
+            padding: 5px 10px;
+            border-radius: 5px;
+            font-size: 12px;
+            margin-left: 10px;
+        }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>🔐 Google OAuth Server <span class="dev-badge">DEV MODE</span></h1>
+        <p class="status">✅ Server đang hoạt động</p>
+        <hr>
+        <h2>📋 Các Endpoint có sẵn:</h2>
+        
+        <div class="endpoint">
+            <span class="method">GET</span>
+            <strong>/api/google-auth</strong>
+            <p>Bắt đầu Google OAuth flow - Mở trình duyệt để đăng nhập Google</p>
+            <p><small>Query (tùy chọn): ?machine_id=... để kiểm tra máy trước trong lúc nhập mã</small></p>
+            <a href="/api/google-auth" target="_blank">🔗 Test ngay</a>
+        </div>
+        
+        <div class="endpoint">
+            <span class="method">GET</span>
+            <strong>/api/google-auth?device=1</strong>
+            <p>Cho app desktop: trả về JSON {{handle, auth_url, poll_url}} thay vì chuyển hướng</p>
+        </div>
+        
+        <div class="endpoint">
+            <span class="method">GET</span>
+            <strong>/api/google-auth/poll</strong>
+            <p>Long-poll tới khi đăng nhập Google của handle hoàn tất, trả về luôn kết quả xác minh (202 = chưa xong, gọi lại)</p>
+            <p><small>Query: ?handle=...&machine_id=...&timeout=30</small></p>
+        </div>
+        
+        <div class="endpoint">
+            <span class="method">GET</span>
+            <strong>/api/google-callback</strong>
+            <p>Callback từ Google OAuth (tự động được gọi bởi Google)</p>
+        </div>
+        
+        <div class="endpoint">
+            <span class="method">POST</span>
+            <strong>/api/verify-google-auth</strong>
+            <p>Xác minh mã 6 chữ số và đăng ký/đăng nhập</p>
+            <p><small>Body: {{"auth_code": "123456", "machine_id": "..."}}</small></p>
+            <p><small>Đăng nhập bắt đầu bằng ?remember=1&machine_id=... thì kết quả có thêm remember_token</small></p>
+        </div>
+        
+        <div class="endpoint">
+            <span class="method">POST</span>
+            <strong>/api/google-auth/refresh</strong>
+            <p>Đăng nhập lại bằng refresh token đã lưu, không mở trình duyệt (401 + reauth = đăng nhập lại qua Google)</p>
+            <p><small>Body: {{"email": "...", "machine_id": "...", "remember_token": "..."}}</small></p>
+        </div>
+        
+        <div class="endpoint">
+            <span class="method">GET</span>
+            <strong>/ping</strong>
+            <p>Kiểm tra server có hoạt động không</p>
+            <a href="/ping" target="_blank">🔗 Test ngay</a>
+        </div>
+        
+        <div class="endpoint">
+            <span class="method">GET</span>
+            <strong>/api/check-config</strong>
+            <p>Kiểm tra cấu hình environment variables</p>
+            <a href="/api/check-config" target="_blank">🔗 Test ngay</a>
+        </div>
+        
+        <hr>
+        <h2>⚙️ Cấu hình:</h2>
+        <p><strong>Client ID:</strong> {client_id_preview}...</p>
+        <p><strong>Redirect URI:</strong> {redirect_uri}</p>
+        
+        <hr>
+        <h2>🧪 Hướng dẫn Test:</h2>
+        <ol>
+            <li>Nhấn vào link "Test ngay" ở endpoint <code>/api/google-auth</code></li>
+            <li>Đăng nhập Google và cho phép ứng dụng</li>
+            <li>Bạn sẽ thấy mã xác minh 6 chữ số</li>
+            <li>Nhập mã đó vào ứng dụng Video Translator</li>
+        </ol>
+        <hr>
+        <p style="color: #666; font-size: 12px;">
+            ⚠️ <strong>Lưu ý:</strong> Giao diện này chỉ hiển thị trong môi trường development. 
+            Trong production, endpoint này sẽ trả về JSON.
+        </p>
+    </div>
+</body>
+</html>
+""")
+INDEX_DEVELOPMENT = StaticResponse(INDEX_DEVELOPMENT_PAGE.render(
+    client_id_preview=GOOGLE_CLIENT_ID[:30] if GOOGLE_CLIENT_ID else 'N/A',
+    redirect_uri=GOOGLE_REDIRECT_URI if GOOGLE_REDIRECT_URI else 'N/A'
+), 'text/html; charset=utf-8')
+
+CALLBACK_SUCCESS_PAGE = PageTemplate("""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Đăng Nhập Thành Công</title>
+    <style>
+        body {{
+            font-family: Arial, sans-serif;
+            text-align: center;
+            padding: 50px;
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            color: white;
+            min-height: 100vh;
+            margin: 0;
+        }}
+        .container {{
+            background: white;
+            color: #333;
+            padding: 40px;
+            border-radius: 10px;
+            box-shadow: 0 10px 30px rgba(0,0,0,0.3);
+            max-width: 500px;
+            margin: 0 auto;
+        }}
+        h1 {{
+            color: #4CAF50;
+            margin-bottom: 20px;
+        }}
+        .code {{
+            font-size: 48px;
+            font-weight: bold;
+            color: #0066cc;
+            letter-spacing: 10px;
+            padding: 20px;
+            background: #f0f0f0;
+            border-radius: 5px;
+            margin: 20px 0;
+        }}
+        .info {{
+            color: #666;
+            margin: 10px 0;
+        }}
+        .warning {{
+            color: #ff6600;
+            font-weight: bold;
+            margin-top: 20px;
+        }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>✅ Đăng Nhập Thành Công!</h1>
+        <p class="info">Email: <strong>{email}</strong></p>
+        <p class="info">Tên: <strong>{name}</strong></p>
+        <hr>
+        <p>{instruction}</p>
+        <div class="code">{code}</div>
+        <p class="warning">⚠️ Mã có hiệu lực trong 5 phút</p>
+        <p style="margin-top: 30px; color: #999; font-size: 12px;">
+            Bạn có thể đóng cửa sổ này sau khi đã nhập mã vào ứng dụng.
+        </p>
+    </div>
+</body>
+</html>
+""")
+
+LOGIN_ERROR_PAGE = PageTemplate("""
+<html>
+<head><title>Lỗi Đăng Nhập</title></head>
+<body style="font-family: Arial; text-align: center; padding: 50px;">
+    <h1 style="color: red;">❌ Lỗi Đăng Nhập</h1>
+    <p>{error}</p>
+    <p>Vui lòng thử lại.</p>
+</body>
+</html>
+""")
+
+CALLBACK_ERROR_PAGE = PageTemplate("""
+<html>
+<head><title>Lỗi</title></head>
+<body style="font-family: Arial; text-align: center; padding: 50px;">
+    <h1 style="color: red;">❌ Lỗi</h1>
+    <p>{error}</p>
+    <p>Vui lòng thử lại.</p>
+</body>
+</html>
+""")
+
+def send_static(page):
+    """StaticResponse theo Accept-Encoding / If-None-Match của request hiện tại"""
+    status, body, headers = page.respond(request.headers.get('Accept-Encoding'), request.headers.get('If-None-Match'))
+    return body, status, headers
+
+def send_html(html, status):
+    """Trang HTML động: không cache (có mã xác minh), nén nếu trình duyệt chấp nhận"""
+    body, encoding = compress_body(html.encode('utf-8'), request.headers.get('Accept-Encoding'))
+    headers = {'Content-Type': 'text/html; charset=utf-8', 'Cache-Control': 'no-store', 'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return body, status, headers
 
 # ============================================
 # API ENDPOINTS
@@ -78,200 +937,125 @@ verification_store = {}  # {code: {email, name, access_token, expires_at}}
 
 @app.route('/', methods=['GET'])
 def index():
-    """Trang chủ - API server, không hiển thị giao diện trong production"""
-    if IS_PRODUCTION:
-        # Production: Chỉ trả về JSON đơn giản, không lộ thông tin
-        return jsonify({
-            'service': 'Google OAuth Server',
-            'status': 'running',
-            'version': '1.0.0',
-            'endpoints': {
-                'auth': '/api/google-auth',
-                'callback': '/api/google-callback',
-                'verify': '/api/verify-google-auth',
-                'ping': '/ping',
-                'check_config': '/api/check-config'
-            },
-            'note': 'This is an API server. Use the endpoints to interact with the service.'
-        }), 200
-    else:
-        # Development: Hiển thị giao diện để dễ test
-        return f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <title>Google OAuth Server - Video Translator (DEV)</title>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    max-width: 800px;
-                    margin: 50px auto;
-                    padding: 20px;
-                    background: #f5f5f5;
-                }}
-                .container {{
-                    background: white;
-                    padding: 30px;
-                    border-radius: 10px;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-                }}
-                h1 {{
-                    color: #0066cc;
-                }}
-                .endpoint {{
-                    background: #f0f0f0;
-                    padding: 10px;
-                    margin: 10px 0;
-                    border-left: 4px solid #0066cc;
-                }}
-                .method {{
-                    display: inline-block;
-                    padding: 3px 8px;
-                    background: #0066cc;
-                    color: white;
-                    border-radius: 3px;
-                    font-weight: bold;
-                    margin-right: 10px;
-                }}
-                .status {{
-                    display: inline-block;
-                    padding: 5px 10px;
-                    background: #4CAF50;
-                    color: white;
-                    border-radius: 5px;
-                    font-weight: bold;
-                }}
-                .dev-badge {{
-                    background: #ff9800;
-                    color: white;
-                    padding: 5px 10px;
-                    border-radius: 5px;
-                    font-size: 12px;
-                    margin-left: 10px;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>🔐 Google OAuth Server <span class="dev-badge">DEV MODE</span></h1>
-                <p class="status">✅ Server đang hoạt động</p>
-                <hr>
-                <h2>📋 Các Endpoint có sẵn:</h2>
-                
-                <div class="endpoint">
-                    <span class="method">GET</span>
-                    <strong>/api/google-auth</strong>
-                    <p>Bắt đầu Google OAuth flow - Mở trình duyệt để đăng nhập Google</p>
-                    <a href="/api/google-auth" target="_blank">🔗 Test ngay</a>
-                </div>
-                
-                <div class="endpoint">
-                    <span class="method">GET</span>
-                    <strong>/api/google-callback</strong>
-                    <p>Callback từ Google OAuth (tự động được gọi bởi Google)</p>
-                </div>
-                
-                <div class="endpoint">
-                    <span class="method">POST</span>
-                    <strong>/api/verify-google-auth</strong>
-                    <p>Xác minh mã 6 chữ số và đăng ký/đăng nhập</p>
-                    <p><small>Body: {{"auth_code": "123456", "machine_id": "..."}}</small></p>
-                </div>
-                
-                <div class="endpoint">
-                    <span class="method">GET</span>
-                    <strong>/ping</strong>
-                    <p>Kiểm tra server có hoạt động không</p>
-                    <a href="/ping" target="_blank">🔗 Test ngay</a>
-                </div>
-                
-                <div class="endpoint">
-                    <span class="method">GET</span>
-                    <strong>/api/check-config</strong>
-                    <p>Kiểm tra cấu hình environment variables</p>
-                    <a href="/api/check-config" target="_blank">🔗 Test ngay</a>
-                </div>
-                
-                <hr>
-                <h2>⚙️ Cấu hình:</h2>
-                <p><strong>Client ID:</strong> {GOOGLE_CLIENT_ID[:30] if GOOGLE_CLIENT_ID else 'N/A'}...</p>
-                <p><strong>Redirect URI:</strong> {GOOGLE_REDIRECT_URI if GOOGLE_REDIRECT_URI else 'N/A'}</p>
-                
-                <hr>
-                <h2>🧪 Hướng dẫn Test:</h2>
-                <ol>
-                    <li>Nhấn vào link "Test ngay" ở endpoint <code>/api/google-auth</code></li>
-                    <li>Đăng nhập Google và cho phép ứng dụng</li>
-                    <li>Bạn sẽ thấy mã xác minh 6 chữ số</li>
-                    <li>Nhập mã đó vào ứng dụng Video Translator</li>
-                </ol>
-                <hr>
-                <p style="color: #666; font-size: 12px;">
-                    ⚠️ <strong>Lưu ý:</strong> Giao diện này chỉ hiển thị trong môi trường development. 
-                    Trong production, endpoint này sẽ trả về JSON.
-                </p>
-            </div>
-        </body>
-        </html>
-        """
+    """Trang chủ - API server, không hiển thị giao diện trong production (nội dung cố định, tạo một lần)"""
+    page = INDEX_PRODUCTION if IS_PRODUCTION else INDEX_DEVELOPMENT
+    return send_static(page)
 
 @app.route('/api/google-auth', methods=['GET'])
 def google_auth():
     """Bắt đầu Google OAuth flow"""
     try:
-        # Tạo state token để bảo mật (tránh CSRF)
-        state = secrets.token_urlsafe(32)
-        session['oauth_state'] = state
+        # machine_id (tùy chọn) đi cùng state để callback prefetch trạng thái máy
+        machine_id = request.args.get('machine_id', '')[:128]
+        state_data = {'machine_id': machine_id} if machine_id else {}
+        
+        # Device flow: state chỉ mang hash của handle (URL đăng nhập có thể bị người khác thấy)
+        device_handle = new_device_handle() if request.args.get('device') == '1' else None
+        if device_handle:
+            state_data['device'] = device_key(device_handle, machine_id)
+        
+        # Ghi nhớ đăng nhập: cần machine_id để gắn refresh token với máy
+        remember = REMEMBER_LOGIN and machine_id and request.args.get('remember') == '1'
+        if remember:
+            state_data['remember'] = 1
+        # Chỉ xin quyền offline (hiện màn hình cấp quyền) khi cần refresh token
+        access_params = "access_type=offline&prompt=consent" if remember else "prompt=select_account"
+        
+        # Tạo state token ký HMAC để bảo mật (tránh CSRF) - worker nào cũng kiểm tra được
+        nonce = secrets.token_urlsafe(16)
+        state = oauth_state_signer.create(state_data or None, nonce=nonce)
         
         # Tạo URL đăng nhập Google
         auth_url = (
-            f"https://accounts.google.com/o/oauth2/v2/auth?"
+            f"{GOOGLE_AUTH_URL}?"
             f"client_id={GOOGLE_CLIENT_ID}&"
             f"redirect_uri={GOOGLE_REDIRECT_URI}&"
             f"response_type=code&"
             f"scope=openid%20email%20profile&"
             f"state={state}&"
-            f"access_type=offline&"
-            f"prompt=consent"
+            f"{access_params}"
         )
         
-        return redirect(auth_url)
+        if device_handle:
+            return jsonify({
+                'handle': device_handle,
+                'auth_url': auth_url,
+                # Poll phải gửi đúng machine_id đã dùng ở đây
+                'poll_url': '/api/google-auth/poll?' + urlencode(
+                    {'handle': device_handle, 'machine_id': machine_id} if machine_id else {'handle': device_handle}
+                ),
+                'poll_timeout': DEVICE_POLL_TIMEOUT,
+                'expires_in': oauth_state_signer.max_age
+            }), 200
+        
+        # Luồng trình duyệt: gắn state với trình duyệt này qua cookie nonce
+        response = redirect(auth_url)
+        response.headers.add('Set-Cookie', oauth_state_cookie(nonce))
+        return response
         
     except Exception as e:
-        print(f"Error in google_auth: {e}")
+        logger.error('google_auth_error', error=str(e))
         return f"Lỗi: {str(e)}", 500
 
+@app.route('/api/google-auth/poll', methods=['GET'])
+@limit_verify_rate
+@shed_load('google_auth_poll', lambda: (
+    jsonify({'success': False, 'message': OVERLOADED_MESSAGE}), 503, retry_after_headers()
+))
+def google_auth_poll():
+    """Long-poll của device flow: chờ callback của handle rồi trả về kết quả verify"""
+    key, data, timeout = device_poll_params(request.args)
+    if key is None:
+        return jsonify(DEVICE_INVALID_PAYLOAD), 400
+    if not wait_for_device_login(key, data, timeout):
+        return jsonify(DEVICE_PENDING_PAYLOAD), 202
+    # Chỉ tính thời gian verify, không tính thời gian chờ user đăng nhập
+    start = time.perf_counter()
+    payload, status = verify_flights.do(
+        verify_flight_key(data),
+        lambda: run_upstream_steps(device_verify_steps(data), upstream)
+    )
+    REQUEST_SECONDS.observe(time.perf_counter() - start, 'google_auth_poll', str(status))
+    return jsonify(payload), status, (retry_after_headers() if status == 503 else {})
+
 @app.route('/api/google-callback', methods=['GET'])
+@shed_load('google_callback', lambda: (OVERLOADED_HTML, 503, retry_after_headers()))
 def google_callback():
     """Xử lý callback từ Google OAuth"""
+    start = time.perf_counter()
+    state_cookie = request.cookies.get(OAUTH_STATE_COOKIE)
+    body, status = run_upstream_steps(google_callback_steps(request.args, state_cookie), upstream)
+    REQUEST_SECONDS.observe(time.perf_counter() - start, 'google_callback', str(status))
+    body, status, headers = send_html(body, status)
+    if state_cookie is not None:
+        # Nonce chỉ dùng một lần
+        headers['Set-Cookie'] = oauth_state_cookie(None)
+    return body, status, headers
+
+def google_callback_steps(args, state_cookie=None):
+    """Các bước xử lý callback - yield UpstreamCall, trả về (html, status); dùng chung với bản ASGI"""
     try:
-        code = request.args.get('code')
-        state = request.args.get('state')
-        error = request.args.get('error')
+        deadline = Deadline(CALLBACK_DEADLINE)
+        code = args.get('code')
+        state = args.get('state')
+        error = args.get('error')
         
         # Kiểm tra lỗi
         if error:
-            return f"""
-            <html>
-            <head><title>Lỗi Đăng Nhập</title></head>
-            <body style="font-family: Arial; text-align: center; padding: 50px;">
-                <h1 style="color: red;">❌ Lỗi Đăng Nhập</h1>
-                <p>{error}</p>
-                <p>Vui lòng thử lại.</p>
-            </body>
-            </html>
-            """, 400
-        
-        # Kiểm tra state (bảo mật)
-        if state != session.get('oauth_state'):
+            return LOGIN_ERROR_PAGE.render(error=error), 400
+        
+        # Kiểm tra state (bảo mật): chữ ký và thời hạn
+        state_data = oauth_state_signer.verify(state)
+        if state_data is None:
+            return "Invalid state token", 400
+        # Luồng trình duyệt: state phải do chính trình duyệt này tạo (cookie nonce khớp)
+        if not state_data.get('device') and not oauth_state_signer.nonce_matches(state, state_cookie):
             return "Invalid state token", 400
         
         if not code:
             return "Missing authorization code", 400
         
         # Exchange code lấy access token
-        token_url = "https://oauth2.googleapis.com/token"
         token_data = {
             'code': code,
             'client_id': GOOGLE_CLIENT_ID,
@@ -280,7 +1064,11 @@ def google_callback():
             'grant_type': 'authorization_code'
         }
         
-        token_response = requests.post(token_url, data=token_data, timeout=30)
+        token_response = (yield UpstreamCall(
+            'POST', GOOGLE_TOKEN_URL, stage='google_token', bulkhead=upstream_bulkheads['google'],
+            data=token_data,
+            timeout=deadline.timeout(30, calls_left=2)
+        )).unwrap()
         
         if token_response.status_code != 200:
             return f"Lỗi khi lấy token: {token_response.text}", 500
@@ -291,149 +1079,172 @@ def google_callback():
         if not access_token:
             return "Không nhận được access token", 500
         
-        # Lấy thông tin user từ Google
-        user_info_url = "https://www.googleapis.com/oauth2/v2/userinfo"
-        headers = {'Authorization': f'Bearer {access_token}'}
-        user_response = requests.get(user_info_url, headers=headers, timeout=30)
+        # Lấy thông tin user từ id_token (xác minh tại chỗ bằng khóa đã cache)
+        user_info = None
+        if GOOGLE_ID_TOKEN_LOCAL and tokens.get('id_token'):
+            try:
+                user_info = verify_id_token(tokens['id_token'], google_jwks, GOOGLE_CLIENT_ID)
+            except IdTokenError as token_error:
+                logger.warning('id_token_fallback', reason=str(token_error))
         
-        if user_response.status_code != 200:
-            return f"Lỗi khi lấy thông tin user: {user_response.text}", 500
+        # Fallback: lấy thông tin user từ Google userinfo
+        if not user_info or not user_info.get('email'):
+            headers = {'Authorization': f'Bearer {access_token}'}
+            user_response = (yield UpstreamCall(
+                'GET', GOOGLE_USERINFO_URL, stage='google_userinfo', bulkhead=upstream_bulkheads['google'],
+                headers=headers,
+                timeout=deadline.timeout(30)
+            )).unwrap()
+            
+            if user_response.status_code != 200:
+                return f"Lỗi khi lấy thông tin user: {user_response.text}", 500
+            
+            user_info = user_response.json()
         
-        user_info = user_response.json()
         email = user_info.get('email', '')
         name = user_info.get('name', '')
-        picture = user_info.get('picture', '')
         
         if not email:
             return "Không lấy được email từ Google", 500
         
-        # Tạo mã xác minh 6 chữ số
-        verification_code = ''.join([str(secrets.randbelow(10)) for _ in range(6)])
+        # Tạo mã xác minh 6 chữ số chưa dùng và lưu tạm thời (5 phút) - chỉ giữ các trường cần cho bước verify
+        try:
+            verification_code = code_allocator.allocate(email, name)
+        except CodeSpaceExhausted as allocate_error:
+            logger.error('verification_code_exhausted', error=str(allocate_error), occupancy=code_allocator.occupancy)
+            return "Server đang quá tải, vui lòng thử lại sau ít phút", 503
         
-        # Lưu thông tin tạm thời (5 phút)
-        verification_store[verification_code] = {
-            'email': email,
-            'name': name,
-            'picture': picture,
-            'access_token': access_token,
-            'expires_at': time.time() + 300  # 5 phút
-        }
+        # Device flow: lưu mục trỏ tới mã vừa cấp và đánh thức app đang long-poll
+        device_state_key = state_data.get('device')
+        if device_state_key:
+            verification_store.put(DEVICE_CODE_PREFIX + device_state_key, email, name, link=verification_code)
+            device_waiters.notify(device_state_key)
+        
+        # Ghi nhớ đăng nhập: lưu tạm refresh token, verify thành công mới kích hoạt
+        if state_data.get('remember') and tokens.get('refresh_token') and state_data.get('machine_id'):
+            refresh_tokens.stage(email, state_data['machine_id'], tokens['refresh_token'], name)
         
-        print(f"[GOOGLE AUTH] User: {email}, Code: {verification_code}")
+        # Kiểm tra machine_id trong nền trong lúc user nhập mã
+        if state_data.get('machine_id'):
+            prefetch_machine_check(state_data['machine_id'])
+        
+        logger.info('verification_code_issued', email=email, code=verification_code, device=bool(device_state_key))
+        
+        instruction = (
+            'Ứng dụng sẽ tự động đăng nhập. Nếu không, hãy nhập mã xác minh sau vào ứng dụng:'
+            if device_state_key else 'Vui lòng nhập mã xác minh sau vào ứng dụng:'
+        )
         
         # Hiển thị mã xác minh cho user
-        return f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <title>Đăng Nhập Thành Công</title>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    text-align: center;
-                    padding: 50px;
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                    color: white;
-                    min-height: 100vh;
-                    margin: 0;
-                }}
-                .container {{
-                    background: white;
-                    color: #333;
-                    padding: 40px;
-                    border-radius: 10px;
-                    box-shadow: 0 10px 30px rgba(0,0,0,0.3);
-                    max-width: 500px;
-                    margin: 0 auto;
-                }}
-                h1 {{
-                    color: #4CAF50;
-                    margin-bottom: 20px;
-                }}
-                .code {{
-                    font-size: 48px;
-                    font-weight: bold;
-                    color: #0066cc;
-                    letter-spacing: 10px;
-                    padding: 20px;
-                    background: #f0f0f0;
-                    border-radius: 5px;
-                    margin: 20px 0;
-                }}
-                .info {{
-                    color: #666;
-                    margin: 10px 0;
-                }}
-                .warning {{
-                    color: #ff6600;
-                    font-weight: bold;
-                    margin-top: 20px;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>✅ Đăng Nhập Thành Công!</h1>
-                <p class="info">Email: <strong>{email}</strong></p>
-                <p class="info">Tên: <strong>{name}</strong></p>
-                <hr>
-                <p>Vui lòng nhập mã xác minh sau vào ứng dụng:</p>
-                <div class="code">{verification_code}</div>
-                <p class="warning">⚠️ Mã có hiệu lực trong 5 phút</p>
-                <p style="margin-top: 30px; color: #999; font-size: 12px;">
-                    Bạn có thể đóng cửa sổ này sau khi đã nhập mã vào ứng dụng.
-                </p>
-            </div>
-        </body>
-        </html>
-        """
+        return CALLBACK_SUCCESS_PAGE.render(
+            email=email, name=name, instruction=instruction, code=verification_code
+        ), 200
         
     except Exception as e:
-        print(f"Error in google_callback: {e}")
-        return f"""
-        <html>
-        <head><title>Lỗi</title></head>
-        <body style="font-family: Arial; text-align: center; padding: 50px;">
-            <h1 style="color: red;">❌ Lỗi</h1>
-            <p>{str(e)}</p>
-            <p>Vui lòng thử lại.</p>
-        </body>
-        </html>
-        """, 500
+        logger.exception('google_callback_error', error=str(e))
+        return CALLBACK_ERROR_PAGE.render(error=e), 500
 
 @app.route('/api/verify-google-auth', methods=['POST'])
+@limit_verify_rate
+@shed_load('verify_google_auth', lambda: (
+    jsonify({'success': False, 'message': OVERLOADED_MESSAGE}), 503, retry_after_headers()
+))
 def verify_google_auth():
     """Xác minh mã và đăng nhập"""
+    start = time.perf_counter()
+    data = request.get_json(silent=True)
+    payload, status = verify_flights.do(
+        verify_flight_key(data),
+        lambda: run_upstream_steps(verify_and_remember_steps(data), upstream)
+    )
+    REQUEST_SECONDS.observe(time.perf_counter() - start, 'verify_google_auth', str(status))
+    return jsonify(payload), status, (retry_after_headers() if status == 503 else {})
+
+def verify_flight_key(data):
+    """Key gộp các lần gửi verify trùng: (auth_code, machine_id); None = không gộp"""
+    if not isinstance(data, dict) or not isinstance(data.get('auth_code'), str) or not data['auth_code'].strip():
+        return None
+    return data['auth_code'].strip(), str(data.get('machine_id', ''))
+
+def verify_and_remember_steps(data):
+    """verify_google_auth_steps + kích hoạt refresh token đã lưu tạm ở callback (nếu user chọn ghi nhớ)"""
+    payload, status = yield from verify_google_auth_steps(data)
+    if status == 200 and payload.get('success'):
+        remember_token = refresh_tokens.activate(payload['user_data']['email'], str(data.get('machine_id', '')))
+        if remember_token:
+            payload = dict(payload, remember_token=remember_token)
+    return payload, status
+
+def verify_google_auth_steps(data):
+    """Các bước xác minh - yield UpstreamCall, trả về (payload, status); dùng chung với bản ASGI"""
     try:
-        data = request.json
         code = data.get('auth_code', '').strip()
         machine_id = data.get('machine_id', '')
         
         if not code:
-            return jsonify({
+            return {
                 'success': False,
                 'message': 'Vui lòng nhập mã xác minh'
-            }), 400
+            }, 400
+        # Mục device chỉ dùng được qua /api/google-auth/poll (device_key có trong state của URL đăng nhập)
+        if code.startswith(DEVICE_CODE_PREFIX):
+            return {
+                'success': False,
+                'message': 'Mã xác minh không hợp lệ'
+            }, 400
         
-        # Kiểm tra mã
-        user_data = verification_store.get(code)
+        # Lấy và xóa mã trong một bước (pop nguyên tử ở mọi backend): hai worker/instance nhận cùng
+        # mã thì chỉ một bên dùng được. Lỗi tạm thời (5xx, breaker mở) thì trả mã lại để user thử lại
+        user_data = verification_store.pop(code)
+        if not user_data and verification_snapshots.restoring:
+            # Vừa khởi động lại: mã có thể còn trong snapshot đang được nạp
+            return {
+                'success': False,
+                'message': 'Server vừa khởi động lại. Vui lòng thử lại sau vài giây.'
+            }, 503
         if not user_data:
-            return jsonify({
+            return {
                 'success': False,
                 'message': 'Mã xác minh không hợp lệ'
-            }), 400
+            }, 400
         
-        # Kiểm tra hết hạn
-        if user_data['expires_at'] < time.time():
-            del verification_store[code]
-            return jsonify({
+        # Kiểm tra hết hạn (mã đã được xóa khỏi kho)
+        if user_data.is_expired():
+            return {
                 'success': False,
                 'message': 'Mã xác minh đã hết hạn. Vui lòng đăng nhập lại.'
-            }), 400
+            }, 400
+    except Exception as e:
+        logger.exception('verify_google_auth_error', error=str(e))
+        return {
+            'success': False,
+            'message': f'Lỗi server: {str(e)}'
+        }, 500
+    
+    payload, status = yield from verify_claimed_code_steps(user_data, machine_id)
+    if status >= 500:
+        release_verification_code(code, user_data)
+    return payload, status
+
+def release_verification_code(code, user_data):
+    """Trả mã đã lấy ra về kho với thời gian còn lại (verify lỗi tạm thời, user nhập lại cùng mã)"""
+    remaining = user_data.expires_at - time.time()
+    try:
+        # add: không ghi đè nếu mã vừa được cấp lại cho người khác
+        if remaining > 0 and verification_store.add(code, user_data.email, user_data.name, ttl=remaining,
+                                                     link=user_data.link) is None:
+            logger.warning('verification_code_release_conflict', email=user_data.email)
+    except Exception as release_error:
+        logger.error('verification_code_release_error', email=user_data.email, error=str(release_error))
+
+def verify_claimed_code_steps(user_data, machine_id):
+    """check-machine + login/register cho mã đã lấy khỏi kho - yield UpstreamCall, trả về (payload, status)"""
+    try:
+        email = user_data.email
+        name = user_data.name
         
-        email = user_data['email']
-        name = user_data['name']
+        # Check-machine + login/register dùng chung một ngân sách thời gian
+        deadline = Deadline(VERIFY_DEADLINE)
         
         # KIỂM TRA MACHINE_ID TRƯỚC KHI ĐĂNG KÝ
         headers = {
@@ -441,22 +1252,23 @@ def verify_google_auth():
             'Accept': 'application/json'
         }
         
-        # Đánh thức server trước
-        try:
-            ping_url = "https://web-admin-srt212.onrender.com/ping"
-            requests.get(ping_url, timeout=10)
-        except:
-            pass
-        
         # Kiểm tra machine_id đã tồn tại chưa
-        check_machine_url = "https://web-admin-srt212.onrender.com/api/check-machine"
+        check_machine_url = f"{ADMIN_SERVER_URL}/api/check-machine"
         try:
-            check_response = requests.post(
-                check_machine_url,
-                json={"machine_id": machine_id},
-                headers=headers,
-                timeout=30
-            )
+            check_response = machine_check_cache.get(machine_id) if machine_id else None
+            if check_response is None:
+                # Chỉ đánh thức server khi đang cold (thread keep-warm giữ server thức)
+                check_response = (yield UpstreamCall(
+                    'POST', check_machine_url, stage='admin_check_machine', wake=admin_keep_warm,
+                    breaker=admin_breakers['check_machine'], bulkhead=upstream_bulkheads['admin'],
+                    json={"machine_id": machine_id},
+                    headers=headers,
+                    timeout=deadline.timeout(30, calls_left=2)
+                )).unwrap()
+                if check_response.status_code < 500:
+                    admin_keep_warm.mark_warm()
+                if check_response.status_code == 200 and machine_id:
+                    machine_check_cache.set(machine_id, check_response)
             
             if check_response.status_code == 200:
                 check_result = check_response.json()
@@ -470,22 +1282,25 @@ def verify_google_auth():
                     hours_since_last = check_result.get("hours_since_last", 0)
                     user_count = check_result.get("user_count", 0)
                     
-                    # Debug log
-                    print(f"[GOOGLE AUTH] Machine ID đã tồn tại:")
-                    print(f"[GOOGLE AUTH] - User: {existing_name} ({existing_email})")
-                    print(f"[GOOGLE AUTH] - Last registered: {last_registered}")
-                    print(f"[GOOGLE AUTH] - Hours since last: {hours_since_last}")
-                    print(f"[GOOGLE AUTH] - User count: {user_count}")
-                    print(f"[GOOGLE AUTH] - Can register again: {can_register_again}")
+                    # Debug log (được lấy mẫu theo LOG_DEBUG_SAMPLE_RATE)
+                    logger.debug(
+                        'machine_exists',
+                        machine_id=machine_id,
+                        existing_name=existing_name,
+                        existing_email=existing_email,
+                        last_registered=last_registered,
+                        hours_since_last=hours_since_last,
+                        user_count=user_count,
+                        can_register_again=can_register_again
+                    )
                     
                     # Kiểm tra xem email có khớp không - nếu khớp thì cho đăng nhập lại
                     if existing_email.lower() == email.lower():
                         # Email khớp với tài khoản đã tồn tại - Cho phép đăng nhập lại
-                        print(f"[GOOGLE AUTH] ✅ Email khớp với tài khoản đã tồn tại: {email}")
-                        print(f"[GOOGLE AUTH] Gọi API login để đăng nhập lại...")
+                        logger.debug('relogin_attempt', email=email, machine_id=machine_id)
                         
                         # Gọi API login để đăng nhập lại
-                        login_url = "https://web-admin-srt212.onrender.com/api/login"
+                        login_url = f"{ADMIN_SERVER_URL}/api/login"
                         login_data = {
                             "email": email,
                             "machine_id": machine_id,
@@ -493,12 +1308,13 @@ def verify_google_auth():
                         }
                         
                         try:
-                            login_response = requests.post(
-                                login_url,
+                            login_response = (yield UpstreamCall(
+                                'POST', login_url, stage='admin_login', breaker=admin_breakers['login'],
+                                bulkhead=upstream_bulkheads['admin'],
                                 json=login_data,
                                 headers=headers,
-                                timeout=30
-                            )
+                                timeout=deadline.timeout(30)
+                            )).unwrap()
                             
                             if login_response.status_code == 200:
                                 login_result = login_response.json()
@@ -506,47 +1322,40 @@ def verify_google_auth():
                                     auth_token = login_result.get("auth_token", "")
                                     user_info = login_result.get("user_info", {})
                                     
-                                    print(f"[GOOGLE AUTH] ✅ Đăng nhập lại thành công: {email}")
-                                    
-                                    # Xóa mã xác minh đã dùng
-                                    del verification_store[code]
+                                    logger.info('relogin_ok', email=email, machine_id=machine_id)
+                                    machine_check_cache.invalidate(machine_id)
                                     
-                                    return jsonify({
-                                        'success': True,
-                                        'user_data': {
-                                            'email': email,
-                                            'name': user_info.get('name', name),
-                                            'auth_token': auth_token
-                                        },
-                                        'auth_token': auth_token,
-                                        'message': 'Đăng nhập lại thành công'
-                                    })
+                                    return relogin_payload(email, user_info.get('name', name), auth_token), 200
                                 else:
                                     error_msg = login_result.get('message', 'Không thể đăng nhập')
-                                    print(f"[GOOGLE AUTH] ❌ Lỗi đăng nhập: {error_msg}")
-                                    return jsonify({
+                                    logger.warning('relogin_failed', email=email, message=error_msg)
+                                    return {
                                         'success': False,
                                         'message': f'Không thể đăng nhập: {error_msg}'
-                                    }), 400
+                                    }, 400
                             else:
                                 error_msg = f'Lỗi server login: {login_response.status_code}'
-                                print(f"[GOOGLE AUTH] ❌ {error_msg}")
-                                return jsonify({
+                                logger.warning('relogin_failed', email=email, status=login_response.status_code)
+                                return {
                                     'success': False,
                                     'message': error_msg
-                                }), 400
+                                }, 400
+                        except (CircuitOpenError, DeadlineExceeded, BulkheadFull) as login_error:
+                            logger.warning('relogin_unavailable', email=email, error=str(login_error))
+                            return admin_unavailable_response()
                         except Exception as login_error:
                             error_msg = f'Lỗi khi gọi API login: {str(login_error)}'
-                            print(f"[GOOGLE AUTH] ❌ {error_msg}")
-                            return jsonify({
+                            logger.error('relogin_error', email=email, error=str(login_error))
+                            return {
                                 'success': False,
                                 'message': error_msg
-                            }), 500
+                            }, 500
                     
                     # Email không khớp - Kiểm tra có thể đăng ký thêm không
                     if can_register_again:
                         # Có thể đăng ký thêm (sau 1 ngày)
-                        print(f"[GOOGLE AUTH] ✅ Cho phép đăng ký thêm: Đã đủ 24 giờ ({hours_since_last:.2f} giờ) và chưa đủ 2 tài khoản ({user_count})")
+                        logger.debug('register_again_allowed', machine_id=machine_id,
+                                     hours_since_last=hours_since_last, user_count=user_count)
                         # Tiếp tục đăng ký
                     else:
                         # Không thể đăng ký thêm
@@ -560,27 +1369,27 @@ def verify_google_auth():
                         else:
                             error_msg += f'Không thể đăng ký thêm.'
                         
-                        print(f"[GOOGLE AUTH] ❌ Từ chối đăng ký: {error_msg}")
-                        return jsonify({
+                        logger.info('register_refused', email=email, machine_id=machine_id,
+                                    hours_since_last=hours_since_last, user_count=user_count)
+                        return {
                             'success': False,
                             'message': error_msg,
                             'existing_user': {
                                 'name': existing_name,
                                 'email': existing_email
                             }
-                        }), 400
+                        }, 400
                 else:
                     # Machine_id chưa tồn tại, có thể đăng ký
-                    print(f"[GOOGLE AUTH] Machine ID chưa tồn tại, tiến hành đăng ký: {email}")
+                    logger.debug('machine_not_registered', email=email, machine_id=machine_id)
             else:
                 # Lỗi khi kiểm tra, vẫn tiếp tục đăng ký (fallback)
-                print(f"[GOOGLE AUTH] Không thể kiểm tra machine_id, tiếp tục đăng ký: {check_response.status_code}")
+                logger.warning('check_machine_failed', machine_id=machine_id, status=check_response.status_code)
         except Exception as check_error:
             # Lỗi khi kiểm tra, vẫn tiếp tục đăng ký (fallback)
-            print(f"[GOOGLE AUTH] Lỗi khi kiểm tra machine_id: {str(check_error)}, tiếp tục đăng ký")
+            logger.warning('check_machine_error', machine_id=machine_id, error=str(check_error))
         
         # Gửi dữ liệu user lên server admin để đăng ký
-        admin_server_url = "https://web-admin-srt212.onrender.com/api/register"
         register_data = {
             "name": name,
             "email": email,
@@ -590,73 +1399,287 @@ def verify_google_auth():
             "login_method": "google_oauth"  # Đánh dấu đăng ký qua Google
         }
         
-        try:
-            # Gửi dữ liệu đăng ký
-            admin_response = requests.post(
-                admin_server_url,
-                json=register_data,
-                headers=headers,
-                timeout=30
-            )
-            
-            if admin_response.status_code == 200:
-                admin_result = admin_response.json()
-                if admin_result.get("success"):
-                    print(f"[GOOGLE AUTH] Đã đăng ký user lên server admin: {email}")
-                else:
-                    error_message = admin_result.get('message', 'Unknown error')
-                    print(f"[GOOGLE AUTH] Không thể đăng ký lên server admin: {error_message}")
-                    # Trả về lỗi nếu server admin từ chối
-                    return jsonify({
-                        'success': False,
-                        'message': f'Không thể đăng ký: {error_message}'
-                    }), 400
-            else:
-                print(f"[GOOGLE AUTH] Server admin trả về status {admin_response.status_code}")
-                return jsonify({
-                    'success': False,
-                    'message': f'Lỗi server admin: {admin_response.status_code}'
-                }), 500
-        except Exception as admin_error:
-            # Lỗi khi đăng ký
-            print(f"[GOOGLE AUTH] Lỗi khi đăng ký lên server admin: {str(admin_error)}")
-            return jsonify({
-                'success': False,
-                'message': f'Không thể kết nối đến server admin: {str(admin_error)}'
-            }), 500
+        # REGISTER_WRITE_BEHIND=1: ghi vào journal (fsync) rồi trả token ngay, thread nền gửi /api/register
+        if not queue_registration(register_data):
+            register_error = yield from register_with_admin_steps(register_data, headers, deadline)
+            if register_error is not None:
+                return register_error
         
         # Tạo auth token
         auth_token = secrets.token_urlsafe(32)
         
-        # Xóa mã xác minh
-        del verification_store[code]
+        logger.info('verified', email=email, machine_id=machine_id)
         
-        print(f"[GOOGLE AUTH] Verified: {email}")
-        
-        return jsonify({
+        return {
             'success': True,
             'user_data': {
                 'email': email,
                 'name': name
             },
             'auth_token': auth_token
-        })
+        }, 200
         
     except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"[GOOGLE AUTH] Error in verify_google_auth: {e}")
-        print(f"[GOOGLE AUTH] Traceback: {error_trace}")
-        return jsonify({
+        logger.exception('verify_google_auth_error', error=str(e))
+        return {
             'success': False,
             'message': f'Lỗi server: {str(e)}'
-        }), 500
+        }, 500
+
+@app.route('/api/google-auth/refresh', methods=['POST'])
+@limit_verify_rate
+@shed_load('google_auth_refresh', lambda: (
+    jsonify({'success': False, 'message': OVERLOADED_MESSAGE}), 503, retry_after_headers()
+))
+def google_auth_refresh():
+    """Đăng nhập lại bằng refresh token đã lưu - không cần mở trình duyệt"""
+    start = time.perf_counter()
+    data = request.get_json(silent=True)
+    payload, status = verify_flights.do(
+        refresh_flight_key(data),
+        lambda: run_upstream_steps(refresh_login_steps(data), upstream)
+    )
+    REQUEST_SECONDS.observe(time.perf_counter() - start, 'google_auth_refresh', str(status))
+    return jsonify(payload), status, (retry_after_headers() if status == 503 else {})
+
+def refresh_login_params(data):
+    """(email, machine_id, remember_token) từ body của /api/google-auth/refresh; None nếu thiếu"""
+    if not isinstance(data, dict):
+        return None
+    params = tuple(data.get(field) for field in ('email', 'machine_id', 'remember_token'))
+    if not all(isinstance(value, str) and value.strip() for value in params):
+        return None
+    email, machine_id, remember_token = (value.strip() for value in params)
+    return email, machine_id[:128], remember_token
+
+def refresh_flight_key(data):
+    """Key gộp các lần gửi refresh trùng (dùng chung verify_flights với verify)"""
+    params = refresh_login_params(data)
+    return ('refresh',) + params if params else None
+
+def reauth_required_response(message='Vui lòng đăng nhập lại bằng Google.'):
+    """Không đăng nhập lại được bằng refresh token: app phải mở lại luồng đăng nhập qua trình duyệt"""
+    return {
+        'success': False,
+        'reauth': True,
+        'message': message
+    }, 401
+
+def refresh_login_steps(data):
+    """Làm mới token với Google rồi đi tiếp các bước verify - yield UpstreamCall, trả về (payload, status)"""
+    try:
+        params = refresh_login_params(data)
+        if params is None:
+            return {
+                'success': False,
+                'message': 'Thiếu email, machine_id hoặc remember_token'
+            }, 400
+        email, machine_id, remember_token = params
+        
+        record = refresh_tokens.check(email, machine_id, remember_token)
+        if record is None:
+            logger.info('refresh_login_unknown', email=email, machine_id=machine_id)
+            return reauth_required_response()
+        
+        deadline = Deadline(VERIFY_DEADLINE)
+        try:
+            token_response = (yield UpstreamCall(
+                'POST', GOOGLE_TOKEN_URL, stage='google_refresh', bulkhead=upstream_bulkheads['google'],
+                data={
+                    'client_id': GOOGLE_CLIENT_ID,
+                    'client_secret': GOOGLE_CLIENT_SECRET,
+                    'refresh_token': record['refresh_token'],
+                    'grant_type': 'refresh_token'
+                },
+                timeout=deadline.timeout(30, calls_left=3)
+            )).unwrap()
+        except (DeadlineExceeded, BulkheadFull) as refresh_error:
+            logger.warning('refresh_login_unavailable', email=email, error=str(refresh_error))
+            return google_unavailable_response()
+        
+        if token_response.status_code in (400, 401):
+            # invalid_grant: user đã thu hồi quyền, đổi mật khẩu hoặc token hết hạn - bỏ bản ghi
+            refresh_tokens.delete(email, machine_id)
+            logger.info('refresh_token_revoked', email=email, machine_id=machine_id,
+                        status=token_response.status_code)
+            return reauth_required_response()
+        if token_response.status_code != 200:
+            logger.warning('refresh_login_failed', email=email, status=token_response.status_code)
+            return google_unavailable_response()
+        
+        tokens = token_response.json()
+        
+        # Lấy thông tin user như ở callback: id_token xác minh tại chỗ, fallback userinfo
+        user_info = None
+        if GOOGLE_ID_TOKEN_LOCAL and tokens.get('id_token'):
+            try:
+                user_info = verify_id_token(tokens['id_token'], google_jwks, GOOGLE_CLIENT_ID)
+            except IdTokenError as token_error:
+                logger.warning('id_token_fallback', reason=str(token_error))
+        
+        if not user_info or not user_info.get('email'):
+            user_response = (yield UpstreamCall(
+                'GET', GOOGLE_USERINFO_URL, stage='google_userinfo', bulkhead=upstream_bulkheads['google'],
+                headers={'Authorization': f"Bearer {tokens.get('access_token', '')}"},
+                timeout=deadline.timeout(30, calls_left=2)
+            )).unwrap()
+            if user_response.status_code != 200:
+                logger.warning('refresh_userinfo_failed', email=email, status=user_response.status_code)
+                return google_unavailable_response()
+            user_info = user_response.json()
+        
+        # Refresh token phải thuộc đúng tài khoản của bản ghi
+        if user_info.get('email', '').lower() != record['email'].lower():
+            refresh_tokens.delete(email, machine_id)
+            logger.warning('refresh_email_mismatch', email=email, machine_id=machine_id)
+            return reauth_required_response()
+        
+        # Google có thể trả refresh token mới; ghi lại cũng gia hạn bản ghi tính từ lần dùng này
+        record['refresh_token'] = tokens.get('refresh_token') or record['refresh_token']
+        record['name'] = user_info.get('name') or record.get('name', '')
+        refresh_tokens.update(email, machine_id, record)
+        
+        # Bản ghi chỉ được kích hoạt sau khi verify thành công với đúng (email, machine_id): máy đã
+        # thuộc tài khoản này nên gọi thẳng /api/login, bỏ qua check-machine
+        try:
+            login_response = (yield UpstreamCall(
+                'POST', f"{ADMIN_SERVER_URL}/api/login", stage='admin_login', wake=admin_keep_warm,
+                breaker=admin_breakers['login'], bulkhead=upstream_bulkheads['admin'],
+                json={"email": record['email'], "machine_id": machine_id, "login_method": "google_oauth"},
+                headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+                timeout=deadline.timeout(30)
+            )).unwrap()
+        except (CircuitOpenError, DeadlineExceeded, BulkheadFull) as login_error:
+            logger.warning('refresh_login_unavailable', email=email, error=str(login_error))
+            return admin_unavailable_response()
+        if login_response.status_code < 500:
+            admin_keep_warm.mark_warm()
+        if login_response.status_code == 200:
+            login_result = login_response.json()
+            if login_result.get('success'):
+                logger.info('refresh_login', email=email, machine_id=machine_id)
+                user_info = login_result.get('user_info', {})
+                return relogin_payload(record['email'], user_info.get('name', record['name']),
+                                       login_result.get('auth_token', '')), 200
+        
+        # Server admin không nhận (vd máy đã bị xóa bên admin): đi lại các bước check-machine +
+        # login/register của verify bằng một mã nội bộ
+        logger.info('refresh_login_fallback', email=email, machine_id=machine_id, status=login_response.status_code)
+        code = REFRESH_CODE_PREFIX + secrets.token_urlsafe(16)
+        verification_store.put(code, record['email'], record['name'])
+        payload, status = yield from verify_google_auth_steps({'auth_code': code, 'machine_id': machine_id})
+        if status != 200:
+            verification_store.delete(code)
+        return payload, status
+        
+    except Exception as e:
+        logger.exception('refresh_login_error', error=str(e))
+        return {
+            'success': False,
+            'message': f'Lỗi server: {str(e)}'
+        }, 500
+
+def google_unavailable_response():
+    """Google tạm thời không làm mới được token: app thử lại sau, refresh token vẫn được giữ"""
+    return {
+        'success': False,
+        'message': 'Google tạm thời không phản hồi. Vui lòng thử lại sau ít phút.'
+    }, 503
+
+def register_with_admin_steps(register_data, headers, deadline):
+    """Gọi /api/register của server admin - yield UpstreamCall, trả về None nếu thành công, ngược lại (payload, status)"""
+    email = register_data['email']
+    machine_id = register_data['machine_id']
+    admin_server_url = f"{ADMIN_SERVER_URL}/api/register"
+    try:
+        # Gửi dữ liệu đăng ký
+        admin_response = (yield UpstreamCall(
+            'POST', admin_server_url, stage='admin_register', breaker=admin_breakers['register'],
+            bulkhead=upstream_bulkheads['admin'],
+            json=register_data,
+            headers=headers,
+            timeout=deadline.timeout(30)
+        )).unwrap()
+        
+        if admin_response.status_code == 200:
+            admin_result = admin_response.json()
+            if admin_result.get("success"):
+                logger.info('admin_registered', email=email, machine_id=machine_id)
+                machine_check_cache.invalidate(machine_id)
+            else:
+                error_message = admin_result.get('message', 'Unknown error')
+                logger.warning('admin_register_rejected', email=email, message=error_message)
+                # Trả về lỗi nếu server admin từ chối
+                return {
+                    'success': False,
+                    'message': f'Không thể đăng ký: {error_message}'
+                }, 400
+        else:
+            logger.warning('admin_register_failed', email=email, status=admin_response.status_code)
+            return {
+                'success': False,
+                'message': f'Lỗi server admin: {admin_response.status_code}'
+            }, 500
+    except (CircuitOpenError, DeadlineExceeded, BulkheadFull) as admin_error:
+        logger.warning('admin_register_unavailable', email=email, error=str(admin_error))
+        return admin_unavailable_response()
+    except Exception as admin_error:
+        # Lỗi khi đăng ký
+        logger.error('admin_register_error', email=email, error=str(admin_error))
+        return {
+            'success': False,
+            'message': f'Không thể kết nối đến server admin: {str(admin_error)}'
+        }, 500
+    return None
+
+def relogin_payload(email, name, auth_token):
+    """Kết quả đăng nhập lại thành công (verify và refresh dùng chung)"""
+    return {
+        'success': True,
+        'user_data': {
+            'email': email,
+            'name': name,
+            'auth_token': auth_token
+        },
+        'auth_token': auth_token,
+        'message': 'Đăng nhập lại thành công'
+    }
+
+def admin_unavailable_response():
+    """Server admin đang lỗi (breaker mở), quá tải hoặc hết thời gian: báo user thử lại, mã xác minh vẫn còn hiệu lực"""
+    return {
+        'success': False,
+        'message': 'Server admin tạm thời không phản hồi. Vui lòng thử lại sau ít phút.'
+    }, 503
+
+def prefetch_machine_check(machine_id):
+    """Gọi /api/check-machine trong thread nền, lưu kết quả vào machine_check_cache cho bước verify"""
+    def run():
+        check_response = upstream.call(UpstreamCall(
+            'POST', f"{ADMIN_SERVER_URL}/api/check-machine", stage='admin_check_machine_prefetch',
+            breaker=admin_breakers['check_machine'], bulkhead=upstream_bulkheads['admin'],
+            json={"machine_id": machine_id},
+            headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+            timeout=30
+        ))
+        if check_response.error is None and check_response.status_code == 200:
+            admin_keep_warm.mark_warm()
+            machine_check_cache.set(machine_id, check_response, ttl=MACHINE_PREFETCH_TTL)
+    
+    machine_prefetch_executor.submit(run)
 
 @app.route('/ping', methods=['GET'])
 def ping():
     """API ping để đánh thức server"""
     return jsonify({'status': 'ok'}), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metrics của worker hiện tại theo định dạng Prometheus"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return 'Unauthorized', 401
+    return REGISTRY.render(), 200, {'Content-Type': REGISTRY.CONTENT_TYPE}
+
 @app.route('/api/check-config', methods=['GET'])
 def check_config():
     """Kiểm tra cấu hình environment variables (chỉ hiển thị một phần để bảo mật)"""
@@ -667,34 +1690,226 @@ def check_config():
         'client_id_preview': GOOGLE_CLIENT_ID[:20] + '...' if GOOGLE_CLIENT_ID else None,
         'redirect_uri': GOOGLE_REDIRECT_URI if GOOGLE_REDIRECT_URI else None,
         'is_production': IS_PRODUCTION,
+        'upstream_pools': upstream.stats.snapshot(),
+        'admin_server_warm': admin_keep_warm.is_warm,
+        'machine_check_cache': machine_check_cache.stats(),
+        'verification_codes': code_allocator.stats(),
+        'verification_snapshot': verification_snapshots.stats() if verification_snapshots.enabled else False,
+        'verify_single_flight': verify_flights.stats(),
+        'device_waiters': len(device_waiters),
+        'remember_login': REMEMBER_LOGIN,
+        'register_write_behind': dict(registration_journal.stats(), **registration_flusher.stats())
+                                 if REGISTER_WRITE_BEHIND else False,
+        'diagnostics': {'profiling': profiler.running, 'tracemalloc': allocation_tracker.running}
+                       if DEBUG_TOKEN else False,
+        'circuit_breakers': {breaker.name: breaker.state for breaker in admin_breakers.values()},
+        'bulkheads': {
+            name: bulkhead.stats()
+            for name, bulkhead in list(endpoint_bulkheads.items()) + list(upstream_bulkheads.items())
+        },
         'status': 'ok' if (GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET and GOOGLE_REDIRECT_URI) else 'missing_config'
     }
     return jsonify(config_status), 200
 
+# ============================================
+# CHẨN ĐOÁN TRONG WORKER ĐANG CHẠY (profiler / tracemalloc theo yêu cầu, xem profiling.py)
+# ============================================
+# DEBUG_TOKEN: chưa set thì /debug/* trả 404; set thì yêu cầu header "Authorization: Bearer <token>".
+# Mỗi request chỉ chẩn đoán worker đã nhận nó (WEB_CONCURRENCY > 1: gọi nhiều lần hoặc dùng 1 worker).
+# Không dùng thì không có thread hay hook nào; profile tối đa MAX_PROFILE_SECONDS, tracemalloc tự tắt
+# sau TRACEMALLOC_MAX_SECONDS
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+TRACEMALLOC_MAX_SECONDS = float(os.getenv('TRACEMALLOC_MAX_SECONDS', 600))
+# Mặc định chỉ đếm stack của các luồng đăng nhập (bản Flask và bản async cùng tên)
+PROFILE_FUNCTIONS = frozenset({
+    'google_callback', 'google_callback_steps', 'verify_google_auth', 'verify_google_auth_steps',
+    'verify_rate_limited', 'google_auth_refresh', 'refresh_login_steps', 'google_auth_poll'
+})
+TRACEMALLOC_GROUP_BY = ('lineno', 'filename', 'traceback')
+
+profiler = SamplingProfiler()
+allocation_tracker = AllocationTracker(max_seconds=TRACEMALLOC_MAX_SECONDS)
+
+def debug_endpoint(view):
+    """Ẩn endpoint khi chưa cấu hình DEBUG_TOKEN, kiểm tra token khi đã cấu hình"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not DEBUG_TOKEN:
+            return 'Not Found', 404
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode('utf-8'), f'Bearer {DEBUG_TOKEN}'.encode('utf-8')):
+            return 'Unauthorized', 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def allocation_report_params(args):
+    """(limit, group_by, files) từ query string; ValueError nếu không hợp lệ"""
+    limit = int(args.get('limit', 20))
+    group_by = args.get('group_by', 'lineno')
+    if limit < 1 or group_by not in TRACEMALLOC_GROUP_BY:
+        raise ValueError('limit hoặc group_by không hợp lệ')
+    # ?file=verification_store.py&file=html_pages.py: chỉ tính cấp phát trong các file này
+    return limit, group_by, args.getlist('file')
+
+@app.route('/debug/profile', methods=['GET'])
+@debug_endpoint
+def debug_profile():
+    """Lấy mẫu stack trong ?seconds= giây, trả về collapsed stacks cho flamegraph.pl / speedscope"""
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 0.01))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'seconds/interval không hợp lệ'}), 400
+    if not (math.isfinite(seconds) and math.isfinite(interval)):
+        return jsonify({'success': False, 'error': 'seconds/interval không hợp lệ'}), 400
+    # ?all=1: mọi thread của worker (thread nền, pool upstream...), không chỉ luồng đăng nhập
+    functions = None if request.args.get('all') == '1' else PROFILE_FUNCTIONS
+    try:
+        stacks, ticks = profiler.profile(seconds, interval, functions)
+    except ProfileBusy as busy_error:
+        return jsonify({'success': False, 'error': str(busy_error)}), 409
+    logger.info('debug_profile', seconds=seconds, interval=interval, ticks=ticks, stacks=len(stacks))
+    return collapsed_stacks(stacks), 200, {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Cache-Control': 'no-store',
+        'X-Profile-Ticks': str(ticks),
+        'X-Profile-Pid': str(os.getpid()),
+    }
+
+@app.route('/debug/tracemalloc/start', methods=['POST'])
+@debug_endpoint
+def debug_tracemalloc_start():
+    """Bật tracemalloc (?frames= độ sâu traceback, >1 cho group_by=traceback) và lấy snapshot gốc cho diff"""
+    try:
+        frames = int(request.args.get('frames', 1))
+        seconds = float(request.args.get('seconds', TRACEMALLOC_MAX_SECONDS))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'frames/seconds không hợp lệ'}), 400
+    if not math.isfinite(seconds):
+        return jsonify({'success': False, 'error': 'frames/seconds không hợp lệ'}), 400
+    stops_in = allocation_tracker.start(frames, seconds)
+    logger.info('debug_tracemalloc_started', frames=frames, seconds=stops_in)
+    return jsonify({'success': True, 'pid': os.getpid(), 'stops_in_seconds': stops_in}), 200
+
+@app.route('/debug/tracemalloc/snapshot', methods=['GET'])
+@debug_endpoint
+def debug_tracemalloc_snapshot():
+    """Các dòng code đang giữ nhiều bộ nhớ nhất"""
+    return debug_tracemalloc_report(allocation_tracker.top)
+
+@app.route('/debug/tracemalloc/diff', methods=['GET'])
+@debug_endpoint
+def debug_tracemalloc_diff():
+    """Các dòng code tăng bộ nhớ nhiều nhất kể từ /debug/tracemalloc/start"""
+    return debug_tracemalloc_report(allocation_tracker.diff)
+
+def debug_tracemalloc_report(report):
+    try:
+        limit, group_by, files = allocation_report_params(request.args)
+    except ValueError as params_error:
+        return jsonify({'success': False, 'error': str(params_error)}), 400
+    result = report(limit, group_by, files)
+    if result is None:
+        return jsonify({'success': False, 'error': 'tracemalloc chưa bật (POST /debug/tracemalloc/start)'}), 409
+    return jsonify(dict(result, success=True, pid=os.getpid(), store_size=len(verification_store))), 200
+
+@app.route('/debug/tracemalloc/stop', methods=['POST'])
+@debug_endpoint
+def debug_tracemalloc_stop():
+    """Tắt tracemalloc, trả lại chi phí cấp phát bình thường"""
+    allocation_tracker.stop()
+    logger.info('debug_tracemalloc_stopped')
+    return jsonify({'success': True, 'pid': os.getpid()}), 200
+
 # ============================================
 # DỌN DẸP MÃ HẾT HẠN
 # ============================================
 
 def cleanup_expired_codes():
-    """Xóa các mã đã hết hạn"""
-    current_time = time.time()
-    expired_codes = [
-        code for code, data in verification_store.items()
-        if data['expires_at'] < current_time
-    ]
-    for code in expired_codes:
-        del verification_store[code]
-    if expired_codes:
-        print(f"[CLEANUP] Removed {len(expired_codes)} expired codes")
-
-# Chạy cleanup mỗi phút
+    """Xóa các mã đã hết hạn (chỉ duyệt các mã thực sự hết hạn)"""
+    removed = verification_store.expire()
+    if removed:
+        logger.info('cleanup_expired_codes', removed=removed)
+    expired_refresh_tokens = refresh_tokens.expire()
+    if expired_refresh_tokens:
+        logger.info('cleanup_expired_refresh_tokens', removed=expired_refresh_tokens)
+
+# Chạy cleanup mỗi phút (dừng khi stop_background_jobs)
+cleanup_stop = threading.Event()
+cleanup_thread = None
+
 def cleanup_worker():
-    while True:
-        time.sleep(60)  # Mỗi phút
+    while not cleanup_stop.wait(60):  # Mỗi phút
         cleanup_expired_codes()
 
-cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
-cleanup_thread.start()
+# ============================================
+# TÁC VỤ NỀN (dọn mã hết hạn, giữ server admin thức, làm mới khóa Google)
+# ============================================
+# Thread tạo lúc import không sống sót qua fork: chạy bằng gunicorn.conf.py (BACKGROUND_JOBS_POST_FORK=1)
+# thì hook của gunicorn gọi start_background_jobs() trong từng worker sau khi fork, kể cả khi --preload.
+# Chạy trực tiếp, uvicorn hoặc gunicorn không có file cấu hình: khởi động ngay khi import như trước
+_background_jobs_pid = None
+_background_jobs_stopped_pid = None
+
+def start_background_jobs():
+    """Khởi động thread nền một lần cho mỗi process (gọi lại trong cùng process không có tác dụng)"""
+    global cleanup_thread, _background_jobs_pid
+    if _background_jobs_pid == os.getpid():
+        return
+    _background_jobs_pid = os.getpid()
+    
+    # Nạp mã của process trước (snapshot lúc tắt) trong nền, không chặn khởi động
+    verification_snapshots.start()
+    
+    # Backend redis dùng TTL của Redis nên không cần thread dọn dẹp
+    cleanup_stop.clear()
+    if verification_store.needs_cleanup:
+        cleanup_thread = threading.Thread(target=cleanup_worker, name='cleanup-expired-codes', daemon=True)
+        cleanup_thread.start()
+    
+    if ADMIN_KEEP_WARM_INTERVAL > 0:
+        admin_keep_warm.start()
+    
+    # Tải và làm mới khóa JWKS của Google trong nền
+    if GOOGLE_ID_TOKEN_LOCAL:
+        google_jwks.start()
+    
+    # Replay yêu cầu đăng ký chưa gửi (của process trước khi restart hoặc worker đã chết) rồi gửi dần
+    if REGISTER_WRITE_BEHIND:
+        replayed = registration_journal.open()
+        if replayed:
+            logger.info('register_journal_replayed', count=replayed)
+        registration_flusher.start()
+
+def stop_background_jobs(timeout=5.0):
+    """Tắt worker êm: dừng thread nền, bỏ các prefetch chưa chạy, ghi nốt log còn trong hàng đợi"""
+    global _background_jobs_stopped_pid
+    # Lifespan của bản ASGI và worker_exit của gunicorn đều gọi: chỉ chạy một lần mỗi process
+    if _background_jobs_stopped_pid == os.getpid():
+        return
+    _background_jobs_stopped_pid = os.getpid()
+    cleanup_stop.set()
+    admin_keep_warm.stop()
+    google_jwks.stop()
+    machine_prefetch_executor.shutdown(wait=False, cancel_futures=True)
+    # Profile đang chạy trả về ngay các mẫu đã lấy, tracemalloc tắt
+    profiler.cancel()
+    allocation_tracker.stop()
+    # Yêu cầu đăng ký chưa gửi vẫn nằm trong journal, process khác/lần chạy sau sẽ replay
+    registration_flusher.stop(timeout)
+    # Ghi mã còn hạn để worker/instance mới nạp lại
+    if verification_snapshots.enabled:
+        try:
+            saved = verification_snapshots.stop(timeout)
+            logger.info('verification_snapshot_saved', count=saved,
+                        seconds=verification_snapshots.last_save_seconds)
+        except Exception as snapshot_error:
+            logger.error('verification_snapshot_error', error=str(snapshot_error))
+    logger.info('background_jobs_stopped', pid=os.getpid())
+    logger.close(timeout)
+
+if os.getenv('BACKGROUND_JOBS_POST_FORK') != '1':
+    start_background_jobs()
 
 # ============================================
 # CHẠY SERVER
@@ -703,7 +1918,7 @@ cleanup_thread.start()
 if __name__ == '__main__':
     """
     Chỉ chạy development server khi chạy local
-    Production nên dùng: gunicorn server_google_oauth_example:app
+    Production nên dùng: gunicorn -c gunicorn.conf.py server_google_oauth_example:app
     """
     print("=" * 50)
     print("Google OAuth Server cho Video Translator")
@@ -712,14 +1927,18 @@ if __name__ == '__main__':
     print(f"Redirect URI: {GOOGLE_REDIRECT_URI if GOOGLE_REDIRECT_URI else 'N/A'}")
     print("=" * 50)
     print("\nEndpoints:")
-    print("  GET  /api/google-auth")
+    print("  GET  /api/google-auth[?machine_id=...][&device=1][&remember=1]")
+    print("  GET  /api/google-auth/poll?handle=...[&machine_id=...]")
     print("  GET  /api/google-callback")
     print("  POST /api/verify-google-auth")
+    print("  POST /api/google-auth/refresh")
     print("  GET  /ping")
     print("  GET  /api/check-config")
+    print("  GET  /metrics")
+    print("  GET  /debug/profile, /debug/tracemalloc/* (khi có DEBUG_TOKEN)")
     print("\n⚠️  LƯU Ý:")
     print("1. Đây là DEVELOPMENT SERVER - chỉ dùng để test local")
-    print("2. Production nên dùng: gunicorn server_google_oauth_example:app")
+    print("2. Production nên dùng: gunicorn -c gunicorn.conf.py server_google_oauth_example:app")
     print("3. Cập nhật GOOGLE_CLIENT_ID và GOOGLE_CLIENT_SECRET trong env vars")
     print("4. Cập nhật GOOGLE_REDIRECT_URI trong Google Cloud Console")
     print("=" * 50)
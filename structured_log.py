@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Logger có cấu trúc (JSON lines) không chặn request
+Request chỉ đưa bản ghi vào hàng đợi giới hạn; thread nền định dạng, che dữ liệu nhạy cảm
+và ghi theo lô ra stdout. Consumer log chậm không làm treo worker, chỉ làm rơi bản ghi.
+"""
+
+import atexit
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+# Hàng đợi đầy: 'newest' = bỏ bản ghi mới đến, 'oldest' = bỏ bản ghi cũ nhất đang chờ
+DROP_POLICIES = ('newest', 'oldest')
+
+# Trường được che trước khi ghi
+EMAIL_KEYS = frozenset({'email', 'existing_email'})
+CODE_KEYS = frozenset({'code', 'auth_code', 'verification_code'})
+SECRET_KEYS = frozenset({'auth_token', 'access_token', 'id_token', 'refresh_token', 'client_secret'})
+
+_EMAIL_RE = re.compile(r'([A-Za-z0-9._%+-])[A-Za-z0-9._%+-]*@([A-Za-z0-9.-]+)')
+
+
+def mask_email(value):
+    """abc@gmail.com -> a***@gmail.com"""
+    local, _, domain = str(value).partition('@')
+    return f"{local[:1]}***@{domain}" if domain else '***'
+
+
+def mask_code(value):
+    """123456 -> 12****"""
+    value = str(value)
+    return value[:2] + '*' * (len(value) - 2) if len(value) > 4 else '***'
+
+
+def mask_fields(fields):
+    """Che email/mã/token theo tên trường, và email lẫn trong chuỗi tự do (message, error...)"""
+    masked = {}
+    for key, value in fields.items():
+        if value is None or value == '':
+            masked[key] = value
+        elif key in SECRET_KEYS:
+            masked[key] = '***'
+        elif key in EMAIL_KEYS:
+            masked[key] = mask_email(value)
+        elif key in CODE_KEYS:
+            masked[key] = mask_code(value)
+        elif isinstance(value, str) and '@' in value:
+            masked[key] = _EMAIL_RE.sub(r'\1***@\2', value)
+        else:
+            masked[key] = value
+    return masked
+
+
+class StructuredLogger:
+    """
+    logger.info('event', key=value, ...) -> {"ts": ..., "level": "info", "event": "event", "key": ...}
+    debug được lấy mẫu theo debug_sample_rate; warning/error luôn được giữ (trừ khi hàng đợi đầy)
+    """
+
+    def __init__(self, stream=None, level='info', max_queue=10000, drop_policy='newest',
+                 debug_sample_rate=0.1, mask=True, asynchronous=True, enabled=True, batch_size=512):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"drop_policy phải là một trong {DROP_POLICIES}")
+        self.stream = stream
+        self.level = LEVELS.get(str(level).lower(), LEVELS['info'])
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+        self.debug_sample_rate = debug_sample_rate
+        self.mask = mask
+        self.asynchronous = asynchronous
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.written_total = 0
+        self.dropped_total = 0
+        self.sampled_out_total = 0
+        self._write_lock = threading.Lock()
+        self._reset()
+        atexit.register(self.close)
+
+    def _reset(self):
+        # Gọi lại sau fork: thread ghi của process cha không tồn tại trong worker
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._closed = False
+        self._thread = None
+        self._pid = os.getpid()
+
+    # --------------------------------------------
+    # Đường request: chỉ kiểm tra mức, lấy mẫu và đưa vào hàng đợi
+    # --------------------------------------------
+
+    def log(self, level, event, **fields):
+        levelno = LEVELS[level]
+        if not self.enabled or levelno < self.level:
+            return
+        if levelno == LEVELS['debug'] and random.random() >= self.debug_sample_rate:
+            self.sampled_out_total += 1
+            return
+        record = (time.time(), level, event, fields)
+        if not self.asynchronous:
+            self._write([record])
+            return
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if len(self._queue) >= self.max_queue:
+                self.dropped_total += 1
+                if self.drop_policy == 'newest':
+                    return
+                self._queue.popleft()
+            self._queue.append(record)
+            self._idle.clear()
+        if self._thread is None:
+            self._start()
+        self._wakeup.set()
+
+    def debug(self, event, **fields):
+        self.log('debug', event, **fields)
+
+    def info(self, event, **fields):
+        self.log('info', event, **fields)
+
+    def warning(self, event, **fields):
+        self.log('warning', event, **fields)
+
+    def error(self, event, **fields):
+        self.log('error', event, **fields)
+
+    def exception(self, event, **fields):
+        """Như error() và kèm traceback của exception đang xử lý"""
+        self.log('error', event, traceback=traceback.format_exc(), **fields)
+
+    # --------------------------------------------
+    # Thread ghi
+    # --------------------------------------------
+
+    def _format(self, record):
+        created, level, event, fields = record
+        ts = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(created)) + f".{int(created % 1 * 1000):03d}Z"
+        data = {'ts': ts, 'level': level, 'event': event}
+        data.update(mask_fields(fields) if self.mask else fields)
+        return json.dumps(data, ensure_ascii=False, default=str) + '\n'
+
+    def _write(self, records):
+        try:
+            text = ''.join(self._format(record) for record in records)
+            stream = self.stream or sys.stdout
+            with self._write_lock:
+                stream.write(text)
+                stream.flush()
+            self.written_total += len(records)
+        except Exception:
+            self.dropped_total += len(records)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._lock:
+                    if not self._queue:
+                        self._idle.set()
+                        break
+                    count = min(len(self._queue), self.batch_size)
+                    batch = [self._queue.popleft() for _ in range(count)]
+                self._write(batch)
+            if self._closed:
+                return
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='structured-log-writer', daemon=True)
+                self._thread.start()
+
+    def flush(self, timeout=5.0):
+        """Chờ thread nền ghi hết hàng đợi; trả về True nếu đã ghi xong"""
+        if self._thread is None or self._pid != os.getpid():
+            return True
+        return self._idle.wait(timeout)
+
+    def close(self, timeout=5.0):
+        self.flush(timeout)
+        self._closed = True
+        self._wakeup.set()
+
+    def stats(self):
+        return {'queued': len(self._queue), 'written': self.written_total,
+                'dropped': self.dropped_total, 'sampled_out': self.sampled_out_total}
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Fixture dùng chung: server admin giả lập (mock_upstreams) và server_google_oauth_example import một lần
+với cấu hình test (không thread nền, không log, không giới hạn tần suất)
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_upstreams import StandInServer, admin_routes  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def admin():
+    """Server admin giả lập; admin.machines = {machine_id: email} đã đăng ký"""
+    machines = {}
+    server = StandInServer(routes=admin_routes(machines)).start()
+    server.machines = machines
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='session')
+def oauth_server(admin):
+    os.environ.update({
+        'GOOGLE_CLIENT_ID': 'test-client-id',
+        'GOOGLE_CLIENT_SECRET': 'test-client-secret',
+        'GOOGLE_REDIRECT_URI': 'http://127.0.0.1/api/google-callback',
+        'OAUTH_STATE_KEYS': 'test-state-key',
+        'ADMIN_SERVER_URL': admin.url,
+        'ADMIN_KEEP_WARM_INTERVAL': '0',
+        'GOOGLE_ID_TOKEN_LOCAL': '0',
+        'BACKGROUND_JOBS_POST_FORK': '1',
+        'LOG_ENABLED': '0',
+        'VERIFY_RATE_PER_IP': '100000000',
+        'VERIFY_BURST_PER_IP': '100000000',
+        'VERIFY_RATE_PER_MACHINE': '100000000',
+        'VERIFY_BURST_PER_MACHINE': '100000000',
+    })
+    import server_google_oauth_example
+    return server_google_oauth_example
+
+
+@pytest.fixture
+def srv(oauth_server, admin, monkeypatch):
+    """Server với admin giả lập sạch: không máy nào đã đăng ký, breaker đóng, cache rỗng"""
+    admin.reset_counters()
+    admin.machines.clear()
+    admin.latency.clear()
+    admin.fail_status = None
+    for breaker in oauth_server.admin_breakers.values():
+        breaker.record_success()
+    monkeypatch.setattr(oauth_server, 'machine_check_cache', type(oauth_server.machine_check_cache)())
+    oauth_server.admin_keep_warm.mark_warm()
+    yield oauth_server
+    admin.fail_status = None
+    admin.latency.clear()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Bản ASGI: I/O đồng bộ của các bước xử lý không chặn event loop, lifespan shutdown dừng thread nền"""
+
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+@pytest.fixture
+def async_server(srv):
+    import async_server
+    return async_server
+
+
+async def asgi_request(app, method, path, body=b''):
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+             'headers': [(b'content-type', b'application/json')], 'client': ('127.0.0.1', 50000)}
+    await app(scope, receive, send)
+    return sent[0]['status'], json.loads(b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+class SlowStore:
+    """Kho mã có pop chậm như Redis/đĩa đang nghẽn"""
+
+    def __init__(self, store, delay):
+        self._store = store
+        self.delay = delay
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+    def __contains__(self, code):
+        return code in self._store
+
+    def pop(self, code):
+        time.sleep(self.delay)
+        return self._store.pop(code)
+
+
+def test_slow_store_does_not_block_event_loop(async_server, srv, monkeypatch):
+    monkeypatch.setattr(srv, 'verification_store', SlowStore(srv.verification_store, delay=0.3))
+    srv.verification_store.put('asgi-slow', 'slow@example.com', 'Slow')
+
+    async def main():
+        lags = []
+
+        async def ticker(stop):
+            while not stop.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - start - 0.01)
+
+        stop = asyncio.Event()
+        ticking = asyncio.create_task(ticker(stop))
+        await asyncio.sleep(0.05)  # Ticker đã chạy trước khi request bắt đầu
+        try:
+            result = await asgi_request(async_server.app, 'POST', '/api/verify-google-auth',
+                                        json.dumps({'auth_code': 'asgi-slow', 'machine_id': 'm-asgi'}).encode())
+        finally:
+            stop.set()
+            await ticking
+            await async_server.async_upstream.close()
+        return result, max(lags)
+
+    (status, payload), max_lag = asyncio.run(main())
+    assert status == 200 and payload['success']
+    assert max_lag < 0.15
+
+
+def test_lifespan_shutdown_stops_background_jobs(async_server, monkeypatch):
+    stopped = []
+    monkeypatch.setattr(async_server.sync_server, 'stop_background_jobs', lambda: stopped.append(True))
+    monkeypatch.setattr(async_server, 'step_executor', ThreadPoolExecutor(max_workers=1))
+
+    async def main():
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await async_server.app({'type': 'lifespan'}, receive, send)
+        return sent
+
+    assert asyncio.run(main()) == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert stopped == [True]
+
+
+def test_cancelled_half_open_trial_releases_breaker(async_server):
+    from upstream_client import CircuitBreaker, UpstreamCall
+
+    async def hang(request):
+        await asyncio.sleep(60)
+
+    async def scenario():
+        client = async_server.AsyncUpstreamClient()
+        client._client = async_server.httpx.AsyncClient(transport=async_server.httpx.MockTransport(hang))
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        task = asyncio.ensure_future(client.call(UpstreamCall('GET', 'http://upstream.test/', breaker=breaker)))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await client.close()
+        return breaker
+
+    breaker = asyncio.run(scenario())
+    # Lượt thử bị hủy không giữ breaker kẹt ở half_open: lời gọi kế tiếp vẫn được thử
+    assert breaker.allow()
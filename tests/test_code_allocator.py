@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""CodeAllocator: bộ đếm khớp với số mã thật sự đã cấp khi nhiều thread cấp mã cùng lúc"""
+
+import threading
+
+from code_allocator import CodeAllocator
+from verification_store import MemoryVerificationStore
+
+
+def test_counters_exact_under_concurrency():
+    store = MemoryVerificationStore(max_entries=100000)
+    taken = [f"{i:03d}" for i in range(0, 1000, 2)]
+    for code in taken:
+        # Mã do worker khác giữ (bitmap không biết): allocate phải va chạm rồi chọn mã khác
+        store.put(code, 'other@example.com', 'Other')
+    # grow_at=1: dùng hết không gian 3 chữ số, ~một nửa lần chọn va chạm; overflow khi bitmap đầy
+    allocator = CodeAllocator(store, ttl=300, length=3, grow_at=1.0, overflow_length=8)
+    threads, per_thread = 8, 100
+    barrier = threading.Barrier(threads)
+
+    def worker():
+        barrier.wait()
+        for _ in range(per_thread):
+            allocator.allocate('user@example.com', 'User')
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    assert allocator.allocated_total == threads * per_thread
+    assert len(store) == len(taken) + threads * per_thread
+    # Mỗi mã bị giữ sẵn va chạm đúng một lần (bit của nó được đánh dấu sau lần đầu)
+    assert allocator.collisions_total == len(taken)
+    assert allocator.overflow_total == threads * per_thread - (1000 - len(taken))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Device flow: URL đăng nhập không lộ handle, poll chỉ khớp machine_id đã tạo handle,
+poll và mã gõ tay dùng chung một mã (một lần đăng nhập = một phiên, một lần /api/register)
+"""
+
+import base64
+import json
+import re
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from mock_upstreams import StandInServer, generate_rsa_key, google_routes
+from rate_limit import create_rate_limiter
+
+
+@pytest.fixture(scope='module')
+def google():
+    server = StandInServer(routes=google_routes('test-client-id', generate_rsa_key(1024), id_token=False)).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def device_srv(srv, google, monkeypatch):
+    monkeypatch.setattr(srv, 'GOOGLE_TOKEN_URL', f"{google.url}/token")
+    monkeypatch.setattr(srv, 'GOOGLE_USERINFO_URL', f"{google.url}/userinfo")
+    return srv
+
+
+def start_device_login(client, machine_id, google_code):
+    """App gọi /api/google-auth?device=1, user đăng nhập xong (callback); trả về (JSON của app, mã 6 số, state)"""
+    login = client.get('/api/google-auth', query_string={'device': '1', 'machine_id': machine_id}).get_json()
+    state = parse_qs(urlparse(login['auth_url']).query)['state'][0]
+    page = client.get('/api/google-callback', query_string={'code': google_code, 'state': state})
+    assert page.status_code == 200
+    code = re.search(r'<div class="code">(\d+)</div>', page.get_data(as_text=True)).group(1)
+    return login, code, state
+
+
+def poll(client, url, **params):
+    # poll_url của app đã có handle (+ machine_id) trong query
+    parsed = urlparse(url)
+    query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+    response = client.get(parsed.path, query_string=dict(query, timeout='0', **params))
+    return response.status_code, response.get_json()
+
+
+def verify(client, code, machine_id):
+    response = client.post('/api/verify-google-auth', json={'auth_code': code, 'machine_id': machine_id})
+    return response.status_code, response.get_json()
+
+
+def test_state_does_not_carry_handle(device_srv):
+    client = device_srv.app.test_client()
+    login = client.get('/api/google-auth', query_string={'device': '1', 'machine_id': 'm-1'}).get_json()
+    state = parse_qs(urlparse(login['auth_url']).query)['state'][0]
+    payload = state.split('.')[0]
+    body = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    assert login['handle'] not in login['auth_url']
+    assert login['handle'] not in json.dumps(body)
+
+
+def test_poll_from_other_machine_gets_nothing(device_srv, admin):
+    client = device_srv.app.test_client()
+    login, _, state = start_device_login(client, 'm-victim', 'victim')
+
+    # Kẻ tấn công biết handle nhưng poll bằng machine_id của mình: không khớp key, không nhận token
+    status, payload = poll(client, '/api/google-auth/poll', handle=login['handle'], machine_id='m-attacker')
+    assert status == 202 and 'auth_token' not in payload
+    # device_key trong state (thấy được qua URL đăng nhập) không dùng được như mã xác minh
+    state_body = state.split('.')[0]
+    device_state_key = json.loads(base64.urlsafe_b64decode(state_body + '=' * (-len(state_body) % 4)))['d']['device']
+    status, payload = verify(client, device_srv.DEVICE_CODE_PREFIX + device_state_key, 'm-attacker')
+    assert status == 400 and 'auth_token' not in payload
+
+    status, payload = poll(client, login['poll_url'])
+    assert status == 200 and payload['auth_token']
+    assert admin.calls['/api/register'] == 1
+
+
+def test_poll_consumes_typed_code(device_srv, admin):
+    client = device_srv.app.test_client()
+    login, code, _ = start_device_login(client, 'm-poll-first', 'poll-first')
+
+    status, payload = poll(client, login['poll_url'])
+    assert status == 200 and payload['auth_token']
+    status, payload = verify(client, code, 'm-poll-first')
+    assert status == 400 and 'auth_token' not in payload
+    assert admin.calls['/api/register'] == 1
+
+
+def test_typed_code_consumes_poll(device_srv, admin):
+    client = device_srv.app.test_client()
+    login, code, _ = start_device_login(client, 'm-typed-first', 'typed-first')
+
+    status, payload = verify(client, code, 'm-typed-first')
+    assert status == 200 and payload['auth_token']
+    # Poll thức dậy với kết quả dứt khoát (không chờ mãi) nhưng không có phiên thứ hai
+    status, payload = poll(client, login['poll_url'])
+    assert status == 400 and 'auth_token' not in payload
+    assert admin.calls['/api/register'] == 1
+
+
+def test_poll_is_rate_limited(device_srv, monkeypatch):
+    monkeypatch.setattr(device_srv, 'verify_ip_limiter', create_rate_limiter('memory', rate=0.001, burst=2))
+    client = device_srv.app.test_client()
+    statuses = [poll(client, '/api/google-auth/poll', handle=f'guess-{i}', machine_id='m-x')[0] for i in range(3)]
+    assert statuses == [202, 202, 429]
+
+
+def test_device_entry_links_code_in_its_own_field(device_srv):
+    client = device_srv.app.test_client()
+    login, code, _ = start_device_login(client, 'm-link', 'link-user')
+    device_entry_key = device_srv.DEVICE_CODE_PREFIX + device_srv.device_key(login['handle'], 'm-link')
+    entry = device_srv.verification_store.get(device_entry_key)
+    assert entry.link == code
+    assert entry.name != code and entry.email == device_srv.verification_store.get(code).email
+
+
+def test_poll_has_its_own_bulkhead(device_srv, monkeypatch):
+    # Long-poll đang giữ hết chỗ: poll mới nhận 503 + Retry-After ngay, /ping vẫn được phục vụ
+    bulkhead = device_srv.endpoint_bulkheads['google_auth_poll']
+    monkeypatch.setattr(bulkhead, 'max_concurrent', 1)
+    client = device_srv.app.test_client()
+    assert bulkhead.acquire()
+    try:
+        response = client.get('/api/google-auth/poll', query_string={'handle': 'x' * 43, 'timeout': '0'})
+        assert response.status_code == 503 and response.headers['Retry-After']
+        assert client.get('/ping').status_code == 200
+    finally:
+        bulkhead.release()
+    status, _ = poll(client, '/api/google-auth/poll', handle='x' * 43)
+    assert status == 202
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+verify_id_token: các trường hợp phải bị từ chối và làm mới JWKS khi gặp kid lạ
+"""
+
+import io
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from google_id_token import GoogleJWKSCache, IdTokenError, verify_id_token
+from mock_upstreams import generate_rsa_key, jwk_from_key, sign_jwt
+from structured_log import StructuredLogger
+
+CLIENT_ID = 'test-client-id'
+
+
+class FakeJWKSClient:
+    """Client HTTP giả: GET trả về JWKS gồm các khóa trong self.keys"""
+
+    def __init__(self, *keys):
+        self.keys = list(keys)
+        self.calls = 0
+
+    def get(self, url, timeout=None):
+        self.calls += 1
+        body = {'keys': [jwk_from_key(key) for key in self.keys]}
+        return SimpleNamespace(status_code=200, headers={'Cache-Control': 'max-age=3600'}, json=lambda: body)
+
+
+@pytest.fixture(scope='module')
+def key():
+    return generate_rsa_key(1024)
+
+
+@pytest.fixture
+def jwks(key):
+    cache = GoogleJWKSCache(FakeJWKSClient(key))
+    assert cache.refresh()
+    return cache
+
+
+def make_claims(**overrides):
+    now = int(time.time())
+    claims = {'iss': 'https://accounts.google.com', 'aud': CLIENT_ID, 'sub': '1234',
+              'email': 'user@example.com', 'email_verified': True, 'name': 'User', 'iat': now, 'exp': now + 3600}
+    claims.update(overrides)
+    return claims
+
+
+def test_valid_token_accepted(jwks, key):
+    claims = verify_id_token(sign_jwt(make_claims(), key), jwks, CLIENT_ID)
+    assert claims['email'] == 'user@example.com'
+
+
+def test_tampered_signature_rejected(jwks, key):
+    header, payload, signature = sign_jwt(make_claims(), key).split('.')
+    forged = sign_jwt(make_claims(email='attacker@example.com'), key).split('.')[1]
+    with pytest.raises(IdTokenError, match='Chữ ký'):
+        verify_id_token(f"{header}.{forged}.{signature}", jwks, CLIENT_ID)
+    flipped = signature[:-2] + ('AA' if signature[-2:] != 'AA' else 'BA')
+    with pytest.raises(IdTokenError, match='Chữ ký'):
+        verify_id_token(f"{header}.{payload}.{flipped}", jwks, CLIENT_ID)
+
+
+@pytest.mark.parametrize('overrides, message', [
+    ({'aud': 'other-client-id'}, 'audience'),
+    ({'iss': 'https://evil.example.com'}, 'issuer'),
+    ({'exp': int(time.time()) - 3600, 'iat': int(time.time()) - 7200}, 'hết hạn'),
+    ({'email_verified': False}, 'xác minh'),
+    ({'email_verified': None}, 'xác minh'),
+])
+def test_bad_claims_rejected(jwks, key, overrides, message):
+    with pytest.raises(IdTokenError, match=message):
+        verify_id_token(sign_jwt(make_claims(**overrides), key), jwks, CLIENT_ID)
+
+
+def test_unknown_kid_triggers_jwks_refresh(key):
+    rotated = generate_rsa_key(1024)
+    client = FakeJWKSClient(key)
+    cache = GoogleJWKSCache(client).start()
+    try:
+        deadline = time.monotonic() + 5
+        while cache.refreshes_total < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Google vừa xoay khóa: JWKS đã có khóa mới nhưng cache chưa tải lại
+        client.keys.append(rotated)
+        token = sign_jwt(make_claims(), rotated)
+        # kid lạ -> từ chối ngay, không gọi mạng trên luồng request, đánh thức thread nền
+        with pytest.raises(IdTokenError, match='kid'):
+            verify_id_token(token, cache, CLIENT_ID)
+        while cache.refreshes_total < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.refreshes_total == 2
+        assert verify_id_token(token, cache, CLIENT_ID)['email'] == 'user@example.com'
+    finally:
+        cache.stop()
+
+
+def test_refresh_error_goes_to_structured_log():
+    class BrokenClient:
+        def get(self, url, timeout=None):
+            raise ConnectionError('connection refused')
+
+    stream = io.StringIO()
+    cache = GoogleJWKSCache(BrokenClient(), logger=StructuredLogger(stream=stream, asynchronous=False))
+    assert not cache.refresh()
+    record = json.loads(stream.getvalue())
+    assert record['level'] == 'error' and record['event'] == 'google_jwks_refresh_error'
+    assert 'connection refused' in record['error']
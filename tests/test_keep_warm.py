@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Verify không ping server admin khi server đang warm; khi cold chỉ đánh thức một lần"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def verify(srv, code, machine_id, email=None):
+    srv.verification_store.put(code, email or f"{code}@example.com", code)
+    response = srv.app.test_client().post('/api/verify-google-auth',
+                                          json={'auth_code': code, 'machine_id': machine_id})
+    return response.status_code
+
+
+def test_warm_verify_makes_no_ping(srv, admin):
+    assert srv.admin_keep_warm.is_warm
+    # Máy mới (check-machine + register) và đăng nhập lại (check-machine + login)
+    assert verify(srv, 'warm-new', 'm-warm') == 200
+    assert verify(srv, 'warm-again', 'm-warm', email='warm-new@example.com') == 200
+
+    assert admin.calls['/api/register'] == 1
+    assert admin.calls['/api/login'] == 1
+    assert admin.calls['/ping'] == 0
+
+
+def test_cold_admin_woken_once_for_concurrent_verifies(srv, admin):
+    srv.admin_keep_warm.mark_cold()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        statuses = list(pool.map(lambda i: verify(srv, f'cold-{i}', f'm-cold-{i}'), range(4)))
+
+    assert statuses == [200] * 4
+    assert admin.calls['/ping'] == 1
+    assert srv.admin_keep_warm.is_warm
+
+    assert verify(srv, 'cold-after', 'm-cold-after') == 200
+    assert admin.calls['/ping'] == 1
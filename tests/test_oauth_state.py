@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Luồng trình duyệt: state chỉ dùng được ở trình duyệt đã bắt đầu đăng nhập (cookie nonce), chống login CSRF
+"""
+
+import re
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from mock_upstreams import StandInServer, generate_rsa_key, google_routes
+
+
+@pytest.fixture(scope='module')
+def google():
+    server = StandInServer(routes=google_routes('test-client-id', generate_rsa_key(1024), id_token=False)).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def browser_srv(srv, google, monkeypatch):
+    monkeypatch.setattr(srv, 'GOOGLE_TOKEN_URL', f"{google.url}/token")
+    monkeypatch.setattr(srv, 'GOOGLE_USERINFO_URL', f"{google.url}/userinfo")
+    return srv
+
+
+def start_login(client):
+    response = client.get('/api/google-auth', query_string={'machine_id': 'm-browser'})
+    assert response.status_code == 302
+    return parse_qs(urlparse(response.headers['Location']).query)['state'][0]
+
+
+def callback(client, state, google_code='browser-user'):
+    response = client.get('/api/google-callback', query_string={'code': google_code, 'state': state})
+    return response.status_code, response.get_data(as_text=True)
+
+
+def test_state_cookie_is_httponly_and_scoped(browser_srv):
+    response = browser_srv.app.test_client().get('/api/google-auth')
+    cookie = response.headers['Set-Cookie']
+    assert cookie.startswith(browser_srv.OAUTH_STATE_COOKIE + '=')
+    assert 'HttpOnly' in cookie and 'SameSite=Lax' in cookie and 'Path=/api/google-callback' in cookie
+
+
+def test_callback_in_starting_browser_succeeds(browser_srv):
+    client = browser_srv.app.test_client()
+    status, html = callback(client, start_login(client))
+    assert status == 200 and re.search(r'<div class="code">\d+</div>', html)
+
+
+def test_state_replayed_in_other_browser_rejected(browser_srv):
+    # Kẻ tấn công tự bắt đầu đăng nhập rồi gửi link callback (state + code của mình) cho nạn nhân
+    attacker = browser_srv.app.test_client()
+    state = start_login(attacker)
+    victim = browser_srv.app.test_client()
+    status, _ = callback(victim, state)
+    assert status == 400
+
+    # Nạn nhân có cookie của lần đăng nhập khác: nonce không khớp
+    start_login(victim)
+    status, _ = callback(victim, state)
+    assert status == 400
+
+
+def test_device_state_needs_no_cookie(browser_srv):
+    app_client = browser_srv.app.test_client()
+    login = app_client.get('/api/google-auth', query_string={'device': '1', 'machine_id': 'm-device'}).get_json()
+    state = parse_qs(urlparse(login['auth_url']).query)['state'][0]
+    status, _ = callback(browser_srv.app.test_client(), state, 'device-user')
+    assert status == 200
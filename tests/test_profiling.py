@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+/debug/profile và /debug/tracemalloc/start: tham số không hữu hạn bị từ chối, thời hạn luôn có giới hạn
+"""
+
+import math
+
+import pytest
+
+from profiling import MIN_TRACEMALLOC_SECONDS, AllocationTracker, SamplingProfiler
+
+
+@pytest.fixture
+def debug_client(srv, monkeypatch):
+    monkeypatch.setattr(srv, 'DEBUG_TOKEN', 'debug-token')
+    client = srv.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer debug-token'
+    return client
+
+
+@pytest.mark.parametrize('query', [{'seconds': 'nan'}, {'interval': 'nan'}, {'seconds': 'inf'}])
+def test_profile_rejects_non_finite(debug_client, srv, query):
+    response = debug_client.get('/debug/profile', query_string=dict({'seconds': '0'}, **query))
+    assert response.status_code == 400
+    assert not srv.profiler.running
+
+
+def test_profile_endpoint_still_samples(debug_client):
+    response = debug_client.get('/debug/profile', query_string={'seconds': '0.05', 'all': '1'})
+    assert response.status_code == 200 and int(response.headers['X-Profile-Ticks']) > 0
+
+
+def test_tracemalloc_start_rejects_non_finite(debug_client):
+    response = debug_client.post('/debug/tracemalloc/start', query_string={'seconds': 'nan'})
+    assert response.status_code == 400
+
+
+def test_profiler_rejects_nan_directly():
+    with pytest.raises(ValueError):
+        SamplingProfiler().profile(math.nan)
+    with pytest.raises(ValueError):
+        SamplingProfiler().profile(1.0, interval=math.nan)
+
+
+def test_allocation_tracker_clamps_seconds():
+    tracker = AllocationTracker(max_seconds=60)
+    try:
+        assert tracker.start(seconds=-5) == MIN_TRACEMALLOC_SECONDS
+        assert tracker.start(seconds=600) == 60
+        with pytest.raises(ValueError):
+            tracker.start(seconds=math.nan)
+    finally:
+        tracker.stop()
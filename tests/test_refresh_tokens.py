@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Refresh token: bản mã AES-GCM gắn với bản ghi, xoay key; kho memory dọn bản ghi hết hạn theo bucket
+"""
+
+import time
+
+from refresh_tokens import MemoryRecordBackend, TokenCipher
+
+
+def test_cipher_round_trip_and_rotation():
+    old = TokenCipher(['key-old'])
+    blob = old.encrypt(b'refresh-token', b'record-1')
+    assert old.decrypt(blob, b'record-1') == b'refresh-token'
+
+    # Key mới đứng đầu: bản mã cũ vẫn đọc được, bản mã mới dùng key mới
+    rotated = TokenCipher(['key-new', 'key-old'])
+    assert rotated.decrypt(blob, b'record-1') == b'refresh-token'
+    new_blob = rotated.encrypt(b'refresh-token', b'record-1')
+    assert old.decrypt(new_blob, b'record-1') is None
+    # Key cũ đã bị loại
+    assert TokenCipher(['key-new']).decrypt(blob, b'record-1') is None
+
+
+def test_cipher_rejects_tampering_and_other_record():
+    cipher = TokenCipher(['key'])
+    blob = cipher.encrypt(b'refresh-token', b'record-1')
+    assert cipher.decrypt(blob, b'record-2') is None
+    flipped = blob[:-2] + ('AA' if blob[-2:] != 'AA' else 'BA')
+    assert cipher.decrypt(flipped, b'record-1') is None
+    assert cipher.decrypt('not-base64!', b'record-1') is None
+
+
+def test_memory_backend_expires_by_bucket():
+    backend = MemoryRecordBackend()
+    backend.set('short', 'blob-1', ttl=1)
+    backend.set('long', 'blob-2', ttl=3600)
+    backend.set('renewed', 'blob-3', ttl=1)
+    backend.set('renewed', 'blob-4', ttl=3600)
+
+    later = time.time() + 2 * MemoryRecordBackend.BUCKET_SECONDS
+    assert backend.expire(now=later) == 1
+    assert len(backend) == 2
+    assert backend.get('renewed') == 'blob-4'
+    assert backend.expire(now=later) == 0
+    assert backend.expire(now=time.time() + 7200) == 2
+    assert len(backend) == 0
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind: yêu cầu gửi lỗi mãi không bị thử lại vô hạn mà chuyển sang dead-letter
+"""
+
+import io
+import json
+import os
+
+from registration_journal import DEAD_LETTER_NAME, RegistrationFlusher, RegistrationJournal
+from structured_log import StructuredLogger
+
+
+def test_failing_entry_moves_to_dead_letter(tmp_path):
+    journal = RegistrationJournal(str(tmp_path), fsync=False)
+    journal.open()
+    entry_id = journal.append({'email': 'stuck@example.com', 'machine_id': 'm-1'})
+    ok_id = journal.append({'email': 'ok@example.com', 'machine_id': 'm-2'})
+    log = io.StringIO()
+    flusher = RegistrationFlusher(
+        journal, lambda batch: {i: ('ok' if i == ok_id else 'retry') for i, _ in batch},
+        base_backoff=0, max_attempts=3, logger=StructuredLogger(stream=log, asynchronous=False)
+    )
+
+    for _ in range(3):
+        flusher.flush_once()
+    assert len(journal) == 0
+    assert flusher.flush_once() == 0
+    assert journal.stats()['dead_lettered'] == 1
+    with open(os.path.join(str(tmp_path), DEAD_LETTER_NAME), encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert [(r['id'], r['data']['email'], r['attempts']) for r in records] == [(entry_id, 'stuck@example.com', 3)]
+    assert json.loads(log.getvalue())['event'] == 'register_dead_letter'
+
+    # Dead-letter không bị process khác replay như journal của process đã chết
+    assert RegistrationJournal(str(tmp_path), fsync=False).open() == 0
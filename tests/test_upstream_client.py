@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""UpstreamClient.call: breaker half_open không bị kẹt khi bulkhead từ chối lượt thử"""
+
+import pytest
+
+from mock_upstreams import StandInServer
+from upstream_client import Bulkhead, BulkheadFull, CircuitBreaker, CircuitOpenError, UpstreamCall, UpstreamClient
+
+
+@pytest.fixture(scope='module')
+def upstream():
+    server = StandInServer(routes={('GET', '/ping'): lambda body, query, headers: (200, {'ok': True})}).start()
+    yield server
+    server.stop()
+
+
+def test_full_bulkhead_does_not_strand_half_open_breaker(upstream):
+    client = UpstreamClient()
+    breaker = CircuitBreaker('admin', failure_threshold=1, reset_timeout=0)
+    bulkhead = Bulkhead('admin', max_concurrent=1)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    def call():
+        return client.call(UpstreamCall('GET', upstream.url + '/ping', breaker=breaker, bulkhead=bulkhead, timeout=5))
+
+    assert bulkhead.acquire()
+    try:
+        assert isinstance(call().error, BulkheadFull)
+        # Lượt thử bị bulkhead từ chối đã được trả lại: breaker vẫn cho thử, không từ chối như đang mở
+        assert isinstance(call().error, BulkheadFull)
+    finally:
+        bulkhead.release()
+
+    result = call()
+    assert result.error is None and result.status_code == 200
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert upstream.calls['/ping'] == 1
+    client.close()
+
+
+def test_half_open_allows_only_one_trial(upstream):
+    client = UpstreamClient()
+    breaker = CircuitBreaker('admin', failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()  # lượt thử đang chạy ở nơi khác
+    result = client.call(UpstreamCall('GET', upstream.url + '/ping', breaker=breaker, timeout=5))
+    assert isinstance(result.error, CircuitOpenError)
+    client.close()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+RedisVerificationStore: số mã đang chờ (gauge /metrics) đếm bằng index, không SCAN keyspace
+VerificationSnapshotter: snapshot hỏng được bỏ qua và ghi vào log có cấu trúc
+"""
+
+import io
+import json
+import time
+
+import fakeredis
+import pytest
+
+from structured_log import StructuredLogger
+from verification_store import MemoryVerificationStore, RedisVerificationStore, VerificationSnapshotter
+
+
+@pytest.fixture
+def store(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(client, 'scan_iter', lambda *a, **kw: pytest.fail('__len__ không được SCAN'))
+    return RedisVerificationStore(client=client)
+
+
+def test_len_follows_add_pop_delete(store):
+    store.put('111111', 'a@example.com', 'A')
+    assert store.add('222222', 'b@example.com', 'B') is not None
+    assert store.add('222222', 'c@example.com', 'C') is None
+    store.put('333333', 'd@example.com', 'D')
+    assert len(store) == 3
+
+    assert store.pop('111111').email == 'a@example.com'
+    assert store.pop('111111') is None
+    assert store.delete('222222')
+    assert not store.delete('222222')
+    assert len(store) == 1
+
+
+def test_len_drops_expired_codes(store):
+    store.put('111111', 'a@example.com', 'A', ttl=0.05)
+    store.put('222222', 'b@example.com', 'B')
+    assert len(store) == 2
+    time.sleep(0.1)
+    assert len(store) == 1
+
+
+def test_len_ignores_other_keys(store):
+    store._client.set('google_oauth:other', 'x')
+    store.put('111111', 'a@example.com', 'A')
+    assert len(store) == 1
+
+
+def test_writes_prune_expired_codes_without_scrape(store):
+    # Không ai gọi __len__ (/metrics không được scrape): put/add tự bỏ mã hết hạn khỏi index
+    store.put('111111', 'a@example.com', 'A', ttl=0.05)
+    store.add('222222', 'b@example.com', 'B', ttl=0.05)
+    time.sleep(0.1)
+    store.put('333333', 'c@example.com', 'C')
+    assert store._client.zcard(store.INDEX_KEY) == 1
+    assert store.expired_total == 2
+
+    store.add('444444', 'd@example.com', 'D', ttl=0.05)
+    assert store.expire(now=time.time() + 1) == 1
+    assert store._client.zcard(store.INDEX_KEY) == 1
+    assert store.expired_total == 3
+
+
+def test_corrupt_snapshot_is_logged_and_skipped(tmp_path):
+    path = tmp_path / 'codes.snapshot'
+    path.write_bytes(b'not a snapshot')
+    log = io.StringIO()
+    snapshotter = VerificationSnapshotter(MemoryVerificationStore(), str(path),
+                                          logger=StructuredLogger(stream=log, asynchronous=False))
+    assert snapshotter.restore() == 0
+    assert not path.exists()
+    events = [json.loads(line)['event'] for line in log.getvalue().splitlines()]
+    assert events == ['verification_snapshot_skipped', 'verification_snapshot_restored']
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Mỗi mã xác minh chỉ dùng được một lần kể cả khi nhiều worker/instance dùng chung kho Redis"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fakeredis
+import pytest
+
+from verification_store import RedisVerificationStore
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+def redis_store(server):
+    """Một instance server: client Redis riêng, cùng dữ liệu"""
+    return RedisVerificationStore(client=fakeredis.FakeRedis(server=server))
+
+
+def verify(srv, code, machine_id):
+    response = srv.app.test_client().post('/api/verify-google-auth',
+                                          json={'auth_code': code, 'machine_id': machine_id})
+    return response.status_code, response.get_json()
+
+
+def test_concurrent_pop_returns_code_once(redis_server):
+    stores = [redis_store(redis_server) for _ in range(8)]
+    stores[0].put('123456', 'a@example.com', 'A')
+    barrier = threading.Barrier(len(stores))
+
+    def claim(store):
+        barrier.wait()
+        return store.pop('123456')
+
+    with ThreadPoolExecutor(max_workers=len(stores)) as pool:
+        claimed = [entry for entry in pool.map(claim, stores) if entry is not None]
+    assert len(claimed) == 1
+    assert claimed[0].email == 'a@example.com'
+    assert stores[0].get('123456') is None
+
+
+def test_concurrent_verify_same_code_logs_in_once(srv, admin, redis_server, monkeypatch):
+    monkeypatch.setattr(srv, 'verification_store', redis_store(redis_server))
+    srv.verification_store.put('654321', 'b@example.com', 'B')
+    # Register chậm: cả hai request đều đã đọc mã trước khi request đầu tiên xong
+    admin.latency['/api/register'] = 0.2
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(lambda machine_id: verify(srv, '654321', machine_id), ['m-a', 'm-b']))
+
+    statuses = sorted(status for status, _ in results)
+    assert statuses == [200, 400]
+    assert admin.calls['/api/register'] == 1
+
+
+def test_retryable_failure_releases_code(srv, admin, redis_server, monkeypatch):
+    monkeypatch.setattr(srv, 'verification_store', redis_store(redis_server))
+    entry = srv.verification_store.put('111222', 'c@example.com', 'C')
+    admin.fail_status = 503
+
+    status, _ = verify(srv, '111222', 'm-c')
+    assert status >= 500
+    restored = srv.verification_store.get('111222')
+    assert restored is not None and restored.email == 'c@example.com'
+    assert restored.expires_at == pytest.approx(entry.expires_at, abs=0.5)
+
+    admin.fail_status = None
+    status, payload = verify(srv, '111222', 'm-c')
+    assert status == 200 and payload['success']
+    assert srv.verification_store.get('111222') is None
+
+
+def test_rejected_verify_consumes_code(srv, admin):
+    admin.machines['m-d'] = 'someone-else@example.com'
+    srv.verification_store.put('333444', 'd@example.com', 'D')
+
+    status, _ = verify(srv, '333444', 'm-d')
+    assert status == 400
+    assert srv.verification_store.get('333444') is None
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Verify gửi trùng: lần gửi đồng thời dùng chung kết quả, lần gửi đến muộn không nhận lại auth_token"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def verify(srv, code, machine_id):
+    response = srv.app.test_client().post('/api/verify-google-auth',
+                                          json={'auth_code': code, 'machine_id': machine_id})
+    return response.status_code, response.get_json()
+
+
+def test_concurrent_duplicates_share_one_login(srv, admin):
+    srv.verification_store.put('dup-code', 'dup@example.com', 'Dup')
+    admin.latency['/api/register'] = 0.2
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        results = list(pool.map(lambda _: verify(srv, 'dup-code', 'm-dup'), range(3)))
+
+    assert [status for status, _ in results] == [200] * 3
+    assert len({payload['auth_token'] for _, payload in results}) == 1
+    assert admin.calls['/api/register'] == 1
+
+
+def test_late_duplicate_does_not_replay_token(srv, admin):
+    srv.verification_store.put('late-code', 'late@example.com', 'Late')
+    status, payload = verify(srv, 'late-code', 'm-late')
+    assert status == 200 and payload['auth_token']
+
+    # Ai biết auth_code + machine_id (vd đọc được mã trên màn hình) không lấy được token sau khi đã dùng
+    status, payload = verify(srv, 'late-code', 'm-late')
+    assert status == 400
+    assert 'auth_token' not in payload
+    assert admin.calls['/api/register'] == 1
+    assert srv.verify_flights.stats()['in_flight'] == 0
@@ -0,0 +1,644 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP client dùng chung cho các lời gọi tới Google và server admin
+Giữ kết nối keep-alive theo từng host, có bộ đếm pool hit / số kết nối tạo mới
+
+Các luồng xử lý (callback, verify) được viết dạng generator: yield UpstreamCall và
+nhận lại UpstreamResult. Cùng một generator chạy được với client đồng bộ (Flask)
+lẫn client bất đồng bộ (ASGI, xem async_server.py).
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from metrics import UPSTREAM_SECONDS, upstream_outcome
+
+try:
+    import fcntl
+except ImportError:  # Không phải POSIX (Windows): không có file lock, mọi process đều ping
+    fcntl = None
+
+# Mặc định cho mỗi worker: số host giữ pool và số kết nối tối đa mỗi host
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
+class CircuitOpenError(Exception):
+    """Circuit breaker đang mở: không gọi upstream, báo lỗi ngay"""
+
+
+class DeadlineExceeded(Exception):
+    """Request đã dùng hết ngân sách thời gian, không còn thời gian cho lời gọi upstream kế tiếp"""
+
+
+class BulkheadFull(Exception):
+    """Đã đủ số lời gọi đồng thời tới upstream và hàng chờ cũng đầy"""
+
+
+class UpstreamCall:
+    """
+    Một lời gọi upstream do generator yêu cầu
+    wake = KeepWarmScheduler cần đánh thức trước, breaker = CircuitBreaker của endpoint,
+    bulkhead = Bulkhead giới hạn số lời gọi đồng thời tới upstream đó
+    """
+
+    __slots__ = ('method', 'url', 'stage', 'wake', 'breaker', 'bulkhead', 'kwargs')
+
+    def __init__(self, method, url, stage=None, wake=None, breaker=None, bulkhead=None, **kwargs):
+        self.method = method
+        self.url = url
+        self.stage = stage
+        self.wake = wake
+        self.breaker = breaker
+        self.bulkhead = bulkhead
+        self.kwargs = kwargs
+
+
+class UpstreamResult:
+    """Kết quả lời gọi upstream: status_code/text như requests, hoặc error nếu lỗi kết nối"""
+
+    __slots__ = ('status_code', 'text', 'error')
+
+    def __init__(self, status_code=0, text='', error=None):
+        self.status_code = status_code
+        self.text = text
+        self.error = error
+
+    def unwrap(self):
+        """Ném lại lỗi kết nối (nếu có) để khối try/except của bước xử lý bắt như trước"""
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def run_upstream_steps(steps, client):
+    """Chạy generator các bước xử lý với client đồng bộ, trả về giá trị return của generator"""
+    result = None
+    while True:
+        try:
+            call = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        # Breaker đang mở thì không tốn thời gian đánh thức server
+        if call.wake is not None and not (call.breaker is not None and call.breaker.is_open):
+            call.wake.ensure_warm(min(call.wake.ping_timeout, call.kwargs.get('timeout') or call.wake.ping_timeout))
+        result = client.call(call)
+
+
+class Deadline:
+    """Ngân sách thời gian của một request, chia dần cho các lời gọi upstream còn lại"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def timeout(self, cap, calls_left=1):
+        """
+        Timeout cho lời gọi kế tiếp: không quá cap, không quá phần chia đều của thời gian còn lại
+        (calls_left = số lời gọi tối đa còn phải làm, kể cả lời gọi này)
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Đã dùng hết {self.budget}s cho request")
+        return min(cap, remaining / max(calls_left, 1))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker cho một endpoint upstream (closed -> open -> half_open -> closed)
+    closed: gọi bình thường; failure_threshold lỗi liên tiếp (lỗi kết nối/timeout/5xx) thì mở
+    open: từ chối ngay trong reset_timeout giây
+    half_open: cho tối đa half_open_max_calls lời gọi thử; thành công thì đóng, lỗi thì mở lại
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_calls = 0
+        self._lock = threading.Lock()
+        self.rejected_total = 0
+        self.opened_total = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_calls = 0
+        return self._state
+
+    @property
+    def is_open(self):
+        """Lời gọi kế tiếp chắc chắn bị từ chối (không thay đổi trạng thái)"""
+        return self.state == self.OPEN
+
+    def allow(self):
+        """Gọi trước mỗi lời gọi upstream; False = từ chối ngay"""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._trial_calls < self.half_open_max_calls:
+                self._trial_calls += 1
+                return True
+            self.rejected_total += 1
+            return False
+
+    def record(self, result):
+        """Ghi nhận kết quả UpstreamResult: lỗi kết nối/timeout hoặc 5xx là thất bại"""
+        if result.error is not None or result.status_code >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened_total += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._failures = 0
+
+    def release_trial(self):
+        """Lời gọi đã được allow() nhưng không có kết quả (bị hủy): trả lại lượt thử của half_open"""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._trial_calls > 0:
+                self._trial_calls -= 1
+
+
+def reject_call(call, error, outcome):
+    """Kết quả cho lời gọi bị từ chối trước khi gọi mạng (breaker mở, bulkhead đầy)"""
+    if call.stage:
+        UPSTREAM_SECONDS.observe(0.0, call.stage, outcome)
+    return UpstreamResult(error=error)
+
+
+def reject_open_circuit(call):
+    return reject_call(call, CircuitOpenError(f"Circuit '{call.breaker.name}' đang mở"), 'circuit_open')
+
+
+def reject_full_bulkhead(call):
+    return reject_call(call, BulkheadFull(f"Bulkhead '{call.bulkhead.name}' đã đầy"), 'bulkhead_full')
+
+
+class UpstreamStats:
+    """Bộ đếm theo host: pool_hits (dùng lại kết nối), pool_misses, connections_created"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):
+        counters = self._hosts.get(host)
+        if counters is None:
+            counters = self._hosts[host] = {'pool_hits': 0, 'pool_misses': 0, 'connections_created': 0}
+        return counters
+
+    def record_checkout(self, host, reused):
+        with self._lock:
+            self._host(host)['pool_hits' if reused else 'pool_misses'] += 1
+
+    def record_connect(self, host):
+        with self._lock:
+            self._host(host)['connections_created'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {host: dict(counters) for host, counters in self._hosts.items()}
+
+
+def _counting_pool_classes(stats):
+    """Tạo các lớp pool/connection của urllib3 có ghi bộ đếm vào stats"""
+
+    class CountingHTTPConnection(HTTPConnection):
+        def connect(self):
+            stats.record_connect(self.host)
+            return super().connect()
+
+    class CountingHTTPSConnection(HTTPSConnection):
+        def connect(self):
+            stats.record_connect(self.host)
+            return super().connect()
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = CountingHTTPConnection
+
+        def _get_conn(self, timeout=None):
+            conn = super()._get_conn(timeout)
+            stats.record_checkout(self.host, getattr(conn, 'sock', None) is not None)
+            return conn
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = CountingHTTPSConnection
+
+        def _get_conn(self, timeout=None):
+            conn = super()._get_conn(timeout)
+            stats.record_checkout(self.host, getattr(conn, 'sock', None) is not None)
+            return conn
+
+    return {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _counting_pool_classes(self._stats)
+
+
+class UpstreamClient:
+    """requests.Session dùng chung trong process, mở lại pool sau khi gunicorn fork"""
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False, verify=True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.verify = verify
+        self.stats = UpstreamStats()
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    def _new_session(self):
+        session = requests.Session()
+        # Không giữ cookie giữa các request của các user khác nhau
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = _CountingAdapter(
+            self.stats,
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def session(self):
+        # Socket mở trước khi fork không được dùng chung giữa các worker
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._new_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        # Truyền verify tường minh, nếu không REQUESTS_CA_BUNDLE sẽ ghi đè session.verify
+        kwargs.setdefault('verify', self.verify)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def call(self, call):
+        """Thực hiện UpstreamCall, lỗi kết nối được gói vào UpstreamResult.error"""
+        if call.breaker is not None and not call.breaker.allow():
+            return reject_open_circuit(call)
+        if call.bulkhead is not None and not call.bulkhead.acquire():
+            # Không gọi mạng nên không có kết quả để ghi: trả lại lượt thử half_open đã lấy ở allow()
+            if call.breaker is not None:
+                call.breaker.release_trial()
+            return reject_full_bulkhead(call)
+        start = time.perf_counter()
+        result = None
+        try:
+            response = self.request(call.method, call.url, **call.kwargs)
+            result = UpstreamResult(response.status_code, response.text)
+        except Exception as error:
+            result = UpstreamResult(error=error)
+        finally:
+            if call.bulkhead is not None:
+                call.bulkhead.release()
+            if call.breaker is not None:
+                if result is None:
+                    # gevent.Timeout / KeyboardInterrupt (BaseException) giữa lời gọi
+                    call.breaker.release_trial()
+                else:
+                    call.breaker.record(result)
+        if call.stage:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, call.stage, upstream_outcome(result))
+        return result
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class Bulkhead:
+    """
+    Giới hạn số việc chạy đồng thời (endpoint hoặc upstream) với hàng chờ ngắn có giới hạn
+    Đủ max_concurrent thì tối đa max_queue việc được chờ tối đa queue_timeout giây,
+    còn lại bị từ chối ngay để worker không bị giữ bởi upstream chậm. max_concurrent <= 0 = không giới hạn
+    """
+
+    def __init__(self, name, max_concurrent, max_queue=0, queue_timeout=0.5):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected_total = 0
+        self._cond = threading.Condition()
+
+    def _has_room(self):
+        return self.max_concurrent <= 0 or self.active < self.max_concurrent
+
+    def acquire(self):
+        """Chiếm một chỗ (có thể chờ trong hàng chờ); False = bị từ chối, không cần release"""
+        with self._cond:
+            if self._has_room():
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected_total += 1
+                return False
+            self.waiting += 1
+            try:
+                admitted = self._cond.wait_for(self._has_room, self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.rejected_total += 1
+                return False
+            self.active += 1
+            return True
+
+    def try_acquire(self):
+        """Như acquire() nhưng không chờ (dùng trong event loop của bản ASGI)"""
+        with self._cond:
+            if self._has_room():
+                self.active += 1
+                return True
+            self.rejected_total += 1
+            return False
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        return {'active': self.active, 'waiting': self.waiting, 'limit': self.max_concurrent,
+                'rejected': self.rejected_total}
+
+
+class TTLCache:
+    """Cache kết quả upstream theo key: hết hạn sau ttl giây, tối đa maxsize key (xóa key ít dùng nhất)"""
+
+    def __init__(self, ttl=30, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi trùng key đang chạy đồng thời: lời gọi đầu tiên chạy, các lời gọi sau chờ
+    và dùng chung kết quả. Kết quả không được giữ lại sau khi lời gọi xong (lời gọi trùng đến muộn
+    chạy lại). key = None thì chạy thẳng, không gộp.
+    """
+
+    def __init__(self):
+        self._flights = {}  # key -> _Flight (thread)
+        self._async_flights = {}  # key -> asyncio.Future (event loop của bản ASGI)
+        self._lock = threading.Lock()
+        self.coalesced_total = 0
+
+    def in_flight(self, key):
+        """Đang có lời gọi chạy cho key này"""
+        return key in self._flights or key in self._async_flights
+
+    def do(self, key, fn):
+        """Chạy fn() (đồng bộ) một lần cho mỗi key đang chạy"""
+        if key is None:
+            return fn()
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.coalesced_total += 1
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    async def do_async(self, key, fn):
+        """Như do() cho coroutine: await fn() một lần cho mỗi key đang chạy"""
+        if key is None:
+            return await fn()
+        future = self._async_flights.get(key)
+        if future is not None:
+            self.coalesced_total += 1
+            return await asyncio.shield(future)
+        future = self._async_flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            future.exception()  # Không có ai chờ thì asyncio không cảnh báo exception bị bỏ qua
+            raise
+        finally:
+            del self._async_flights[key]
+
+    def stats(self):
+        return {'in_flight': len(self._flights) + len(self._async_flights), 'coalesced': self.coalesced_total}
+
+
+class KeepWarmScheduler:
+    """
+    Ping server admin định kỳ trong thread nền để server không ngủ (Render free tier)
+    Theo dõi trạng thái warm/cold; request chỉ phải chờ đánh thức khi server đang cold
+    """
+
+    def __init__(self, client, ping_url, interval=240, warm_window=600, ping_timeout=10, leader_lock_path=None):
+        self.client = client
+        self.ping_url = ping_url
+        self.interval = interval
+        # Có phản hồi thành công trong warm_window giây thì coi là warm
+        self.warm_window = warm_window
+        self.ping_timeout = ping_timeout
+        # Nếu set: chỉ process giữ được file lock mới ping theo lịch (1 process/máy, cần fcntl)
+        self.leader_lock_path = leader_lock_path
+        self._cond = threading.Condition()
+        self._waking = False
+        self._last_ok = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._leader_file = None
+        self.pings_total = 0
+        self.wakeups_total = 0
+
+    @property
+    def is_warm(self):
+        return time.time() - self._last_ok < self.warm_window
+
+    def mark_warm(self):
+        """Gọi khi có phản hồi thành công bất kỳ từ server admin"""
+        self._last_ok = time.time()
+
+    def mark_cold(self):
+        self._last_ok = 0.0
+
+    def ping(self, timeout=None):
+        """Ping server admin, cập nhật trạng thái warm/cold"""
+        self.pings_total += 1
+        result = self.client.call(UpstreamCall(
+            'GET', self.ping_url, stage='admin_ping', timeout=timeout or self.ping_timeout
+        ))
+        if result.error is None and result.status_code < 500:
+            self.mark_warm()
+            return True
+        self.mark_cold()
+        return False
+
+    def ensure_warm(self, timeout=None):
+        """
+        Server đang warm: trả về ngay, không gọi mạng.
+        Server cold: chỉ một thread ping để đánh thức, các thread khác chờ kết quả đó.
+        """
+        if self.is_warm:
+            return True
+        timeout = timeout or self.ping_timeout
+        with self._cond:
+            if self._waking:
+                self._cond.wait_for(lambda: not self._waking, timeout)
+                return self.is_warm
+            self._waking = True
+        self.wakeups_total += 1
+        try:
+            return self.ping(timeout)
+        finally:
+            with self._cond:
+                self._waking = False
+                self._cond.notify_all()
+
+    def _is_leader(self):
+        if not self.leader_lock_path or fcntl is None:
+            return True
+        if self._leader_file is None:
+            lock_file = open(self.leader_lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._leader_file = lock_file
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Bỏ qua lượt ping nếu vừa có phản hồi thành công từ request thật
+            if self._is_leader() and time.time() - self._last_ok >= self.interval:
+                self.ping()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='admin-keep-warm', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
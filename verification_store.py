@@ -0,0 +1,666 @@
+# -*- coding: utf-8 -*-
+"""
+Kho lưu trữ mã xác minh cho Google OAuth Server
+- memory: trong process, tra cứu O(1), hết hạn theo timing wheel, giới hạn số mã
+- sqlite: dùng chung cho nhiều worker trên cùng máy (WAL + index expires_at)
+- redis: dùng chung cho nhiều instance sau load balancer (TTL của Redis)
+- VerificationSnapshotter: ghi các mã còn hạn của kho memory ra file khi tắt, nạp lại khi khởi động
+"""
+
+import json
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+
+from structured_log import StructuredLogger
+
+try:
+    import redis
+except ImportError:  # Chỉ cần khi dùng backend redis
+    redis = None
+
+# Thời gian sống mặc định của mã xác minh (5 phút)
+DEFAULT_TTL = 300
+# Số mã tối đa giữ trong bộ nhớ, vượt quá sẽ xóa mã cũ nhất
+DEFAULT_MAX_ENTRIES = 100000
+# File SQLite mặc định dùng chung giữa các worker gunicorn trên cùng máy
+DEFAULT_SQLITE_PATH = os.path.join(tempfile.gettempdir(), 'google_oauth_verification.db')
+DEFAULT_REDIS_URL = 'redis://localhost:6379/0'
+# Snapshot: magic + (version, số mã, thời điểm ghi) rồi phần thân nén zlib, lưu theo cột:
+# độ dài 4 cột chuỗi + code/email/name/link nối bằng NUL (UTF-8) + expires_at dạng mảng double
+# Version 1 (không có cột link) vẫn đọc được
+SNAPSHOT_MAGIC = b'GOVS'
+SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADER = struct.Struct('>HId')
+_SNAPSHOT_COLUMNS = {1: struct.Struct('>III'), 2: struct.Struct('>IIII')}
+
+
+class VerificationEntry:
+    """
+    Thông tin user gắn với một mã xác minh (chỉ giữ các trường cần cho verify)
+    link: mã xác minh mà mục này trỏ tới (mục device của device flow), rỗng với mã thường
+    """
+
+    __slots__ = ('email', 'name', 'expires_at', 'link')
+
+    def __init__(self, email, name, expires_at, link=''):
+        self.email = email
+        self.name = name
+        self.expires_at = expires_at
+        self.link = link
+
+    def is_expired(self, now=None):
+        return self.expires_at < (time.time() if now is None else now)
+
+
+class MemoryVerificationStore:
+    """Kho mã xác minh trong bộ nhớ của một process"""
+
+    # Cần cleanup_worker gọi expire() định kỳ
+    needs_cleanup = True
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        # Timing wheel: {giây hết hạn: deque[(code, entry)]} - phần tử cũ được bỏ qua khi dọn
+        self._buckets = {}
+        self._wheel_items = 0
+        self._next_bucket = int(time.time())
+        self._lock = threading.Lock()
+        self.expired_total = 0
+        self.evicted_total = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, code):
+        return code in self._entries
+
+    def put(self, code, email, name, ttl=None, link=''):
+        """Lưu mã xác minh, ghi đè mã trùng và xóa mã cũ nhất khi đầy"""
+        now = time.time()
+        entry = VerificationEntry(email, name, now + (self.ttl if ttl is None else ttl), link)
+        with self._lock:
+            self._put_locked(code, entry, now)
+        return entry
+
+    def add(self, code, email, name, ttl=None, link=''):
+        """Lưu mã chỉ khi chưa có mã còn hạn trùng; trả về None nếu mã đang được dùng"""
+        now = time.time()
+        entry = VerificationEntry(email, name, now + (self.ttl if ttl is None else ttl), link)
+        with self._lock:
+            existing = self._entries.get(code)
+            if existing is not None and not existing.is_expired(now):
+                return None
+            self._put_locked(code, entry, now)
+        return entry
+
+    def _put_locked(self, code, entry, now):
+        self._expire_locked(now)
+        if code not in self._entries:
+            while len(self._entries) >= self.max_entries:
+                self._evict_oldest_locked()
+        self._entries[code] = entry
+        self._add_to_wheel_locked(code, entry)
+
+    def get(self, code):
+        """Lấy thông tin của mã (có thể đã hết hạn nhưng chưa được dọn)"""
+        return self._entries.get(code)
+
+    def snapshot_entries(self, now=None):
+        """[(code, entry)] còn hạn - chỉ copy dưới lock, lọc và ghi file ở ngoài"""
+        now = time.time() if now is None else now
+        with self._lock:
+            items = list(self._entries.items())
+        return [(code, entry) for code, entry in items if entry.expires_at >= now]
+
+    def restore_entries(self, rows, chunk_size=5000):
+        """
+        Nạp lại [(code, email, name, expires_at, link)] từ snapshot theo từng đoạn (request vẫn được phục vụ
+        giữa các đoạn); mã đã có trong kho (cấp sau khi khởi động) được giữ nguyên, kho đầy thì dừng
+        (không đẩy mã mới ra). Trả về số mã đã nạp
+        """
+        restored = 0
+        for start in range(0, len(rows), chunk_size):
+            now = time.time()
+            with self._lock:
+                self._expire_locked(now)
+                entries, buckets, first_second = self._entries, self._buckets, self._next_bucket
+                room = self.max_entries - len(entries)
+                added = 0
+                for code, email, name, expires_at, link in rows[start:start + chunk_size]:
+                    if expires_at < now or code in entries:
+                        continue
+                    if added >= room:
+                        break
+                    entry = entries[code] = VerificationEntry(email, name, expires_at, link)
+                    # Như _add_to_wheel_locked, gộp cho cả đoạn
+                    second = int(expires_at)
+                    bucket = buckets.get(second if second > first_second else first_second)
+                    if bucket is None:
+                        bucket = buckets[second if second > first_second else first_second] = deque()
+                    bucket.append((code, entry))
+                    added += 1
+                self._wheel_items += added
+            restored += added
+            if added >= room:
+                break
+        return restored
+
+    def pop(self, code):
+        """Lấy và xóa mã trong một bước - mỗi mã chỉ dùng được một lần"""
+        with self._lock:
+            return self._entries.pop(code, None)
+
+    def delete(self, code):
+        """Xóa mã, không báo lỗi nếu mã đã bị xóa trước đó"""
+        with self._lock:
+            return self._entries.pop(code, None) is not None
+
+    def expire(self, now=None):
+        """Xóa các mã đã hết hạn, chi phí tỉ lệ với số mã thực sự hết hạn"""
+        with self._lock:
+            return self._expire_locked(time.time() if now is None else now)
+
+    def _add_to_wheel_locked(self, code, entry):
+        second = max(int(entry.expires_at), self._next_bucket)
+        bucket = self._buckets.get(second)
+        if bucket is None:
+            bucket = self._buckets[second] = deque()
+        bucket.append((code, entry))
+        self._wheel_items += 1
+        # Khi bị flood, wheel giữ nhiều phần tử rác hơn số mã còn sống -> xây lại
+        if self._wheel_items > 2 * len(self._entries) + 1024:
+            self._rebuild_wheel_locked()
+
+    def _rebuild_wheel_locked(self):
+        self._buckets = {}
+        self._wheel_items = 0
+        for code, entry in self._entries.items():
+            second = max(int(entry.expires_at), self._next_bucket)
+            self._buckets.setdefault(second, deque()).append((code, entry))
+            self._wheel_items += 1
+
+    def _bucket_seconds_locked(self, limit):
+        # Khoảng trống dài (server rảnh) thì duyệt các bucket đang có thay vì từng giây
+        if limit - self._next_bucket > len(self._buckets):
+            return sorted(s for s in self._buckets if s < limit)
+        return range(self._next_bucket, limit)
+
+    def _expire_locked(self, now):
+        # Bucket giây s chứa mã hết hạn trong [s, s+1) - dọn khi cả bucket đã qua
+        limit = int(now)
+        if limit <= self._next_bucket:
+            return 0
+        entries = self._entries
+        removed = 0
+        for second in self._bucket_seconds_locked(limit):
+            bucket = self._buckets.pop(second, None)
+            if not bucket:
+                continue
+            self._wheel_items -= len(bucket)
+            for code, entry in bucket:
+                if entries.get(code) is entry:
+                    del entries[code]
+                    removed += 1
+        self._next_bucket = limit
+        self.expired_total += removed
+        return removed
+
+    def _evict_oldest_locked(self):
+        # Mã cũ nhất nằm ở bucket hết hạn sớm nhất (TTL giống nhau)
+        for second in sorted(self._buckets):
+            bucket = self._buckets[second]
+            while bucket:
+                code, entry = bucket.popleft()
+                self._wheel_items -= 1
+                if self._entries.get(code) is entry:
+                    del self._entries[code]
+                    self.evicted_total += 1
+                    if not bucket:
+                        del self._buckets[second]
+                    return
+            del self._buckets[second]
+        # Wheel rỗng nhưng vẫn còn mã (không xảy ra nếu wheel đồng bộ) - xóa mã bất kỳ
+        self._entries.pop(next(iter(self._entries)))
+        self.evicted_total += 1
+
+
+class SQLiteVerificationStore:
+    """Kho mã xác minh dùng chung cho mọi worker trên cùng một máy (SQLite WAL)"""
+
+    needs_cleanup = True
+    # Số lần put giữa hai lần kiểm tra giới hạn (COUNT(*) phải quét bảng)
+    CAP_CHECK_INTERVAL = 256
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, busy_timeout=5.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._puts = 0
+        self.expired_total = 0
+        self.evicted_total = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS verification_codes ("
+            " code TEXT PRIMARY KEY,"
+            " email TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " link TEXT NOT NULL DEFAULT ''"
+            ") WITHOUT ROWID"
+        )
+        self._add_link_column(conn)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_verification_codes_expires_at"
+            " ON verification_codes (expires_at)"
+        )
+
+    @staticmethod
+    def _add_link_column(conn):
+        # File tạo trước khi có cột link (file nằm trên đĩa bền, giữ qua deploy)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(verification_codes)")}
+        if 'link' in columns:
+            return
+        try:
+            conn.execute("ALTER TABLE verification_codes ADD COLUMN link TEXT NOT NULL DEFAULT ''")
+        except sqlite3.OperationalError:
+            # Worker khác vừa thêm cột
+            pass
+
+    def _conn(self):
+        # Mỗi thread một connection; sau khi gunicorn fork thì mở connection mới
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            local.conn = conn
+            local.pid = os.getpid()
+        return conn
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM verification_codes").fetchone()[0]
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+    def put(self, code, email, name, ttl=None, link=''):
+        """Lưu mã xác minh, ghi đè mã trùng và xóa mã cũ nhất khi đầy"""
+        entry = VerificationEntry(email, name, time.time() + (self.ttl if ttl is None else ttl), link)
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO verification_codes (code, email, name, expires_at, link)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (code, email, name, entry.expires_at, link)
+        )
+        self._puts += 1
+        if self._puts % self.CAP_CHECK_INTERVAL == 0:
+            self._enforce_cap(conn)
+        return entry
+
+    def add(self, code, email, name, ttl=None, link=''):
+        """Lưu mã chỉ khi chưa có mã còn hạn trùng (một câu lệnh upsert); trả về None nếu mã đang được dùng"""
+        now = time.time()
+        entry = VerificationEntry(email, name, now + (self.ttl if ttl is None else ttl), link)
+        conn = self._conn()
+        cursor = conn.execute(
+            "INSERT INTO verification_codes (code, email, name, expires_at, link) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (code) DO UPDATE SET"
+            " email = excluded.email, name = excluded.name, expires_at = excluded.expires_at, link = excluded.link"
+            " WHERE verification_codes.expires_at < ?",
+            (code, email, name, entry.expires_at, link, now)
+        )
+        if cursor.rowcount == 0:
+            return None
+        self._puts += 1
+        if self._puts % self.CAP_CHECK_INTERVAL == 0:
+            self._enforce_cap(conn)
+        return entry
+
+    def get(self, code):
+        """Lấy thông tin của mã (có thể đã hết hạn nhưng chưa được dọn)"""
+        row = self._conn().execute(
+            "SELECT email, name, expires_at, link FROM verification_codes WHERE code = ?",
+            (code,)
+        ).fetchone()
+        return VerificationEntry(*row) if row else None
+
+    def pop(self, code):
+        """Lấy và xóa mã trong một transaction - mỗi mã chỉ dùng được một lần"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT email, name, expires_at, link FROM verification_codes WHERE code = ?",
+                (code,)
+            ).fetchone()
+            if row:
+                conn.execute("DELETE FROM verification_codes WHERE code = ?", (code,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return VerificationEntry(*row) if row else None
+
+    def delete(self, code):
+        """Xóa mã, không báo lỗi nếu mã đã bị xóa trước đó"""
+        cursor = self._conn().execute("DELETE FROM verification_codes WHERE code = ?", (code,))
+        return cursor.rowcount > 0
+
+    def expire(self, now=None):
+        """Xóa các mã đã hết hạn qua index expires_at"""
+        cursor = self._conn().execute(
+            "DELETE FROM verification_codes WHERE expires_at < ?",
+            (time.time() if now is None else now,)
+        )
+        self.expired_total += cursor.rowcount
+        return cursor.rowcount
+
+    def _enforce_cap(self, conn):
+        overflow = len(self) - self.max_entries
+        if overflow > 0:
+            cursor = conn.execute(
+                "DELETE FROM verification_codes WHERE code IN ("
+                " SELECT code FROM verification_codes ORDER BY expires_at LIMIT ?)",
+                (overflow,)
+            )
+            self.evicted_total += cursor.rowcount
+
+
+class RedisVerificationStore:
+    """Kho mã xác minh trên Redis, dùng chung cho mọi instance"""
+
+    # Redis tự xóa key khi hết TTL, không cần cleanup_worker
+    needs_cleanup = False
+    KEY_PREFIX = 'google_oauth:code:'
+    # Sorted set {mã: expires_at} để đếm mã đang chờ mà không SCAN toàn bộ keyspace
+    # Mã hết hạn được bỏ khỏi index ngay trong put/add (ZREMRANGEBYSCORE), index không phình khi không ai scrape
+    INDEX_KEY = 'google_oauth:code-index'
+
+    def __init__(self, url=None, ttl=DEFAULT_TTL, max_connections=20, socket_timeout=2.0, client=None):
+        self.ttl = ttl
+        self.expired_total = 0
+        self.evicted_total = 0
+        if client is not None:
+            self._client = client
+        else:
+            if redis is None:
+                raise RuntimeError("Backend redis cần cài đặt: pip install redis")
+            # Pool kết nối dùng chung cho mọi thread trong process
+            pool = redis.BlockingConnectionPool.from_url(
+                url or DEFAULT_REDIS_URL,
+                max_connections=max_connections,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_timeout,
+                timeout=socket_timeout
+            )
+            self._client = redis.Redis(connection_pool=pool)
+
+    def _key(self, code):
+        return self.KEY_PREFIX + code
+
+    @staticmethod
+    def _encode(entry):
+        fields = [entry.email, entry.name, entry.expires_at]
+        if entry.link:
+            fields.append(entry.link)
+        return json.dumps(fields, separators=(',', ':'))
+
+    @staticmethod
+    def _decode(raw):
+        return VerificationEntry(*json.loads(raw)) if raw else None
+
+    def _prune(self, pipe, now):
+        """Thêm lệnh bỏ mã đã hết hạn khỏi index vào pipeline; Redis đã tự xóa key của các mã này"""
+        pipe.zremrangebyscore(self.INDEX_KEY, '-inf', now)
+
+    def _count_pruned(self, removed):
+        self.expired_total += removed
+        return removed
+
+    def __len__(self):
+        """Bỏ mã đã hết hạn khỏi index rồi ZCARD - O(log n) thay vì SCAN mỗi lần /metrics scrape"""
+        pipe = self._client.pipeline(transaction=True)
+        self._prune(pipe, time.time())
+        pipe.zcard(self.INDEX_KEY)
+        removed, count = pipe.execute()
+        self._count_pruned(removed)
+        return count
+
+    def __contains__(self, code):
+        return bool(self._client.exists(self._key(code)))
+
+    def put(self, code, email, name, ttl=None, link=''):
+        """Lưu mã xác minh với TTL của Redis (giới hạn bộ nhớ do maxmemory của Redis)"""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        entry = VerificationEntry(email, name, now + ttl, link)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.set(self._key(code), self._encode(entry), ex=max(1, int(ttl + 0.999)))
+        self._prune(pipe, now)
+        pipe.zadd(self.INDEX_KEY, {code: entry.expires_at})
+        self._count_pruned(pipe.execute()[1])
+        return entry
+
+    def add(self, code, email, name, ttl=None, link=''):
+        """SET NX: lưu mã chỉ khi chưa có key trùng; trả về None nếu mã đang được dùng"""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        entry = VerificationEntry(email, name, now + ttl, link)
+        if not self._client.set(self._key(code), self._encode(entry), ex=max(1, int(ttl + 0.999)), nx=True):
+            return None
+        # Ngoài SET NX: index chỉ dùng để đếm, lệch một mã khi process chết giữa hai lệnh là chấp nhận được
+        pipe = self._client.pipeline(transaction=True)
+        self._prune(pipe, now)
+        pipe.zadd(self.INDEX_KEY, {code: entry.expires_at})
+        self._count_pruned(pipe.execute()[0])
+        return entry
+
+    def get(self, code):
+        """Lấy thông tin của mã"""
+        return self._decode(self._client.get(self._key(code)))
+
+    def pop(self, code):
+        """GET + DEL trong một transaction MULTI/EXEC - mỗi mã chỉ dùng được một lần"""
+        pipe = self._client.pipeline(transaction=True)
+        pipe.get(self._key(code))
+        pipe.delete(self._key(code))
+        pipe.zrem(self.INDEX_KEY, code)
+        raw, _, _ = pipe.execute()
+        return self._decode(raw)
+
+    def delete(self, code):
+        """Xóa mã, không báo lỗi nếu mã đã bị xóa trước đó"""
+        pipe = self._client.pipeline(transaction=True)
+        pipe.delete(self._key(code))
+        pipe.zrem(self.INDEX_KEY, code)
+        return pipe.execute()[0] > 0
+
+    def expire(self, now=None):
+        """Redis tự hết hạn key - chỉ bỏ các mã đó khỏi index, trả về số mã đã bỏ"""
+        now = time.time() if now is None else now
+        return self._count_pruned(self._client.zremrangebyscore(self.INDEX_KEY, '-inf', now))
+
+
+def write_snapshot(path, entries):
+    """Ghi [(code, entry)] ra file tạm, fsync rồi rename - file cũ chỉ bị thay khi file mới đã đầy đủ"""
+    # NUL là dấu phân cách cột: bỏ khỏi email/name (Google không trả về ký tự này)
+    codes = '\0'.join([code for code, _ in entries]).encode('utf-8')
+    emails = '\0'.join([entry.email.replace('\0', '') for _, entry in entries]).encode('utf-8')
+    names = '\0'.join([entry.name.replace('\0', '') for _, entry in entries]).encode('utf-8')
+    links = '\0'.join([entry.link for _, entry in entries]).encode('utf-8')
+    expires = array('d', [entry.expires_at for _, entry in entries])
+    if sys.byteorder != 'big':
+        expires.byteswap()
+    columns = _SNAPSHOT_COLUMNS[SNAPSHOT_VERSION].pack(len(codes), len(emails), len(names), len(links))
+    body = zlib.compress(b''.join((columns, codes, emails, names, links, expires.tobytes())), 1)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + _SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, len(entries), time.time()) + body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(entries)
+
+
+def read_snapshot(path):
+    """[(code, email, name, expires_at, link)] trong file snapshot; ValueError nếu file hỏng hoặc khác version"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    header_end = len(SNAPSHOT_MAGIC) + _SNAPSHOT_HEADER.size
+    if len(data) < header_end or not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("Không phải file snapshot mã xác minh")
+    version, count, _ = _SNAPSHOT_HEADER.unpack(data[len(SNAPSHOT_MAGIC):header_end])
+    if version not in _SNAPSHOT_COLUMNS:
+        raise ValueError(f"Snapshot version {version} không được hỗ trợ")
+    if count == 0:
+        return []
+    try:
+        body = zlib.decompress(data[header_end:])
+        sizes = _SNAPSHOT_COLUMNS[version].unpack_from(body)
+        offset = _SNAPSHOT_COLUMNS[version].size
+        columns = []
+        for size in sizes:
+            columns.append(body[offset:offset + size].decode('utf-8').split('\0'))
+            offset += size
+        expires = array('d')
+        expires.frombytes(body[offset:])
+    except (zlib.error, struct.error, ValueError) as e:
+        raise ValueError(f"Snapshot hỏng: {e}")
+    if sys.byteorder != 'big':
+        expires.byteswap()
+    if any(len(column) != count for column in columns + [expires]):
+        raise ValueError(f"Snapshot hỏng: số mã không khớp {count}")
+    codes, emails, names = columns[:3]
+    links = columns[3] if len(columns) > 3 else [''] * count
+    return list(zip(codes, emails, names, expires, links))
+
+
+class VerificationSnapshotter:
+    """
+    Giữ mã đang chờ của kho memory qua restart/deploy: stop() ghi snapshot (SIGTERM, tắt êm),
+    start() nạp snapshot trong thread nền rồi xóa file (mã đã dùng sau đó không sống lại ở lần restart sau).
+    interval > 0: ghi thêm snapshot định kỳ để còn giữ được mã khi process bị kill -9 / crash
+    """
+
+    def __init__(self, store, path=None, interval=0.0, on_restored=None, logger=None):
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.on_restored = on_restored
+        # Mặc định ghi thẳng ra stdout (như khi dùng riêng module); server truyền logger chung
+        self.logger = logger or StructuredLogger(asynchronous=False)
+        self.saved_total = 0
+        self.restored_total = 0
+        self.last_save_seconds = None
+        self.last_restore_seconds = None
+        self._restored = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.path) and hasattr(self.store, 'snapshot_entries')
+
+    @property
+    def restoring(self):
+        """Snapshot đang được nạp: mã chưa thấy trong kho có thể sắp xuất hiện"""
+        return self._thread is not None and not self._restored.is_set()
+
+    def save(self):
+        """Ghi snapshot ngay; trả về số mã đã ghi"""
+        if not self.enabled:
+            return 0
+        start = time.perf_counter()
+        count = write_snapshot(self.path, self.store.snapshot_entries())
+        self.last_save_seconds = time.perf_counter() - start
+        self.saved_total += 1
+        return count
+
+    def restore(self):
+        """Nạp snapshot (nếu có) vào kho rồi xóa file; trả về số mã đã nạp"""
+        if not self.enabled:
+            return 0
+        start = time.perf_counter()
+        try:
+            rows = read_snapshot(self.path)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            self.logger.warning('verification_snapshot_skipped', path=self.path, error=str(e))
+            rows = []
+        restored = self.store.restore_entries(rows)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.last_restore_seconds = time.perf_counter() - start
+        self.restored_total += restored
+        self.logger.info('verification_snapshot_restored', path=self.path, count=restored,
+                         seconds=round(self.last_restore_seconds, 3))
+        if self.on_restored is not None and restored:
+            self.on_restored([row[0] for row in rows])
+        return restored
+
+    def _run(self):
+        try:
+            self.restore()
+        except Exception as e:
+            self.logger.exception('verification_snapshot_restore_error', path=self.path, error=str(e))
+        finally:
+            self._restored.set()
+        while self.interval > 0 and not self._stop.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                self.logger.exception('verification_snapshot_save_error', path=self.path, error=str(e))
+
+    def start(self):
+        """Nạp snapshot trong nền (không chặn khởi động) và ghi định kỳ nếu interval > 0"""
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return self
+        self._stop.clear()
+        self._restored.clear()
+        self._thread = threading.Thread(target=self._run, name='verification-snapshot', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """Dừng ghi định kỳ rồi ghi snapshot cuối cùng (sau khi đã nạp xong snapshot cũ); trả về số mã đã ghi"""
+        if not self.enabled:
+            return 0
+        self._stop.set()
+        # Chưa start hoặc chưa nạp xong: giữ nguyên file cũ thay vì ghi đè bằng kho chưa đầy đủ
+        if not self._restored.wait(timeout if self._thread is not None else 0):
+            return 0
+        return self.save()
+
+    def stats(self):
+        return {'path': self.path, 'interval': self.interval, 'restoring': self.restoring,
+                'saved': self.saved_total, 'restored': self.restored_total,
+                'last_save_seconds': self.last_save_seconds, 'last_restore_seconds': self.last_restore_seconds}
+
+
+def create_verification_store(backend='memory', ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, path=None, url=None):
+    """Tạo kho mã xác minh theo cấu hình (memory | sqlite | redis)"""
+    if backend == 'memory':
+        return MemoryVerificationStore(ttl=ttl, max_entries=max_entries)
+    if backend == 'sqlite':
+        return SQLiteVerificationStore(path or DEFAULT_SQLITE_PATH, ttl=ttl, max_entries=max_entries)
+    if backend == 'redis':
+        return RedisVerificationStore(url, ttl=ttl)
+    raise ValueError(f"Backend verification store không hợp lệ: {backend}")